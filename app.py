@@ -1,13 +1,34 @@
 import asyncio
 import logging
-from typing import Dict
+import multiprocessing
+import os
+import pickle
+import queue
+import tempfile
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
 
 import tornado.autoreload
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 
+from db.current_models import CURRENT_MODELS
+from db.rec_index import REC_INDEX
 from handlers import base, model, recommendation
 from lib.config import config
-from lib.metrics import Unit, write_aggregate_metrics, write_metric
+from lib.db import DB_EXECUTOR, DB_POOL_WARM_CONNECTIONS, db, pool_stats
+from lib.histogram import LatencyHistogram
+from lib.metrics import EMITTER as METRIC_EMITTER
+from lib.metrics import Unit, write_histogram_metrics, write_metric
+
+REC_INDEX_REFRESH_SEC = config.get("REC_INDEX_REFRESH_SEC")
+CURRENT_MODELS_REFRESH_SEC = config.get("CURRENT_MODELS_REFRESH_SEC")
+DB_POOL_VALIDATE_SEC = config.get("DB_POOL_VALIDATE_SEC")
+PROMETHEUS_QUANTILES = [0.5, 0.9, 0.95, 0.99]
+# how often each worker saves its metric totals for the others, see MetricRegistry
+METRICS_SHARE_SEC = 10
 
 APP_SETTINGS = {
     "default_handler_class": base.NotFoundHandler,
@@ -21,14 +42,345 @@ class Application(tornado.web.Application):
             (r"^/$", base.HealthHandler),
             (r"^/health/?$", base.HealthHandler),
             (r"^/recs/?$", recommendation.RecHandler),
+            (r"^/recs/batch/?$", recommendation.RecBatchHandler),
             (r"^/models/?$", model.ModelHandler),
             (r"^/models/(\d+)/set_current/?", model.ModelHandler),
             (r"^/models/(\d+)/articles/?", model.ModelArticleHandler),
+            (r"^/metrics/?$", base.MetricsHandler, {"render_metrics": REGISTRY.render}),
         ]
 
         super(Application, self).__init__(app_handlers, **APP_SETTINGS)
 
 
+# (counter, metric name) pairs flushed every interval
+COUNTERS = [
+    (recommendation.DEFAULT_REC_COUNTER, "total_default_recs_served"),
+    (recommendation.DB_HIT_COUNTER, "total_rec_db_hits"),
+    (recommendation.CACHE_HIT_COUNTER, "total_rec_cache_hits"),
+    (recommendation.CACHE_STALE_HIT_COUNTER, "total_rec_cache_stale_hits"),
+    (recommendation.CACHE_MISS_COUNTER, "total_rec_cache_misses"),
+    (recommendation.SHARED_CACHE_HIT_COUNTER, "total_rec_shared_cache_hits"),
+    (recommendation.INDEX_HIT_COUNTER, "total_rec_index_hits"),
+    (recommendation.TOTAL_HANDLED, "total_rec_requests"),
+    (recommendation.COALESCED_COUNTER, "total_rec_requests_coalesced"),
+]
+
+
+class MetricSnapshot:
+    """
+    the metric buffers of one process for one flush interval, which can be merged with other workers' snapshots
+    or with later snapshots of the same process
+    """
+
+    def __init__(self):
+        self.counters: Dict[str, Dict[str, int]] = {}
+        # keyed by (handler, status code)
+        self.requests: Dict[Tuple[str, str], int] = {}
+        self.latencies: Dict[Tuple[str, str], LatencyHistogram] = {}
+        # keyed by (handler, site, stage)
+        self.stage_latencies: Dict[Tuple[str, str, str], LatencyHistogram] = {}
+        self.db_max_queue_depth = 0
+        self.db_wait_times = LatencyHistogram()
+        # in_use and idle connections of the pool when the snapshot was taken
+        self.db_pool_connections: Dict[str, int] = {}
+        self.db_connect_times = LatencyHistogram()
+        self.db_connections_opened = 0
+        self.db_connections_closed = 0
+        # bytes, entries and evictions of the rec cache by site
+        self.rec_cache_stats: Dict[str, Dict[str, int]] = {}
+        self.rec_shared_cache_errors = 0
+
+    @classmethod
+    def collect(cls) -> "MetricSnapshot":
+        """
+        take this process' buffered metrics, resetting the buffers
+        """
+        snapshot = cls()
+        for counter, metric_name in COUNTERS:
+            snapshot.counters[metric_name] = dict(counter)
+            for site in counter:
+                counter[site] = 0
+        snapshot.requests = dict(base.REQUEST_COUNTER)
+        base.REQUEST_COUNTER.clear()
+
+        snapshot.latencies = dict(base.LATENCY_HISTOGRAMS)
+        base.LATENCY_HISTOGRAMS.clear()
+        snapshot.stage_latencies = dict(base.STAGE_LATENCY_HISTOGRAMS)
+        base.STAGE_LATENCY_HISTOGRAMS.clear()
+
+        snapshot.db_max_queue_depth, snapshot.db_wait_times = DB_EXECUTOR.flush_stats()
+        snapshot.db_pool_connections = pool_stats()
+        (
+            snapshot.db_connect_times,
+            snapshot.db_connections_opened,
+            snapshot.db_connections_closed,
+        ) = db.flush_stats()
+        snapshot.rec_cache_stats = recommendation.TTL_CACHE.flush_stats()
+        snapshot.rec_shared_cache_errors = recommendation.SHARED_CACHE.flush_errors()
+        return snapshot
+
+    def merge(self, other: "MetricSnapshot", later: bool = False) -> None:
+        """
+        add other's metrics to this snapshot's. with later, other was taken after this snapshot in the same process,
+        so its gauges (e.g. cache size) replace this snapshot's rather than add to them.
+        """
+        for metric_name, counter in other.counters.items():
+            merged = self.counters.setdefault(metric_name, {})
+            for site, total in counter.items():
+                merged[site] = merged.get(site, 0) + total
+        for request_key, total in other.requests.items():
+            self.requests[request_key] = self.requests.get(request_key, 0) + total
+
+        for key, histogram in other.latencies.items():
+            self.latencies.setdefault(key, LatencyHistogram()).merge(histogram)
+        for stage_key, histogram in other.stage_latencies.items():
+            self.stage_latencies.setdefault(stage_key, LatencyHistogram()).merge(histogram)
+
+        # each worker has its own executor, so report the most saturated one
+        self.db_max_queue_depth = max(self.db_max_queue_depth, other.db_max_queue_depth)
+        self.db_wait_times.merge(other.db_wait_times)
+        self.db_connect_times.merge(other.db_connect_times)
+        self.db_connections_opened += other.db_connections_opened
+        self.db_connections_closed += other.db_connections_closed
+
+        if later:
+            # a site missing from other has nothing cached anymore
+            for stats in self.rec_cache_stats.values():
+                stats["bytes"] = stats["entries"] = 0
+            self.db_pool_connections = {}
+        # each worker has its own pool, so connections add up to the task's total
+        for state, connections in other.db_pool_connections.items():
+            self.db_pool_connections[state] = self.db_pool_connections.get(state, 0) + connections
+        # each worker has its own cache, so sizes add up to the task's total
+        for site, stats in other.rec_cache_stats.items():
+            merged = self.rec_cache_stats.setdefault(site, {})
+            for stat, value in stats.items():
+                merged[stat] = merged.get(stat, 0) + value
+
+        self.rec_shared_cache_errors += other.rec_shared_cache_errors
+
+    def take_gauges(self) -> "MetricSnapshot":
+        """
+        move this snapshot's gauges (pool connections, cache sizes) into a snapshot of their own, leaving the rest
+        """
+        gauges = MetricSnapshot()
+        gauges.db_pool_connections, self.db_pool_connections = self.db_pool_connections, {}
+        for site, stats in self.rec_cache_stats.items():
+            gauges.rec_cache_stats[site] = {"bytes": stats["bytes"], "entries": stats["entries"], "evictions": 0}
+            stats["bytes"] = stats["entries"] = 0
+        return gauges
+
+    def rec_cache_hit_ratios(self) -> Dict[str, float]:
+        hits = self.counters.get("total_rec_cache_hits", {})
+        stale_hits = self.counters.get("total_rec_cache_stale_hits", {})
+        misses = self.counters.get("total_rec_cache_misses", {})
+        ratios = {}
+        for site in set(hits) | set(stale_hits) | set(misses):
+            served = hits.get(site, 0) + stale_hits.get(site, 0)
+            total = served + misses.get(site, 0)
+            if total:
+                ratios[site] = served / total * 100
+        return ratios
+
+    def publish(self) -> None:
+        for metric_name, counter in self.counters.items():
+            write_counter_metrics(counter, metric_name)
+
+        for (handler, status_code), total in self.requests.items():
+            write_metric("total_requests", total, tags={"handler": handler, "status_code": status_code})
+
+        for (handler, site), histogram in self.latencies.items():
+            tags = {"handler": handler, "site": site}
+            write_histogram_metrics("aggregate_latency", histogram, tags=tags, unit=Unit.MILLISECONDS)
+
+        for (handler, site, stage), histogram in self.stage_latencies.items():
+            tags = {"handler": handler, "site": site, "stage": stage}
+            write_histogram_metrics("stage_latency", histogram, tags=tags, unit=Unit.MILLISECONDS)
+
+        write_metric("db_executor_max_queue_depth", self.db_max_queue_depth, unit=Unit.COUNT)
+        write_histogram_metrics("db_executor_wait_time", self.db_wait_times, unit=Unit.MILLISECONDS)
+        for state, connections in self.db_pool_connections.items():
+            write_metric("db_pool_connections", connections, unit=Unit.COUNT, tags={"state": state})
+        write_histogram_metrics("db_pool_connect_time", self.db_connect_times, unit=Unit.MILLISECONDS)
+        write_metric("db_pool_connections_opened", self.db_connections_opened, unit=Unit.COUNT)
+        write_metric("db_pool_connections_closed", self.db_connections_closed, unit=Unit.COUNT)
+
+        for site, stats in self.rec_cache_stats.items():
+            tags = {"site": site}
+            write_metric("rec_cache_bytes", stats["bytes"], unit=Unit.BYTES, tags=tags)
+            write_metric("rec_cache_entries", stats["entries"], unit=Unit.COUNT, tags=tags)
+            write_metric("rec_cache_evictions", stats["evictions"], unit=Unit.COUNT, tags=tags)
+
+        for site, ratio in self.rec_cache_hit_ratios().items():
+            write_metric("rec_cache_hit_ratio", ratio, unit=Unit.PERCENT, tags={"site": site})
+
+        if recommendation.SHARED_CACHE.client is not None:
+            write_metric("rec_shared_cache_errors", self.rec_shared_cache_errors, unit=Unit.COUNT)
+
+    def to_prometheus(self, live_gauges: bool = True) -> str:
+        """
+        the snapshot in the prometheus text format, plus this process' live db pool and executor gauges. without
+        live_gauges, e.g. for totals merged across workers, pool connections come from the snapshot instead
+        and the executor's queue depth is left out.
+        """
+        lines: List[str] = []
+
+        def write(name: str, metric_type: str, samples: Iterable[Tuple[Mapping[str, Any], float]]) -> None:
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+
+        def write_summary(name: str, histograms: Mapping[Any, LatencyHistogram], label_names: List[str]) -> None:
+            samples: List[Tuple[Mapping[str, Any], float]] = []
+            for key, histogram in histograms.items():
+                labels = dict(zip(label_names, key))
+                for quantile in PROMETHEUS_QUANTILES:
+                    samples.append(({**labels, "quantile": quantile}, histogram.percentile(quantile * 100)))
+            write(name, "summary", samples)
+            for key, histogram in histograms.items():
+                formatted_labels = format_labels(dict(zip(label_names, key)))
+                lines.append(f"{name}_sum{formatted_labels} {histogram.sum}")
+                lines.append(f"{name}_count{formatted_labels} {histogram.count}")
+
+        write("total_requests", "counter", [({"handler": h, "status_code": c}, n) for (h, c), n in self.requests.items()])
+        for metric_name, counter in self.counters.items():
+            write(metric_name, "counter", [({"site": site}, total) for site, total in counter.items()])
+
+        write_summary("aggregate_latency_ms", self.latencies, ["handler", "site"])
+        write_summary("stage_latency_ms", self.stage_latencies, ["handler", "site", "stage"])
+
+        for stat, metric_type in (("bytes", "gauge"), ("entries", "gauge"), ("evictions", "counter")):
+            samples = [({"site": site}, stats[stat]) for site, stats in self.rec_cache_stats.items()]
+            write(f"rec_cache_{stat}", metric_type, samples)
+        write("rec_shared_cache_errors", "counter", [({}, self.rec_shared_cache_errors)])
+
+        if live_gauges:
+            write("db_executor_queue_depth", "gauge", [({}, DB_EXECUTOR.queue_depth)])
+        write("db_executor_max_queue_depth", "gauge", [({}, self.db_max_queue_depth)])
+        write_summary("db_executor_wait_time_ms", {(): self.db_wait_times}, [])
+        pool_connections = pool_stats() if live_gauges else self.db_pool_connections
+        write("db_pool_connections", "gauge", [({"state": state}, n) for state, n in pool_connections.items()])
+        write_summary("db_pool_connect_time_ms", {(): self.db_connect_times}, [])
+        write("db_pool_connections_opened", "counter", [({}, self.db_connections_opened)])
+        write("db_pool_connections_closed", "counter", [({}, self.db_connections_closed)])
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Mapping[str, Any]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels.items()
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class MetricRegistry:
+    """
+    this process' metrics, collected for both outputs: what's pending for the next cloudwatch publish,
+    and running totals since startup for /metrics. with several workers, each saves its totals to shared_dir,
+    so whichever worker answers a scrape serves the whole task's totals and the counters don't jump between workers.
+    """
+
+    def __init__(self):
+        self.pending = MetricSnapshot()
+        self.totals = MetricSnapshot()
+        self.shared_dir: Optional[str] = None
+        self.worker_id = 0
+
+    def share_totals(self, shared_dir: str, worker_id: int) -> None:
+        self.shared_dir = shared_dir
+        self.worker_id = worker_id
+
+    def collect(self) -> None:
+        snapshot = MetricSnapshot.collect()
+        self.pending.merge(snapshot, later=True)
+        self.totals.merge(snapshot, later=True)
+
+    def take_pending(self) -> MetricSnapshot:
+        self.collect()
+        pending = self.pending
+        self.pending = MetricSnapshot()
+        return pending
+
+    def save_totals(self) -> None:
+        """
+        collect, then save this worker's totals for the other workers to serve
+        """
+        self.collect()
+        if self.shared_dir is None:
+            return
+        path = os.path.join(self.shared_dir, f"worker-{self.worker_id}.pickle")
+        with open(f"{path}.tmp", "wb") as totals_file:
+            pickle.dump(self.totals, totals_file)
+        os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def task_totals(shared_dir: str) -> MetricSnapshot:
+        """
+        every worker's totals as of its last save, merged
+        """
+        merged = MetricSnapshot()
+        for name in sorted(os.listdir(shared_dir)):
+            if not name.endswith(".pickle"):
+                continue
+            try:
+                with open(os.path.join(shared_dir, name), "rb") as totals_file:
+                    merged.merge(pickle.load(totals_file))
+            except (OSError, EOFError, pickle.UnpicklingError):
+                logging.warning(f"Couldn't read the metric totals in {name}")
+        return merged
+
+    def render(self) -> str:
+        if self.shared_dir is None:
+            self.collect()
+            return self.totals.to_prometheus()
+        self.save_totals()
+        return self.task_totals(self.shared_dir).to_prometheus(live_gauges=False)
+
+
+REGISTRY = MetricRegistry()
+
+
+class WorkerMetricAggregator:
+    """
+    in multi-worker mode, workers send their snapshots to the lead worker,
+    which merges them with its own so each interval is published once for the whole task.
+    the queue has to be created before forking so every worker shares it.
+    """
+
+    def __init__(self):
+        self._queue: multiprocessing.Queue = multiprocessing.Queue()
+        self.is_leader = False
+        self.worker_id = 0
+        # on the leader, the latest gauges of each other worker, since a flush can drain none or several of its snapshots
+        self._gauges: Dict[int, MetricSnapshot] = {}
+
+    def send(self, snapshot: MetricSnapshot) -> None:
+        self._queue.put((self.worker_id, snapshot))
+
+    def drain(self) -> List[Tuple[int, MetricSnapshot]]:
+        snapshots = []
+        while True:
+            try:
+                snapshots.append(self._queue.get_nowait())
+            except queue.Empty:
+                return snapshots
+
+    def merge_into(self, snapshot: MetricSnapshot) -> None:
+        """
+        add the other workers' snapshots to the leader's: their counters and latencies add up,
+        while only each worker's latest gauges count
+        """
+        # in the order they were sent, so the last snapshot of each worker has its latest gauges
+        for worker_id, worker_snapshot in self.drain():
+            self._gauges[worker_id] = worker_snapshot.take_gauges()
+            snapshot.merge(worker_snapshot)
+        for gauges in self._gauges.values():
+            snapshot.merge(gauges)
+
+
 def write_counter_metrics(counter: Dict[str, int], metric_name: str) -> None:
     """
     each counter includes a total for each site
@@ -36,43 +388,112 @@ def write_counter_metrics(counter: Dict[str, int], metric_name: str) -> None:
     for site, total in counter.items():
         tags = {"site": site}
         write_metric(metric_name, total, unit=Unit.COUNT, tags=tags)
-        # reset counter
-        counter[site] = 0
 
 
-async def empty_metric_buffers():
+def flush_metrics(aggregator: Optional[WorkerMetricAggregator] = None) -> None:
+    snapshot = REGISTRY.take_pending()
+    if aggregator is None:
+        snapshot.publish()
+    elif aggregator.is_leader:
+        # other workers' snapshots arrive on their own schedule, so they are published up to one interval late
+        aggregator.merge_into(snapshot)
+        snapshot.publish()
+    else:
+        aggregator.send(snapshot)
+
+
+async def empty_metric_buffers(aggregator: Optional[WorkerMetricAggregator] = None):
     INTERVAL_MIN = 1
     while True:
         await asyncio.sleep(INTERVAL_MIN * 60)
+        flush_metrics(aggregator)
 
-        counters = [
-            (recommendation.DEFAULT_REC_COUNTER, "total_default_recs_served"),
-            (recommendation.DB_HIT_COUNTER, "total_rec_db_hits"),
-            (recommendation.TOTAL_HANDLED, "total_rec_requests"),
-        ]
 
-        for counter, metric_name in counters:
-            write_counter_metrics(counter, metric_name)
+async def share_metric_totals():
+    """
+    keep this worker's totals fresh for scrapes answered by the other workers
+    """
+    while True:
+        await asyncio.sleep(METRICS_SHARE_SEC)
+        try:
+            REGISTRY.save_totals()
+        except Exception:
+            logging.exception("Failed to save metric totals")
+
+
+async def refresh_rec_index():
+    while True:
+        try:
+            await REC_INDEX.refresh()
+        except Exception:
+            logging.exception("Failed to refresh rec index")
+        await asyncio.sleep(REC_INDEX_REFRESH_SEC)
 
-        for (handler, site), latency_buffer in base.LATENCY_BUFFERS.items():
-            latencies = latency_buffer.flush()
-            if latencies:
-                tags = {"handler": handler, "site": site}
-                write_aggregate_metrics("aggregate_latency", latencies, tags=tags, unit=Unit.MILLISECONDS)
+
+async def refresh_current_models():
+    while True:
+        try:
+            await CURRENT_MODELS.refresh()
+        except Exception:
+            logging.exception("Failed to refresh current models")
+        await asyncio.sleep(CURRENT_MODELS_REFRESH_SEC)
+
+
+async def maintain_db_pool():
+    """
+    pre-open connections at startup, then periodically drop broken or stale idle connections and top the pool back up,
+    so requests don't pay for either
+    """
+    while True:
+        try:
+            closed = await DB_EXECUTOR.run(db.validate_idle)
+            opened = await DB_EXECUTOR.run(db.warm_up, DB_POOL_WARM_CONNECTIONS)
+            if closed or opened:
+                logging.debug(f"db pool: closed {closed} idle connection(s), opened {opened}")
+        except Exception:
+            logging.exception("Failed to maintain db pool")
+        await asyncio.sleep(DB_POOL_VALIDATE_SEC)
+
+
+def start_server(port: int, workers: int) -> None:
+    aggregator = None
+    if workers > 1:
+        aggregator = WorkerMetricAggregator()
+        # the parent process stays behind to restart workers that die
+        metrics_dir = tempfile.mkdtemp(prefix="article-rec-api-metrics-")
+        task_id = tornado.process.fork_processes(workers)
+        aggregator.is_leader = task_id == 0
+        aggregator.worker_id = task_id
+        REGISTRY.share_totals(metrics_dir, task_id)
+
+    # with several workers, each binds its own socket and SO_REUSEPORT lets the kernel balance connections
+    sockets = tornado.netutil.bind_sockets(port, reuse_port=workers > 1)
+    http_server = tornado.httpserver.HTTPServer(request_callback=Application(), xheaders=True)
+    http_server.add_sockets(sockets)
+    io_loop = tornado.ioloop.IOLoop.current()
+    io_loop.add_callback(empty_metric_buffers, aggregator)
+    io_loop.add_callback(METRIC_EMITTER.run)
+    io_loop.add_callback(maintain_db_pool)
+    io_loop.add_callback(refresh_current_models)
+    if workers > 1:
+        io_loop.add_callback(share_metric_totals)
+    if config.get("REC_INDEX_ENABLED"):
+        io_loop.add_callback(refresh_rec_index)
+    io_loop.start()
 
 
 if __name__ == "__main__":
+    workers = config.get("WORKERS")
     if config.get("DEBUG") is True:
+        if workers > 1:
+            logging.warning("autoreload can't run with multiple workers, starting a single worker")
+            workers = 1
         tornado.autoreload.start()
 
     logging_level = logging.getLevelName(config.get("LOG_LEVEL"))
     logging.getLogger().setLevel(logging_level)
 
     port = config.get("PORT")
-    logging.info(f"service is listening on port {port}")
+    logging.info(f"service is listening on port {port} with {workers} worker(s)")
 
-    http_server = tornado.httpserver.HTTPServer(request_callback=Application(), xheaders=True)
-    http_server.listen(port)
-    io_loop = tornado.ioloop.IOLoop.current()
-    io_loop.add_callback(empty_metric_buffers)
-    io_loop.start()
+    start_server(port, workers)
@@ -0,0 +1,217 @@
+"""
+load test of /recs, /models and /models/{id}/articles against a synthetic dataset (see benchmarks.dataset).
+the app runs in this process on a local sqlite database, and each scenario is driven through HTTP at a fixed
+concurrency. reports throughput, latency percentiles, db queries per request and peak RSS, and saves them as JSON
+so runs can be compared across commits.
+
+usage: STAGE=local python -m benchmarks.api_load [--compare benchmark-results/api-load-<commit>.json]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+import tornado.httpserver
+import tornado.testing
+from peewee import SqliteDatabase
+from tornado.httpclient import AsyncHTTPClient
+
+from app import APP_SETTINGS, Application
+from benchmarks.dataset import (
+    Scale,
+    add_scale_arguments,
+    ensure_dataset,
+    open_database,
+    scale_from_args,
+)
+from db.current_models import CURRENT_MODELS
+from db.mappings.model import Model, Status, Type
+from db.mappings.recommendation import Rec
+from handlers.recommendation import TTL_CACHE
+from lib.histogram import LatencyHistogram
+
+RESULTS_DIR = "benchmark-results"
+PERCENTILES = [50, 95, 99]
+
+
+class CountingSqliteDatabase(SqliteDatabase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queries = 0
+        self._queries_lock = threading.Lock()
+
+    def execute_sql(self, *args, **kwargs):
+        with self._queries_lock:
+            self.queries += 1
+        return super().execute_sql(*args, **kwargs)
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_version() -> str:
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def make_scenarios(rng: random.Random) -> Dict[str, Callable[[], str]]:
+    """
+    scenario name -> a function returning the path of its next request, picked from the dataset at random
+    """
+    current_article_models = list(
+        Model.select(Model.id, Model.site)
+        .where((Model.type == Type.ARTICLE.value) & (Model.status == Status.CURRENT.value))
+        .tuples()
+    )
+    sources = {
+        site: [row[0] for row in Rec.select(Rec.source_entity_id).where(Rec.model == model_id).distinct().tuples()]
+        for model_id, site in current_article_models
+    }
+    sites = sorted(sources)
+    model_ids = [model_id for (model_id,) in Model.select(Model.id).tuples()]
+
+    def recs() -> str:
+        site = rng.choice(sites)
+        return f"/recs?site={site}&source_entity_id={rng.choice(sources[site])}&model_type={Type.ARTICLE.value}"
+
+    def models() -> str:
+        return f"/models?site={rng.choice(sites)}&status={Status.CURRENT.value}"
+
+    def model_articles() -> str:
+        return f"/models/{rng.choice(model_ids)}/articles"
+
+    return {"recs": recs, "models": models, "model_articles": model_articles}
+
+
+async def drive(base_url: str, paths: List[str], concurrency: int) -> dict:
+    client = AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    latencies = LatencyHistogram()
+    errors = 0
+    pending = iter(paths)
+
+    async def worker() -> None:
+        nonlocal errors
+        for path in pending:
+            started_at = time.perf_counter()
+            response = await client.fetch(base_url + path, raise_error=False, request_timeout=60)
+            latencies.record((time.perf_counter() - started_at) * 1000)
+            if response.code >= 400:
+                errors += 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    duration_sec = time.perf_counter() - started_at
+    client.close()
+    return {
+        "requests": len(paths),
+        "errors": errors,
+        "duration_sec": round(duration_sec, 3),
+        "throughput_rps": round(len(paths) / duration_sec, 1),
+        "latency_ms": {
+            **{f"p{p}": round(latencies.percentile(p), 2) for p in PERCENTILES},
+            "mean": round(latencies.sum / latencies.count, 2),
+            "max": round(latencies.max, 2),
+        },
+    }
+
+
+async def run(
+    database: CountingSqliteDatabase, scale: Scale, requests: int, warmup_requests: int, concurrency: int, seed: int
+) -> dict:
+    # debug mode turns on autoreload and other dev-only overhead
+    APP_SETTINGS["debug"] = False
+    server = tornado.httpserver.HTTPServer(Application())
+    sock, port = tornado.testing.bind_unused_port()
+    server.add_sockets([sock])
+    base_url = f"http://127.0.0.1:{port}"
+    await CURRENT_MODELS.refresh()
+
+    rng = random.Random(seed)
+    results = {}
+    for name, next_path in make_scenarios(rng).items():
+        TTL_CACHE.clear()
+        await drive(base_url, [next_path() for _ in range(warmup_requests)], concurrency)
+        paths = [next_path() for _ in range(requests)]
+        queries_before = database.queries
+        result = await drive(base_url, paths, concurrency)
+        result["queries_per_request"] = round((database.queries - queries_before) / requests, 2)
+        result["peak_rss_mb"] = round(peak_rss_mb(), 1)
+        results[name] = result
+        latency = result["latency_ms"]
+        print(
+            f"{name:>15} {result['throughput_rps']:>9} req/s  p50 {latency['p50']:>8} ms  p95 {latency['p95']:>8} ms"
+            f"  p99 {latency['p99']:>8} ms  {result['queries_per_request']:>5} queries/req"
+            f"  {result['peak_rss_mb']:>7} MB  {result['errors']} errors"
+        )
+    server.stop()
+
+    return {
+        "version": git_version(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "scale": scale._asdict(),
+        "concurrency": concurrency,
+        "scenarios": results,
+    }
+
+
+def compare(report: dict, baseline_path: str) -> None:
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline["scale"] != report["scale"] or baseline["concurrency"] != report["concurrency"]:
+        print("warning: the baseline ran at a different scale or concurrency")
+    print(f"\nvs. {baseline['version']}")
+    for name, result in report["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if before is None:
+            continue
+        throughput = result["throughput_rps"] / before["throughput_rps"] - 1
+        p99 = result["latency_ms"]["p99"] / before["latency_ms"]["p99"] - 1
+        queries = result["queries_per_request"] - before["queries_per_request"]
+        print(f"{name:>15} throughput {throughput:+.1%}  p99 {p99:+.1%}  queries/req {queries:+.2f}")
+
+
+def main(args: argparse.Namespace) -> None:
+    scale = scale_from_args(args)
+    ensure_dataset(args.db_path, scale)
+    database = open_database(args.db_path, CountingSqliteDatabase)
+    report = asyncio.run(run(database, scale, args.requests, args.warmup_requests, args.concurrency, args.request_seed))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"api-load-{report['version']}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"saved to {output}")
+
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-path", default="/tmp/article-rec-bench.db")
+    add_scale_arguments(parser)
+    parser.add_argument("--requests", type=int, default=2000, help="per scenario")
+    parser.add_argument("--warmup-requests", type=int, default=200, help="per scenario, not measured")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--request-seed", type=int, default=0)
+    parser.add_argument("--output", help=f"defaults to {RESULTS_DIR}/api-load-<git version>.json")
+    parser.add_argument("--compare", help="a previous run's JSON to compare with")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("tornado.access").setLevel(logging.ERROR)
+    main(args)
@@ -0,0 +1,174 @@
+"""
+generate a synthetic dataset at a configurable scale into a local sqlite database, for benchmarks.
+every site gets models_per_site models (a current article, popularity and user model, the rest stale),
+articles_per_site articles, and each non-popularity model recs_per_source recs for sources_per_model source articles,
+so the recommendation table holds about sites * models_per_site * sources_per_model * recs_per_source rows.
+
+usage: STAGE=local python -m benchmarks.dataset --db-path /tmp/article-rec-bench.db
+"""
+import argparse
+import json
+import os
+import random
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence
+
+from peewee import SqliteDatabase
+
+from db.mappings.article import Article
+from db.mappings.base import db_proxy
+from db.mappings.model import Model, Status, Type
+from db.mappings.recommendation import Rec
+
+MAPPINGS = (Model, Article, Rec)
+INSERT_BATCH_SIZE = 10_000
+# first the current models of each type, then stale ones
+MODEL_TYPES = [Type.ARTICLE.value, Type.POPULARITY.value, Type.USER.value]
+
+
+class Scale(NamedTuple):
+    sites: int = 3
+    models_per_site: int = 4
+    articles_per_site: int = 20_000
+    sources_per_model: int = 5_000
+    recs_per_source: int = 40
+    seed: int = 0
+
+    @property
+    def rec_rows(self) -> int:
+        recs_per_source = min(self.recs_per_source, self.articles_per_site)
+        sources = min(self.sources_per_model, self.articles_per_site)
+        model_types = [MODEL_TYPES[n % len(MODEL_TYPES)] for n in range(self.models_per_site)]
+        popularity_models = model_types.count(Type.POPULARITY.value)
+        return self.sites * recs_per_source * (popularity_models + (len(model_types) - popularity_models) * sources)
+
+
+def add_scale_arguments(parser: argparse.ArgumentParser) -> None:
+    for name, default in Scale._field_defaults.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=int, default=default)
+
+
+def scale_from_args(args: argparse.Namespace) -> Scale:
+    return Scale(**{name: getattr(args, name) for name in Scale._fields})
+
+
+def metadata_path(db_path: str) -> str:
+    return f"{db_path}.json"
+
+
+def existing_scale(db_path: str) -> Optional[Scale]:
+    """
+    the scale of the dataset already generated at db_path, if any
+    """
+    try:
+        with open(metadata_path(db_path)) as metadata_file:
+            return Scale(**json.load(metadata_file))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+def open_database(db_path: str, database_class: Callable[..., SqliteDatabase] = SqliteDatabase) -> SqliteDatabase:
+    """
+    point the mappings at the sqlite database at db_path
+    """
+    database = database_class(db_path, pragmas={"journal_mode": "wal", "cache_size": -64 * 1024})
+    db_proxy.initialize(database)
+    return database
+
+
+def executemany(database: SqliteDatabase, table: str, columns: List[str], rows: Sequence[tuple]) -> None:
+    # straight to sqlite: going through the mappings converts every value in python, which dominates at this scale
+    sql = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    for start in range(0, len(rows), INSERT_BATCH_SIZE):
+        database.connection().executemany(sql, rows[start : start + INSERT_BATCH_SIZE])
+
+
+def generate(db_path: str, scale: Scale) -> None:
+    for path in (metadata_path(db_path), db_path, f"{db_path}-wal", f"{db_path}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    rng = random.Random(scale.seed)
+    database = open_database(db_path)
+    database.create_tables(MAPPINGS)
+    now = datetime.now(timezone.utc)
+    timestamp = now.isoformat()
+    started_at = time.perf_counter()
+
+    with database.atomic():
+        for site_number in range(scale.sites):
+            site = f"site-{site_number}"
+            model_rows = []
+            for model_number in range(scale.models_per_site):
+                status = Status.CURRENT.value if model_number < len(MODEL_TYPES) else Status.STALE.value
+                model_type = MODEL_TYPES[model_number % len(MODEL_TYPES)]
+                model_rows.append((timestamp, timestamp, model_type, status, site))
+            executemany(database, "model", ["created_at", "updated_at", "type", "status", "site"], model_rows)
+            models = list(Model.select(Model.id, Model.type).where(Model.site == site).tuples())
+
+            article_rows = []
+            for article_number in range(scale.articles_per_site):
+                published_at = now - timedelta(minutes=rng.randrange(365 * 24 * 60))
+                article_rows.append(
+                    (
+                        timestamp,
+                        timestamp,
+                        str(article_number),
+                        f"An article headline that is about as long as a real one, number {article_number}",
+                        f"/news/{published_at:%Y/%m/%d}/an-article-headline-{article_number}",
+                        published_at.strftime("%Y-%m-%d %H:%M:%S"),
+                        site,
+                    )
+                )
+            executemany(
+                database,
+                "article",
+                ["created_at", "updated_at", "external_id", "title", "path", "published_at", "site"],
+                article_rows,
+            )
+            article_ids: Dict[str, int] = dict(
+                Article.select(Article.external_id, Article.id).where(Article.site == site).tuples()
+            )
+            external_ids = list(article_ids)
+
+            for model_id, model_type in models:
+                # popularity recs are the same for every source, so there's just one list of them
+                sources = ["popular"] if model_type == Type.POPULARITY.value else None
+                if sources is None:
+                    sources = rng.sample(external_ids, min(scale.sources_per_model, len(external_ids)))
+                rec_rows = []
+                for source_entity_id in sources:
+                    for external_id in rng.sample(external_ids, min(scale.recs_per_source, len(external_ids))):
+                        score = round(rng.random(), 6)
+                        rec_rows.append(
+                            (timestamp, timestamp, source_entity_id, model_id, article_ids[external_id], score)
+                        )
+                executemany(
+                    database,
+                    "recommendation",
+                    ["created_at", "updated_at", "source_entity_id", "model_id", "recommended_article_id", "score"],
+                    rec_rows,
+                )
+
+    database.execute_sql("ANALYZE")
+    database.close()
+    with open(metadata_path(db_path), "w") as metadata_file:
+        json.dump(scale._asdict(), metadata_file)
+    print(f"generated {scale.rec_rows:,} recs in {time.perf_counter() - started_at:.1f}s: {db_path}")
+
+
+def ensure_dataset(db_path: str, scale: Scale) -> None:
+    """
+    generate the dataset unless db_path already holds one at this scale
+    """
+    if existing_scale(db_path) != scale:
+        generate(db_path, scale)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-path", default="/tmp/article-rec-bench.db")
+    add_scale_arguments(parser)
+    args = parser.parse_args()
+
+    generate(args.db_path, scale_from_args(args))
@@ -0,0 +1,54 @@
+"""
+size of a /recs response body raw vs. compressed, and the CPU time per cache hit of compressing it
+on every response vs. reusing the body compressed once per cache entry.
+
+usage: STAGE=local python -m benchmarks.rec_compression
+"""
+import argparse
+from typing import List
+
+from benchmarks.rec_response import SIZES, cpu_time_per_call_us, make_results
+from handlers.base import EncodedResults
+from lib.compression import ENCODINGS, compress
+
+
+def run(iterations: int) -> List[dict]:
+    rows = []
+    for size in SIZES:
+        results = make_results(size)
+        encoded_results = EncodedResults(results)
+        raw_body = encoded_results.response_body(results)
+        for encoding in ENCODINGS:
+            per_response = cpu_time_per_call_us(lambda: compress(raw_body, encoding), iterations)
+            encoded_results.compressed_response_body(results, encoding)
+            once_per_entry = cpu_time_per_call_us(
+                lambda: encoded_results.compressed_response_body(results, encoding), iterations
+            )
+            rows.append(
+                {
+                    "size": size,
+                    "encoding": encoding,
+                    "raw_bytes": len(raw_body),
+                    "compressed_bytes": len(compress(raw_body, encoding)),
+                    "per_response_us": round(per_response, 1),
+                    "once_per_entry_us": round(once_per_entry, 1),
+                }
+            )
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    print(
+        f"{'size':>6} {'encoding':>8} {'raw (B)':>9} {'compressed (B)':>15} {'ratio':>6} "
+        f"{'per response (us)':>18} {'once per entry (us)':>20}"
+    )
+    for row in run(args.iterations):
+        ratio = row["raw_bytes"] / row["compressed_bytes"]
+        print(
+            f"{row['size']:>6} {row['encoding']:>8} {row['raw_bytes']:>9} {row['compressed_bytes']:>15} "
+            f"{ratio:>5.1f}x {row['per_response_us']:>18} {row['once_per_entry_us']:>20}"
+        )
@@ -0,0 +1,77 @@
+"""
+CPU time spent encoding a /recs response on a cache hit: json.dumps of the result dicts (before)
+vs. joining the pre-encoded JSON of each result (after).
+
+usage: STAGE=local python -m benchmarks.rec_response
+"""
+import argparse
+import json
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+from random import random
+from typing import Callable, List
+
+from handlers.base import EncodedResults, default_serializer
+
+SIZES = [10, 100, 499]
+
+
+def make_results(count: int) -> List[dict]:
+    now = datetime.now(timezone.utc).isoformat()
+    model = {"id": 1, "created_at": now, "updated_at": now, "type": "article", "status": "current", "site": "site"}
+    return [
+        {
+            "id": i,
+            "created_at": now,
+            "updated_at": now,
+            "source_entity_id": "12345",
+            "model": dict(model),
+            "recommended_article": {
+                "id": i,
+                "created_at": now,
+                "updated_at": now,
+                "external_id": str(10_000 + i),
+                "title": f"An article headline that is about as long as a real one, number {i}",
+                "path": f"/news/2022/01/01/an-article-headline-that-is-about-as-long-as-a-real-one-{i}",
+                "published_at": now,
+                "site": "site",
+            },
+            "score": Decimal(f"{random():.6f}"),
+        }
+        for i in range(count)
+    ]
+
+
+def cpu_time_per_call_us(f: Callable[[], object], iterations: int) -> float:
+    start = time.process_time()
+    for _ in range(iterations):
+        f()
+    return (time.process_time() - start) / iterations * 1e6
+
+
+def run(iterations: int) -> List[dict]:
+    rows = []
+    for size in SIZES:
+        results = make_results(size)
+        encoded_results = EncodedResults(results)
+
+        before = cpu_time_per_call_us(lambda: json.dumps({"results": results}, default=default_serializer), iterations)
+        after = cpu_time_per_call_us(lambda: encoded_results.response_body(results), iterations)
+        assert (
+            encoded_results.response_body(results)
+            == json.dumps({"results": results}, default=default_serializer).encode()
+        )
+        rows.append({"size": size, "json_dumps_us": round(before, 1), "pre_encoded_us": round(after, 1)})
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'size':>6} {'json.dumps (us)':>16} {'pre-encoded (us)':>17} {'speedup':>8}")
+    for row in run(args.iterations):
+        speedup = row["json_dumps_us"] / row["pre_encoded_us"]
+        print(f"{row['size']:>6} {row['json_dumps_us']:>16} {row['pre_encoded_us']:>17} {speedup:>7.1f}x")
@@ -0,0 +1,68 @@
+"""
+cold start: wall time from launching the server process to its first served request.
+any response counts, so the db doesn't have to be reachable. each run is a fresh process;
+set CONFIG_CACHE_PATH to compare with and without the on-disk config cache.
+
+usage: STAGE=local python -m benchmarks.startup
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from typing import List
+
+import tornado.testing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def unused_port() -> int:
+    sock, port = tornado.testing.bind_unused_port()
+    sock.close()
+    return port
+
+
+def time_to_first_request_sec(timeout_sec: float) -> float:
+    port = unused_port()
+    started_at = time.perf_counter()
+    # start_server rather than app.py, to pick the port and skip autoreload
+    process = subprocess.Popen(
+        [sys.executable, "-c", f"import app; app.start_server({port}, 1)"],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - started_at < timeout_sec:
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1)
+            except urllib.error.HTTPError:
+                pass  # served, just not healthy
+            except OSError:
+                time.sleep(0.005)
+                continue
+            return time.perf_counter() - started_at
+        raise TimeoutError(f"server didn't answer within {timeout_sec}s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main(runs: int, timeout_sec: float) -> None:
+    times: List[float] = [time_to_first_request_sec(timeout_sec) * 1000 for _ in range(runs)]
+    print(f"time to first served request over {runs} runs (ms)")
+    print(f"{'min':>8} {'median':>8} {'max':>8}")
+    print(f"{min(times):8.0f} {statistics.median(times):8.0f} {max(times):8.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout-sec", type=float, default=30)
+    args = parser.parse_args()
+
+    main(args.runs, args.timeout_sec)
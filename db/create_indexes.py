@@ -0,0 +1,82 @@
+"""
+create the indexes declared on the mappings that the database doesn't have yet, e.g. after adding one to a mapping's
+Meta.indexes. each is built with CREATE INDEX CONCURRENTLY, so reads and writes carry on while it builds.
+an index left invalid by a failed concurrent build is dropped and built again.
+DB_HOST is a read replica, which can't build indexes, so the primary's host is passed explicitly.
+
+usage: STAGE=dev python -m db.create_indexes --host <primary host> [--dry-run]
+"""
+import argparse
+import logging
+from typing import List, Set, Tuple, Type
+
+from peewee import ModelIndex, PostgresqlDatabase
+
+from db.mappings.article import Article
+from db.mappings.base import BaseMapping
+from db.mappings.model import Model
+from db.mappings.recommendation import Rec
+from lib.db import NAME, PASSWORD, PORT, USER
+
+MAPPINGS = (Model, Article, Rec)
+
+# initialized by main with the primary's host
+db = PostgresqlDatabase(None)
+
+
+def index_statements(mapping: Type[BaseMapping]) -> List[Tuple[str, str]]:
+    """
+    (index name, CREATE INDEX CONCURRENTLY IF NOT EXISTS statement) for each index in mapping's Meta.indexes.
+    the ones peewee adds for foreign keys are left out: they're covered by the declared ones or exist under other names.
+    """
+    statements = []
+    for declared in mapping._meta.indexes:
+        if isinstance(declared, ModelIndex):
+            index = declared
+        else:
+            names, unique = declared
+            index = ModelIndex(mapping, [mapping._meta.combined[name] for name in names], unique=unique)
+        sql, _ = db.get_sql_context().sql(index.safe(True)).query()
+        # peewee can't emit CONCURRENTLY itself
+        statements.append((index._name, sql.replace("CREATE INDEX ", "CREATE INDEX CONCURRENTLY ", 1)))
+    return statements
+
+
+def invalid_indexes(cursor) -> Set[str]:
+    cursor.execute(
+        "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace WHERE NOT i.indisvalid AND n.nspname = current_schema()"
+    )
+    return {name for (name,) in cursor.fetchall()}
+
+
+def main(host: str, dry_run: bool) -> None:
+    db.init(NAME, user=USER, password=PASSWORD, host=host, port=PORT)
+    conn = db.connection()
+    # CREATE INDEX CONCURRENTLY can't run inside a transaction
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            invalid = invalid_indexes(cursor)
+            for mapping in MAPPINGS:
+                for name, statement in index_statements(mapping):
+                    statements = [statement]
+                    if name in invalid:
+                        statements.insert(0, f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
+                    for sql in statements:
+                        logging.info(sql)
+                        if not dry_run:
+                            cursor.execute(sql)
+    finally:
+        conn.autocommit = False
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", required=True, help="the primary database's host, not a read replica")
+    parser.add_argument("--dry-run", action="store_true", help="log the statements without running them")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    main(args.host, args.dry_run)
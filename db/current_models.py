@@ -0,0 +1,60 @@
+import logging
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+from db.helpers import retry_rollback
+from db.mappings.model import Model, Status
+from lib.db import DB_EXECUTOR
+
+
+class CurrentModels:
+    """
+    the Status.CURRENT models, serialized, by (site, type), so /recs can filter recs on their model_id and attach
+    the model without joining the model table. it's reloaded in the background on a short interval.
+    """
+
+    def __init__(self):
+        self._by_site_type: Optional[Dict[Tuple[str, str], Dict[int, dict]]] = None
+        self._by_type: Dict[str, Dict[int, dict]] = {}
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._by_site_type is not None
+
+    def clear(self) -> None:
+        self._by_site_type = None
+        self._by_type = {}
+
+    @retry_rollback
+    def load(self) -> Dict[int, dict]:
+        return {model.id: model.to_dict() for model in Model.select().where(Model.status == Status.CURRENT.value)}
+
+    def set(self, models: Dict[int, dict]) -> None:
+        by_site_type: Dict[Tuple[str, str], Dict[int, dict]] = defaultdict(dict)
+        by_type: Dict[str, Dict[int, dict]] = defaultdict(dict)
+        for model_id, model in models.items():
+            by_site_type[(model["site"], model["type"])][model_id] = model
+            by_type[model["type"]][model_id] = model
+        self._by_site_type, self._by_type = dict(by_site_type), dict(by_type)
+
+    async def refresh(self) -> None:
+        models = await DB_EXECUTOR.run(self.load)
+        if self._by_site_type is not None:
+            loaded = {model_id for type_models in self._by_type.values() for model_id in type_models}
+            if set(models) != loaded:
+                logging.info(f"Current models changed: {sorted(loaded)} -> {sorted(models)}")
+        self.set(models)
+
+    def get(self, site: Optional[str], model_type: str) -> Optional[Dict[int, dict]]:
+        """
+        the current models of model_type by id: for site, plus those not tied to a site, or for every site if site
+        is empty. None if the models haven't been loaded yet, and the caller should query them itself.
+        """
+        if self._by_site_type is None:
+            return None
+        if not site:
+            return self._by_type.get(model_type, {})
+        return {**self._by_site_type.get(("", model_type), {}), **self._by_site_type.get((site, model_type), {})}
+
+
+CURRENT_MODELS = CurrentModels()
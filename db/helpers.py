@@ -1,46 +1,67 @@
 import logging
-from typing import List
+from datetime import datetime
+from typing import Generator, Iterable, Optional, Tuple, Type, Union
 
 import psycopg2.errors
-from peewee import Expression, InterfaceError
+from peewee import Expression, InterfaceError, Select
+from playhouse.postgres_ext import PostgresqlExtDatabase, ServerSide
 
 from db.mappings.article import Article
-from db.mappings.base import BaseMapping, tzaware_now
-from lib.config import config
+from db.mappings.base import BaseMapping, db_proxy, tzaware_now
 from lib.db import db
 
-MAX_PAGE_SIZE = config.get("MAX_PAGE_SIZE")
+# rows fetched per round trip when iterating a server-side cursor
+SERVER_SIDE_FETCH_ROWS = 1000
 
 
-def create_resource(mapping_class: BaseMapping, **params) -> int:
+def create_resource(mapping_class: Type[BaseMapping], **params) -> int:
     resource = mapping_class(**params)
     resource.save()
     return resource.id
 
 
-def get_resource(mapping_class: BaseMapping, _id: int) -> dict:
+def get_resource(mapping_class: Type[BaseMapping], _id: int) -> dict:
     instance = mapping_class.get(mapping_class.id == _id)
     return instance.to_dict()
 
 
-def update_resources(mapping_class: BaseMapping, conditions: Expression, **params) -> None:
+def update_resources(mapping_class: Type[BaseMapping], conditions: Expression, **params) -> None:
     params["updated_at"] = tzaware_now()
     q = mapping_class.update(**params).where(conditions)
     q.execute()
 
 
-def get_articles_by_external_ids(site: str, external_ids: List[str]) -> List[dict]:
-    res = (
-        Article.select()
-        .where((Article.site == site))
-        .where(Article.external_id.in_(list(external_ids)))
-        .order_by(Article.published_at.desc())
-        .limit(MAX_PAGE_SIZE)
-    )
-    if res:
-        return [r.to_dict() for r in res]
+def articles_page_query(
+    site: str, external_ids: Union[Iterable[str], Select], size: int, after: Optional[Tuple[Optional[datetime], int]]
+) -> Select:
+    """
+    up to size of the site's articles with external_ids, which can be a subquery selecting them, newest first.
+    after is the (published_at, id) of the previous page's last article; articles without published_at come last.
+    """
+    query = Article.select().where((Article.site == site) & Article.external_id.in_(external_ids))
+    if after is not None:
+        published_at, article_id = after
+        if published_at is None:
+            query = query.where(Article.published_at.is_null() & (Article.id < article_id))
+        else:
+            query = query.where(
+                (Article.published_at < published_at)
+                | ((Article.published_at == published_at) & (Article.id < article_id))
+                | Article.published_at.is_null()
+            )
+    query = query.order_by(Article.published_at.desc(nulls="LAST"), Article.id.desc()).limit(size)
+    return query
+
+
+def iterate_lazily(query: Select) -> Generator[BaseMapping, None, None]:
+    """
+    query's rows one at a time without caching them on the query. on postgres they come from a server-side cursor,
+    since psycopg2 otherwise fetches the whole result set up front.
+    """
+    if isinstance(db_proxy.obj, PostgresqlExtDatabase):
+        yield from ServerSide(query, array_size=SERVER_SIDE_FETCH_ROWS)
     else:
-        return []
+        yield from query.iterator()
 
 
 def retry_rollback(f):
@@ -2,6 +2,7 @@ from peewee import SqliteDatabase
 
 from db.mappings.base import db_proxy
 from lib.config import config
+from lib.db import DB_EXECUTOR, STREAM_EXECUTOR
 from lib.db import db as PooledPostgresDB
 
 if config.get("TEST_DB"):
@@ -10,3 +11,6 @@ else:
     database = PooledPostgresDB
 
 db_proxy.initialize(database)
+# executor work borrows a connection per call from whichever database the mappings use
+DB_EXECUTOR.database = db_proxy
+STREAM_EXECUTOR.database = db_proxy
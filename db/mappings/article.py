@@ -6,6 +6,10 @@ from db.mappings.base import BaseMapping
 class Article(BaseMapping):
     class Meta:
         table_name = "article"
+        indexes = (
+            # articles are looked up by their id on the news site, which is only unique within a site
+            (("site", "external_id"), False),
+        )
 
     external_id = TextField(null=False, default="")
     title = TextField(null=False, default="")
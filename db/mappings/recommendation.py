@@ -1,4 +1,5 @@
 from peewee import DecimalField, ForeignKeyField, TextField
+from playhouse.shortcuts import model_to_dict
 
 from db.mappings.article import Article
 from db.mappings.base import BaseMapping
@@ -8,8 +9,42 @@ from db.mappings.model import Model
 class Rec(BaseMapping):
     class Meta:
         table_name = "recommendation"
+        indexes = (
+            # /recs filters on model and source article and takes the top scores, which a backward scan returns in
+            # order; /models/{id}/articles reads the source articles of a model from it without touching the table
+            (("model", "source_entity_id", "score"), False),
+        )
 
     source_entity_id = TextField(null=False)
     model = ForeignKeyField(Model, null=False)
     recommended_article = ForeignKeyField(Article, null=False)
     score = DecimalField(max_digits=7, decimal_places=6)
+
+    @classmethod
+    def select_with_relations(cls):
+        """
+        select recs along with their model and recommended article in a single joined query,
+        so serializing a rec doesn't lazily load each foreign key with its own query
+        """
+        return (
+            cls.select(cls, Model, Article)
+            .join(Model, on=cls.model)
+            .switch(cls)
+            .join(Article, on=cls.recommended_article)
+        )
+
+    @classmethod
+    def select_with_article(cls):
+        """
+        select_with_relations without the model, for when the caller already has the models serialized
+        """
+        return cls.select(cls, Article).join(Article, on=cls.recommended_article)
+
+    def to_dict_with_model(self, model: dict) -> dict:
+        """
+        to_dict for a rec from select_with_article, given its serialized model
+        """
+        resource = self.format_datetime(model_to_dict(self, exclude=[Rec.model]))
+        resource["model"] = model
+        # in the same order as to_dict
+        return {name: resource[name] for name in self._meta.sorted_field_names}
@@ -0,0 +1,156 @@
+import heapq
+import logging
+from collections import defaultdict
+from decimal import Decimal
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+from db.helpers import retry_rollback
+from db.mappings.model import Model, Status
+from db.mappings.recommendation import Rec
+from lib.db import DB_EXECUTOR
+
+
+class IndexedRec(NamedTuple):
+    id: int
+    created_at: str
+    updated_at: str
+    source_entity_id: str
+    model_id: int
+    article_id: int
+    score: Decimal
+
+
+class SiteRecs:
+    """
+    the current models' recs for one site, keyed by (model id, source_entity_id) and ordered by score desc.
+    each recommended article is serialized once and shared by every rec that points at it.
+    """
+
+    def __init__(self):
+        self.articles: Dict[int, dict] = {}
+        self.recs: Dict[Tuple[int, str], List[IndexedRec]] = defaultdict(list)
+
+
+class RecIndexData:
+    def __init__(self, models: Dict[int, dict]):
+        # current models by id, serialized
+        self.models = models
+        self.model_ids_by_type: Dict[str, List[int]] = defaultdict(list)
+        for model in models.values():
+            self.model_ids_by_type[model["type"]].append(model["id"])
+        self.versions = frozenset((model["id"], model["updated_at"]) for model in models.values())
+        self.sites: Dict[str, SiteRecs] = {}
+
+
+class RecIndex:
+    """
+    in-process copy of the recs for Status.CURRENT models, so /recs can be answered without the database.
+    it is rebuilt in the background whenever the set of current models or their updated_at changes.
+    """
+
+    def __init__(self):
+        self._data: Optional[RecIndexData] = None
+
+    @property
+    def is_loaded(self) -> bool:
+        return self._data is not None
+
+    def clear(self) -> None:
+        self._data = None
+
+    @retry_rollback
+    def current_model_versions(self) -> FrozenSet[Tuple[int, str]]:
+        query = Model.select().where(Model.status == Status.CURRENT.value)
+        return frozenset((model.id, model.to_dict()["updated_at"]) for model in query)
+
+    @retry_rollback
+    def build(self) -> RecIndexData:
+        models = {model.id: model.to_dict() for model in Model.select().where(Model.status == Status.CURRENT.value)}
+        data = RecIndexData(models)
+        if not models:
+            return data
+
+        # one joined query, so the recs and their articles are read from the same snapshot: an inner join leaves
+        # out any rec whose article is missing instead of failing the whole build
+        rec_query = Rec.select_with_article().where(Rec.model.in_(list(models))).order_by(Rec.score.desc())
+        for rec in rec_query.iterator():
+            article_id = rec.recommended_article_id
+            site = rec.recommended_article.site
+            site_recs = data.sites.get(site)
+            if site_recs is None:
+                site_recs = data.sites[site] = SiteRecs()
+            if article_id not in site_recs.articles:
+                site_recs.articles[article_id] = rec.recommended_article.to_dict()
+            indexed = IndexedRec(
+                rec.id,
+                rec.created_at.isoformat(),
+                rec.updated_at.isoformat(),
+                rec.source_entity_id,
+                rec.model_id,
+                article_id,
+                rec.score,
+            )
+            site_recs.recs[(rec.model_id, rec.source_entity_id)].append(indexed)
+
+        return data
+
+    async def refresh(self) -> None:
+        """
+        reload the index if a model was promoted, demoted or updated since it was built
+        """
+        versions = await DB_EXECUTOR.run(self.current_model_versions)
+        if self._data is not None and versions == self._data.versions:
+            return
+        data = await DB_EXECUTOR.run(self.build)
+        self._data = data
+        logging.info(f"Loaded rec index for current models: {sorted(data.models)}")
+
+    def lookup(
+        self,
+        site: str,
+        source_entity_id: Optional[str] = None,
+        model_type: Optional[str] = None,
+        model_id: Optional[str] = None,
+    ) -> Optional[List[dict]]:
+        """
+        returns the serialized recs ordered by score desc, or None if the index can't answer the request
+        (not loaded, no source_entity_id, or a model that isn't current) and it should go to the database
+        """
+        data = self._data
+        if data is None or not source_entity_id:
+            return None
+
+        if model_id:
+            if int(model_id) not in data.models:
+                return None
+            model_ids = [int(model_id)]
+        elif model_type:
+            model_ids = data.model_ids_by_type.get(model_type, [])
+        else:
+            return None
+
+        site_recs = data.sites.get(site)
+        if site_recs is None:
+            return []
+
+        rec_lists = [site_recs.recs.get((_id, source_entity_id), []) for _id in model_ids]
+        if len(rec_lists) == 1:
+            recs = rec_lists[0]
+        else:
+            recs = list(heapq.merge(*rec_lists, key=lambda rec: rec.score, reverse=True))
+
+        return [
+            {
+                "id": rec.id,
+                "created_at": rec.created_at,
+                "updated_at": rec.updated_at,
+                "source_entity_id": rec.source_entity_id,
+                "model": data.models[rec.model_id],
+                "recommended_article": site_recs.articles[rec.article_id],
+                "score": rec.score,
+            }
+            for rec in recs
+        ]
+
+
+REC_INDEX = RecIndex()
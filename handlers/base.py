@@ -1,23 +1,78 @@
+import asyncio
+import base64
+import binascii
 import datetime
+import hashlib
 import json
 import logging
+import threading
 import time
 from collections import defaultdict
+from contextlib import closing, contextmanager
 from decimal import Decimal
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, Type, Union, cast
 
+import tornado.http1connection
+import tornado.iostream
 import tornado.web
+from peewee import Select
 
+from db.helpers import iterate_lazily
+from db.mappings.base import BaseMapping
 from db.mappings.model import Model
+from lib.compression import MIN_COMPRESS_BYTES, compress, negotiate_encoding
 from lib.config import config
+from lib.db import DB_EXECUTOR, STREAM_EXECUTOR
+from lib.histogram import LatencyHistogram
 from lib.metrics import Unit, write_metric
 
 DEFAULT_PAGE_SIZE = config.get("DEFAULT_PAGE_SIZE")
+MAX_PAGE_SIZE = config.get("MAX_PAGE_SIZE")
+# with stream=true, pages are written as they're read from the db, so they can be much larger
+MAX_STREAM_PAGE_SIZE = config.get("MAX_STREAM_PAGE_SIZE")
+# streamed results are flushed in chunks of about this many bytes, and at most this many chunks wait to be written
+STREAM_CHUNK_BYTES = 64 * 1024
+STREAM_BUFFERED_CHUNKS = 4
+# a client that takes longer than this to take a chunk is disconnected, so it can't hold a stream thread indefinitely
+STREAM_WRITE_TIMEOUT_SEC = 10
+# send each request's stage timings back in a Server-Timing header
+SERVER_TIMING_ENABLED = config.get("SERVER_TIMING_ENABLED")
+# compressed bodies kept per EncodedResults
+MAX_COMPRESSED_VARIANTS = 4
 
 
 def unix_time_ms(datetime_instance):
     return int(time.mktime(datetime_instance.timetuple()) * 1e3 + datetime_instance.microsecond / 1e3)
 
 
+def version_etag(*parts) -> str:
+    """
+    strong ETag for a response that is fully determined by parts, e.g. the versions of the data it's built from
+    and the request's filters
+    """
+    return '"' + hashlib.sha1(repr(parts).encode()).hexdigest() + '"'
+
+
+def encode_cursor(*values) -> str:
+    """
+    opaque pagination cursor for the sort key of the last result on a page, e.g. its (published_at, id)
+    """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str, size: int) -> list:
+    """
+    the values passed to encode_cursor. raises HTTPError 400 for anything that isn't a cursor of size values.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, binascii.Error):
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise tornado.web.HTTPError(status_code=400, log_message=f"Invalid input for 'cursor': {cursor}")
+    return values
+
+
 def default_serializer(obj):
     if isinstance(obj, datetime.datetime):
         return int(unix_time_ms(obj) / 1000)  # unix seconds
@@ -26,21 +81,58 @@ def default_serializer(obj):
     raise TypeError(f"couldn't serialize obj: {obj}")
 
 
-class LatencyBuffer:
-    def __init__(self):
-        self._buffer = []
-
-    def push(self, latency):
-        self._buffer.append(latency)
-
-    def flush(self):
-        _buffer = self._buffer
-        self._buffer = []
-        return _buffer
-
-
-# buffer of latency values for each handler/site combination
-LATENCY_BUFFERS: dict[tuple[str, str], LatencyBuffer] = defaultdict(LatencyBuffer)
+class EncodedResults:
+    """
+    results serialized with to_dict, each also encoded as JSON up front,
+    so a response made of any subset of them can be written without running json.dumps again
+    """
+
+    def __init__(self, results: List[dict]):
+        self.results = results
+        # keyed by id() of each result dict, which this object keeps alive
+        self._encoded = {id(result): json.dumps(result, default=default_serializer).encode() for result in results}
+        # compressed response bodies, keyed by encoding and the ids of the results in the body
+        self._compressed: Dict[Tuple[str, Tuple[int, ...]], bytes] = {}
+
+    def encode(self, results: List[dict]) -> bytes:
+        """
+        the same bytes as json.dumps(results), for results taken from self.results
+        """
+        return b"[" + b", ".join(self._encoded[id(result)] for result in results) + b"]"
+
+    def response_body(self, results: List[dict]) -> bytes:
+        """
+        the same bytes as json.dumps({"results": results})
+        """
+        return b'{"results": ' + self.encode(results) + b"}"
+
+    def compressed_response_body(self, results: List[dict], encoding: str) -> bytes:
+        """
+        response_body compressed with encoding. the first few variants (e.g. sizes or excludes) are kept,
+        so repeat requests for them don't compress again.
+        """
+        key = (encoding, tuple(id(result) for result in results))
+        body = self._compressed.get(key)
+        if body is None:
+            body = compress(self.response_body(results), encoding)
+            # not counted in the rec cache's byte budget, so keep it to a fraction of the raw results
+            if len(self._compressed) < MAX_COMPRESSED_VARIANTS:
+                self._compressed[key] = body
+        return body
+
+    def to_json(self) -> bytes:
+        """
+        all of self.results as a JSON array
+        """
+        return self.encode(self.results)
+
+
+# counter of finished requests by handler and status code
+REQUEST_COUNTER: Dict[Tuple[str, str], int] = defaultdict(int)
+# latency histogram for each handler/site combination
+LATENCY_HISTOGRAMS: Dict[Tuple[str, str], LatencyHistogram] = defaultdict(LatencyHistogram)
+# latency histogram of each stage (see BaseHandler.span) for each handler/site combination
+STAGE_LATENCY_HISTOGRAMS: Dict[Tuple[str, str, str], LatencyHistogram] = defaultdict(LatencyHistogram)
 
 
 def admin_only(f):
@@ -81,6 +173,26 @@ class BaseHandler(tornado.web.RequestHandler):
 
     def prepare(self):
         self.start_time = time.time()
+        # ms spent in each stage of handling the request
+        self.spans: Dict[str, float] = defaultdict(float)
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """
+        times the enclosed code as part of stage, e.g. "db" or "encode". a stage can be entered several times.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans[stage] += (time.perf_counter() - start) * 1000
+
+    def set_server_timing_header(self) -> None:
+        if not SERVER_TIMING_ENABLED:
+            return
+        timings = [f"{stage};dur={duration:.2f}" for stage, duration in self.spans.items()]
+        timings.append(f"total;dur={(time.time() - self.start_time) * 1000:.2f}")
+        self.set_header("Server-Timing", ", ".join(timings))
 
     def write_error_metric(self, latency: float):
         tags = {
@@ -93,16 +205,19 @@ class BaseHandler(tornado.web.RequestHandler):
 
     def push_latency(self, latency, handler_name: str, site_name: str) -> None:
         key = (handler_name, site_name)
-        LATENCY_BUFFERS[key].push(latency)
+        LATENCY_HISTOGRAMS[key].record(latency)
+        for stage, duration in self.spans.items():
+            STAGE_LATENCY_HISTOGRAMS[(handler_name, site_name, stage)].record(duration)
 
     def on_finish(self):
         if self.handler_name == "Health":
             return
+        REQUEST_COUNTER[(self.handler_name, str(self._status_code))] += 1
         latency = (time.time() - self.start_time) * 1000
-        if not 200 <= self._status_code < 300:
+        if not (200 <= self._status_code < 300 or self._status_code == 304):
             self.write_error_metric(latency)
-        # for now, only record latency for /recs endpoint
-        elif self.handler_name == "Rec":
+        # for now, only record latency for /recs endpoints
+        elif self.handler_name in ("Rec", "RecBatch"):
             self.push_latency(latency, self.handler_name, self.site_name)
 
 
@@ -117,9 +232,9 @@ class NotFoundHandler(BaseHandler):
 class HealthHandler(BaseHandler):
     """Return 200 OK."""
 
-    def get(self):
+    async def get(self):
         try:
-            Model.select().limit(1).count()
+            await DB_EXECUTOR.run(Model.select().limit(1).count)
         except Exception:
             msg = "Can't connect to db"
             logging.exception(msg)
@@ -128,9 +243,25 @@ class HealthHandler(BaseHandler):
         self.finish("OK")
 
 
+class MetricsHandler(BaseHandler):
+    """This process' metrics since startup, in the prometheus text format."""
+
+    def initialize(self, *args, **kwargs):
+        self.render_metrics: Callable[[], str] = kwargs.pop("render_metrics")
+        super(MetricsHandler, self).initialize(*args, **kwargs)
+
+    @admin_only
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(self.render_metrics())
+
+
 class APIHandler(BaseHandler):
     """Base class for API handlers."""
 
+    # set by each subclass to the mapping it serves
+    mapping: Type[BaseMapping]
+
     def __init__(self, *args, **kwargs):
         super(APIHandler, self).__init__(*args, **kwargs)
 
@@ -139,6 +270,30 @@ class APIHandler(BaseHandler):
         arguments["size"] = arguments.get("size", DEFAULT_PAGE_SIZE)
         return arguments
 
+    @property
+    def streaming(self) -> bool:
+        """
+        whether the client asked for the response to be streamed, see stream_page. streaming needs stream threads to
+        read rows while the IOLoop writes them, so without any the paged response is served instead.
+        """
+        return self.get_argument("stream", "") == "true" and STREAM_EXECUTOR.is_threaded
+
+    def get_page_size(self, filters: dict) -> int:
+        """
+        filters["size"] as an int. raises HTTPError 400 unless it's between 1 and MAX_PAGE_SIZE,
+        or MAX_STREAM_PAGE_SIZE for a streamed response.
+        """
+        max_size = MAX_STREAM_PAGE_SIZE if self.streaming else MAX_PAGE_SIZE
+        try:
+            size = int(filters["size"])
+            assert 0 < size <= max_size
+        except (ValueError, AssertionError):
+            raise tornado.web.HTTPError(
+                status_code=400,
+                log_message=f"Invalid input for 'size' (int), must be at most {max_size}: {filters['size']}",
+            )
+        return size
+
     def apply_sort(self, query, **filters):
         DEFAULT_ORDER_BY = "desc"
 
@@ -156,22 +311,155 @@ class APIHandler(BaseHandler):
 
         return query
 
+    def sort_results(self, results: List[dict], **filters) -> List[dict]:
+        """
+        in-memory equivalent of apply_sort, for results that were already serialized with to_dict
+        """
+        sort_by_field = None
+        if filters.get("sort_by"):
+            sort_by_field = self.mapping._meta.combined.get(filters["sort_by"])
+        if not sort_by_field:
+            return results
+
+        sort_by = sort_by_field.name
+
+        def sort_key(result: dict):
+            value = result[sort_by]
+            # foreign keys are serialized as nested dicts; the db orders them by id
+            return value["id"] if isinstance(value, dict) else value
+
+        # like apply_sort, anything but an explicit "asc" falls back to desc
+        reverse = filters.get("order_by") != "asc"
+        return sorted(results, key=sort_key, reverse=reverse)
+
     def apply_conditions(self, query, **filters):
         """override for custom where logic"""
         raise NotImplementedError
 
-    def api_response(self, data, code=200):
+    def not_modified(self, etag: str, cache_control: str) -> bool:
+        """
+        sets the response's validators. if the client's copy matches etag, finishes with a 304
+        and returns True, so the caller can skip building the body.
+        """
+        self.set_header("Etag", etag)
+        self.set_header("Cache-Control", cache_control)
+        self.set_header("Vary", "Accept-Encoding")
+        if not self.check_etag_header():
+            return False
+        self.set_status(304)
+        self.set_server_timing_header()
+        self.finish()
+        return True
+
+    @property
+    def response_encoding(self) -> Optional[str]:
+        """
+        the content-coding negotiated from the request's Accept-Encoding, or None for identity
+        """
+        return negotiate_encoding(self.request.headers.get("Accept-Encoding", ""))
+
+    def api_response(self, data, code=200, content_encoding: Optional[str] = None):
+        """
+        data that is bytes is sent as-is, and is already compressed if content_encoding is given.
+        otherwise, large enough responses are compressed if the client accepts it.
+        """
         self.set_status(code)
         self.set_header("Content-Type", "application/json")
+        self.set_header("Vary", "Accept-Encoding")
         self.add_header("Access-Control-Allow-Origin", "*")
         self.add_header("Access-Control-Allow-Headers", "Content-Type, Authorization")
 
+        response: Union[dict, str, bytes] = data
         if not 200 <= code < 300:
             response = {"message": data}
-        if not isinstance(data, str):
-            response = json.dumps(data, default=default_serializer)
+        with self.span("encode"):
+            if isinstance(data, bytes):
+                # already encoded, e.g. by EncodedResults
+                response = data
+            elif not isinstance(data, str):
+                response = json.dumps(data, default=default_serializer)
+
+            encoding = self.response_encoding
+            if content_encoding is None and encoding is not None and 200 <= code < 300:
+                if isinstance(response, str):
+                    response = response.encode()
+                if isinstance(response, bytes) and len(response) >= MIN_COMPRESS_BYTES:
+                    content_encoding = encoding
+                    response = compress(response, encoding)
+        if content_encoding is not None:
+            self.set_header("Content-Encoding", content_encoding)
+        self.set_server_timing_header()
         self.finish(response)
 
+    async def stream_page(self, query: Select, size: int, next_cursor: Callable[[dict], str]) -> None:
+        """
+        writes the same body as api_response({"results": [...], "next_cursor": ...}) for a page of query, which
+        selects one more than size rows to tell whether there's a next page, and next_cursor(last result) is its
+        cursor. the rows are read lazily on a STREAM_EXECUTOR thread, apart from the threads serving other requests,
+        and written in chunks as they're encoded, with only STREAM_BUFFERED_CHUNKS chunks in memory at a time,
+        however large the page. the body isn't compressed. a client that stops reading is disconnected after
+        STREAM_WRITE_TIMEOUT_SEC, which stops the producer and closes its cursor.
+        """
+        # the producer blocks until the IOLoop takes its chunks, so it can't run on the IOLoop itself
+        assert STREAM_EXECUTOR.is_threaded, "streaming needs STREAM_EXECUTOR_WORKERS > 0"
+        loop = asyncio.get_running_loop()
+        chunks: asyncio.Queue = asyncio.Queue(maxsize=STREAM_BUFFERED_CHUNKS)
+        closed = threading.Event()
+
+        def put(chunk: Optional[bytes]) -> None:
+            # blocks this thread while the client is behind, for at most STREAM_WRITE_TIMEOUT_SEC per chunk
+            asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+
+        def produce() -> None:
+            parts, buffered, last = [b'{"results": ['], 0, None
+            try:
+                with closing(iterate_lazily(query)) as rows:
+                    for n, row in enumerate(rows):
+                        if closed.is_set():
+                            return
+                        if n == size:
+                            break
+                        last = row.to_dict()
+                        encoded = (b", " if n else b"") + json.dumps(last, default=default_serializer).encode()
+                        parts.append(encoded)
+                        buffered += len(encoded)
+                        if buffered >= STREAM_CHUNK_BYTES:
+                            put(b"".join(parts))
+                            parts, buffered = [], 0
+                    else:
+                        # no row past the page, so no next page
+                        last = None
+                cursor = next_cursor(last) if last is not None else None
+                parts.append(b'], "next_cursor": ' + json.dumps(cursor).encode() + b"}")
+                put(b"".join(parts))
+            finally:
+                put(None)
+
+        self.set_status(200)
+        self.set_header("Content-Type", "application/json")
+        self.add_header("Access-Control-Allow-Origin", "*")
+        self.add_header("Access-Control-Allow-Headers", "Content-Type, Authorization")
+        self.set_server_timing_header()
+        producer = asyncio.ensure_future(STREAM_EXECUTOR.run(produce))
+        try:
+            while True:
+                chunk = await chunks.get()
+                if chunk is None:
+                    break
+                self.write(chunk)
+                await asyncio.wait_for(self.flush(), STREAM_WRITE_TIMEOUT_SEC)
+        except (tornado.iostream.StreamClosedError, asyncio.TimeoutError) as e:
+            if isinstance(e, asyncio.TimeoutError):
+                logging.warning(f"Stream client took over {STREAM_WRITE_TIMEOUT_SEC}s to read, disconnecting")
+                cast(tornado.http1connection.HTTP1Connection, self.request.connection).close()
+            # stop the producer, and unblock it if it's waiting for room
+            closed.set()
+            while not chunks.empty():
+                chunks.get_nowait()
+        await producer
+        if not closed.is_set():
+            self.finish()
+
     def write_error(self, status_code, exc_info=None, **kwargs):
         """Write errors as a JSON response."""
         if not exc_info:
@@ -1,13 +1,30 @@
 import operator
-from functools import reduce
+from datetime import datetime
+from functools import partial, reduce
+from typing import List, NamedTuple, Optional, Tuple
 
 import tornado.web
-from peewee import DoesNotExist
+from peewee import DoesNotExist, Field, IntegerField, fn
 
-from db.helpers import get_articles_by_external_ids, get_resource, retry_rollback
+from db.helpers import articles_page_query, get_resource, retry_rollback
 from db.mappings.model import Model
 from db.mappings.recommendation import Rec
-from handlers.base import APIHandler
+from handlers.base import APIHandler, decode_cursor, encode_cursor, version_etag
+from lib.db import DB_EXECUTOR
+
+# models are read straight from the db, so clients revalidate every time; the etag makes that a cheap query
+CACHE_CONTROL = "no-cache"
+
+
+class Page(NamedTuple):
+    """
+    a page of models, ordered by fields and starting after the sort values of the previous page's last model
+    """
+
+    fields: List[Field]
+    descending: bool
+    after: Optional[list]
+    size: int
 
 
 class ModelArticleHandler(APIHandler):
@@ -15,24 +32,67 @@ class ModelArticleHandler(APIHandler):
         self.mapping = Model
         super(APIHandler, self).__init__(*args, **kwargs)
 
+    def validate_page(self, filters: dict) -> Tuple[int, Optional[Tuple[Optional[datetime], int]]]:
+        """
+        the page size and the decoded cursor, if any. raises HTTPError 400 for invalid ones.
+        """
+        size = self.get_page_size(filters)
+        if not filters.get("cursor"):
+            return size, None
+        published_at, article_id = decode_cursor(filters["cursor"], 2)
+        try:
+            assert isinstance(article_id, int)
+            return size, (datetime.fromisoformat(published_at) if published_at is not None else None, article_id)
+        except (TypeError, ValueError, AssertionError):
+            raise tornado.web.HTTPError(status_code=400, log_message=f"Invalid input for 'cursor': {filters['cursor']}")
+
+    def articles_query(self, model: dict, size: int, after: Optional[Tuple[Optional[datetime], int]]):
+        """
+        a page of the articles the model has recs for, plus one more to tell whether there's a next page.
+        the articles are resolved with a semi-join on the model's recs, so their source_entity_ids never leave the db.
+        """
+        source_entity_ids = Rec.select(Rec.source_entity_id).where(Rec.model == model["id"])
+        return articles_page_query(model["site"], source_entity_ids, size + 1, after)
+
+    @staticmethod
+    def article_cursor(article: dict) -> str:
+        return encode_cursor(article["published_at"], article["id"])
+
+    @retry_rollback
+    def fetch_model(self, _id) -> dict:
+        return get_resource(self.mapping, _id)
+
     @retry_rollback
+    def fetch_articles(
+        self, _id, size: int, after: Optional[Tuple[Optional[datetime], int]]
+    ) -> Tuple[List[dict], Optional[str]]:
+        """
+        a page of the model's articles, and the cursor of the next page if there is one
+        """
+        model = get_resource(self.mapping, _id)
+        articles = [article.to_dict() for article in self.articles_query(model, size, after)]
+        if len(articles) <= size:
+            return articles, None
+        articles = articles[:size]
+        return articles, self.article_cursor(articles[-1])
+
     async def get(self, _id):
-        model = None
+        filters = self.get_arguments_as_dict()
+        size, after = self.validate_page(filters)
         try:
-            model = get_resource(self.mapping, _id)
+            if self.streaming:
+                model = await DB_EXECUTOR.run(self.fetch_model, _id)
+            else:
+                articles, next_cursor = await DB_EXECUTOR.run(self.fetch_articles, _id, size, after)
         except DoesNotExist:
             raise tornado.web.HTTPError(404, "RESOURCE DOES NOT EXIST")
 
-        rec_query = (
-            Rec.select(Rec.source_entity_id)
-            .join(Model, on=(Model.id == Rec.model))
-            .where((Model.id == model["id"]))
-            .distinct()
-        )
-        source_entity_ids = [rec.source_entity_id for rec in rec_query]
-        articles = get_articles_by_external_ids(model["site"], source_entity_ids)
+        if self.streaming:
+            await self.stream_page(self.articles_query(model, size, after), size, self.article_cursor)
+            return
         res = {
             "results": articles,
+            "next_cursor": next_cursor,
         }
         self.api_response(res)
 
@@ -60,13 +120,108 @@ class ModelHandler(APIHandler):
 
         return query
 
+    def sort_fields(self, filters: dict) -> Tuple[List[Field], bool]:
+        """
+        the fields pages are ordered by, sort_by and then id to break ties, and whether in descending order.
+        like apply_sort, anything but an explicit "asc" is descending.
+        """
+        fields = [self.mapping.id]
+        sort_by_field = self.mapping._meta.combined.get(filters.get("sort_by") or "")
+        if sort_by_field is not None and sort_by_field is not self.mapping.id:
+            fields.insert(0, sort_by_field)
+        return fields, filters.get("order_by") != "asc"
+
+    def get_page(self, filters: dict) -> Page:
+        """
+        the requested page. raises HTTPError 400 for an invalid size, or a cursor that isn't for this sort.
+        """
+        size = self.get_page_size(filters)
+        fields, descending = self.sort_fields(filters)
+        if not filters.get("cursor"):
+            return Page(fields, descending, None, size)
+        names, cursor_descending, after = decode_cursor(filters["cursor"], 3)
+        # a cursor only makes sense with the sort it was made for
+        if (
+            names != [field.name for field in fields]
+            or cursor_descending != descending
+            or not isinstance(after, list)
+            or len(after) != len(fields)
+        ):
+            raise tornado.web.HTTPError(
+                status_code=400,
+                log_message=f"Invalid input for 'cursor', it's for a different sort_by or order_by: {filters['cursor']}",
+            )
+        try:
+            # integer fields are ints in to_dict, the rest (text and datetimes) strings
+            for field, value in zip(fields, after):
+                assert isinstance(value, int if isinstance(field, IntegerField) else str) and not isinstance(value, bool)
+            after = [field.db_value(value) for field, value in zip(fields, after)]
+        except (TypeError, ValueError, AssertionError):
+            raise tornado.web.HTTPError(status_code=400, log_message=f"Invalid input for 'cursor': {filters['cursor']}")
+        return Page(fields, descending, after, size)
+
+    def apply_page(self, query, page: Page):
+        """
+        query limited to the page after the cursor, plus one more model to tell whether there's a next page
+        """
+        if page.after is not None:
+            clauses = []
+            for n, (field, value) in enumerate(zip(page.fields, page.after)):
+                # equal on every field before this one, past the cursor on this one
+                ties = [earlier == earlier_value for earlier, earlier_value in zip(page.fields[:n], page.after[:n])]
+                clauses.append(reduce(operator.and_, ties + [field < value if page.descending else field > value]))
+            query = query.where(reduce(operator.or_, clauses))
+        ordering = [field.desc() if page.descending else field.asc() for field in page.fields]
+        return query.order_by(*ordering).limit(page.size + 1)
+
     @retry_rollback
-    async def get(self):
-        filters = self.get_arguments_as_dict()
+    def fetch_version(self, filters: dict, page: Page) -> tuple:
+        """
+        count, latest updated_at and sum of ids of the models on the page: any insert, update or delete that
+        changes the page changes it. only the page is aggregated, however many models match.
+        """
+        page_query = self.mapping.select(self.mapping.id, self.mapping.updated_at)
+        page_query = self.apply_page(self.apply_conditions(page_query, **filters), page).alias("page")
+        query = self.mapping.select(
+            fn.COUNT(page_query.c.id), fn.MAX(page_query.c.updated_at), fn.SUM(page_query.c.id)
+        ).from_(page_query)
+        with self.span("db"):
+            return query.tuples().get()
+
+    @staticmethod
+    def page_cursor(page: Page, last: dict) -> str:
+        return encode_cursor([field.name for field in page.fields], page.descending, [last[f.name] for f in page.fields])
+
+    @retry_rollback
+    def fetch_results(self, filters: dict, page: Page) -> Tuple[List[dict], Optional[str]]:
+        """
+        the models on the page, and the cursor of the next page if there is one
+        """
         query = self.mapping.select()
-        query = self.apply_conditions(query, **filters)
-        query = self.apply_sort(query, **filters)
+        query = self.apply_page(self.apply_conditions(query, **filters), page)
+        with self.span("db"):
+            models = list(query)
+        with self.span("serialize"):
+            results = [x.to_dict() for x in models[: page.size]]
+        if len(models) <= page.size:
+            return results, None
+        return results, self.page_cursor(page, results[-1])
+
+    async def get(self):
+        with self.span("parse"):
+            filters = self.get_arguments_as_dict()
+            page = self.get_page(filters)
+        version = await DB_EXECUTOR.run(self.fetch_version, filters, page)
+        if self.not_modified(version_etag(version, sorted(filters.items()), self.response_encoding), CACHE_CONTROL):
+            return
+
+        if self.streaming:
+            query = self.apply_page(self.apply_conditions(self.mapping.select(), **filters), page)
+            await self.stream_page(query, page.size, partial(self.page_cursor, page))
+            return
+        results, next_cursor = await DB_EXECUTOR.run(self.fetch_results, filters, page)
         res = {
-            "results": [x.to_dict() for x in query],
+            "results": results,
+            "next_cursor": next_cursor,
         }
         self.api_response(res)
@@ -1,31 +1,85 @@
+import asyncio
+import functools
+import json
 import logging
 import operator
 from datetime import datetime, timedelta
+from decimal import Decimal
 from functools import reduce
 from random import randint
-from typing import Any, Dict, List, Optional
+from typing import Any, Awaitable, Dict, List, Optional, Tuple
 
 import tornado.web
-from cachetools import TTLCache, cached, keys
+from tornado.ioloop import IOLoop
 
+from db.current_models import CURRENT_MODELS
 from db.helpers import retry_rollback
 from db.mappings.article import Article
 from db.mappings.model import Model, Status, Type
 from db.mappings.recommendation import Rec
-from handlers.base import APIHandler
-from lib.config import config
+from db.rec_index import REC_INDEX
+from handlers.base import APIHandler, EncodedResults, default_serializer, version_etag
+from lib.cache import SingleFlight, StaleWhileRevalidateCache, deep_getsizeof
+from lib.config import STAGE, config
+from lib.db import DB_EXECUTOR
+from lib.shared_cache import SharedCache
 
 MAX_PAGE_SIZE = config.get("MAX_PAGE_SIZE")
+MODEL_TYPES = [model_type.value for model_type in Type]
+# source_entity_ids per /recs/batch request
+MAX_BATCH_SIZE = 100
 DEFAULT_SITE = config.get("DEFAULT_SITE")
 STALE_AFTER_MIN = 15
-# each result takes roughly 50,000 bytes; 2048 cached results ~= 100 MBs
-TTL_CACHE: TTLCache = TTLCache(maxsize=2048, ttl=STALE_AFTER_MIN * 60)
+# clients and CDNs may reuse a response for as long as it would be served fresh from TTL_CACHE
+CACHE_CONTROL = f"public, max-age={STALE_AFTER_MIN * 60}"
+# stale results keep being served (while they're refreshed in the background) until they're this old
+EXPIRE_AFTER_MIN = max(config.get("REC_CACHE_EXPIRE_AFTER_MIN"), STALE_AFTER_MIN)
+# keyed by (site, source_entity_id, model_type, model_id), bounded by the measured size of the cached results
+TTL_CACHE = StaleWhileRevalidateCache(
+    maxsize=config.get("REC_CACHE_MAX_MB") * 1024 * 1024,
+    soft_ttl=STALE_AFTER_MIN * 60,
+    hard_ttl=EXPIRE_AFTER_MIN * 60,
+    partition_of=lambda key: key[0],
+)
 # counter of default recs served for site
 DEFAULT_REC_COUNTER: Dict[str, int] = {}
 # counter of db hits by site
 DB_HIT_COUNTER: Dict[str, int] = {}
+# counter of local cache misses and default rec refreshes filled from the shared cache, by site
+SHARED_CACHE_HIT_COUNTER: Dict[str, int] = {}
+# counters of rec cache lookups by outcome and site
+CACHE_HIT_COUNTER: Dict[str, int] = {}
+CACHE_STALE_HIT_COUNTER: Dict[str, int] = {}
+CACHE_MISS_COUNTER: Dict[str, int] = {}
+# counter of requests answered from the in-memory rec index by site
+INDEX_HIT_COUNTER: Dict[str, int] = {}
 # counter of all handled requests by site
 TOTAL_HANDLED: Dict[str, int] = {}
+# counter of cache misses and default rec refreshes that joined an in-flight db fetch, by site
+COALESCED_COUNTER: Dict[str, int] = {}
+# optional cache tier shared across replicas, behind TTL_CACHE and DefaultRecs
+SHARED_CACHE = SharedCache.from_url(
+    config.get("REC_SHARED_CACHE_URL"),
+    prefix=f"{config.get('SERVICE')}:{STAGE}:",
+    timeout_sec=config.get("REC_SHARED_CACHE_TIMEOUT_MS") / 1000,
+)
+# db fetches in flight for cache misses, keyed like TTL_CACHE
+IN_FLIGHT = SingleFlight()
+
+
+def shared_cache_key(key: tuple) -> str:
+    return "recs:" + ":".join(str(part or "") for part in key)
+
+
+def recs_from_json(body: bytes) -> EncodedResults:
+    """
+    rebuild results stored in the shared cache by EncodedResults.to_json
+    """
+    results = json.loads(body)
+    for result in results:
+        # scores are serialized as strings; restore the db's Decimals so they sort and re-encode the same way
+        result["score"] = Decimal(result["score"])
+    return EncodedResults(results)
 
 
 def incr_metric_total(counter: dict[str, int], site: str) -> None:
@@ -38,38 +92,63 @@ def incr_metric_total(counter: dict[str, int], site: str) -> None:
         counter[site] = 1
 
 
-def instance_unaware_key(instance, *args, **kwargs):
-    # ignore "self" argument
-    key = keys.hashkey(*args, **kwargs)
-    return key
+def serialize_rec(rec: Rec, models: Optional[Dict[int, dict]]) -> Dict[str, Any]:
+    """
+    with models, rec was selected without its model (Rec.select_with_article) and its model is in models
+    """
+    if models is None:
+        return rec.to_dict()
+    return rec.to_dict_with_model(models[rec.model_id])
 
 
 class DefaultRecs:
     DEFAULT_TYPE = Type.POPULARITY.value
-    _recs: dict[str, list[dict]] = {}
+    _recs: dict[str, EncodedResults] = {}
     _last_updated: dict[str, datetime] = {}
+    _in_flight = SingleFlight()
 
     @classmethod
-    @retry_rollback
-    def get_recs(cls, site: str, external_id: str, size: int) -> List[Dict[str, Any]]:
+    async def get_recs(cls, site: str, external_id: str, size: int) -> Tuple[List[Dict[str, Any]], EncodedResults]:
         incr_metric_total(DEFAULT_REC_COUNTER, site)
         logging.info(f"Returning default recs for site:{site}, external_id:{external_id}")
 
         if cls.should_refresh(site):
-            query = (
-                Rec.select()
-                .join(Model, on=(Model.id == Rec.model))
-                .where((Model.type == cls.DEFAULT_TYPE) & (Model.status == Status.CURRENT.value))
-                .order_by(Rec.score.desc())
-            )
-            if site:
-                query = query.join(Article, on=(Article.id == Rec.recommended_article)).where(Article.site == site)
-
-            cls._recs[site] = [x.to_dict() for x in query]
-            cls._last_updated[site] = datetime.now()
+            if site in cls._in_flight:
+                incr_metric_total(COALESCED_COUNTER, site)
+            await cls._in_flight.run(site, lambda: cls.refresh(site))
 
         recs = cls._recs[site]
-        return recs[:size]
+        return recs.results[:size], recs
+
+    @classmethod
+    async def refresh(cls, site: str) -> None:
+        shared_key = f"default_recs:{site}"
+        body = await SHARED_CACHE.get(shared_key)
+        if body is not None:
+            incr_metric_total(SHARED_CACHE_HIT_COUNTER, site)
+            cls._recs[site] = await DB_EXECUTOR.run(recs_from_json, body)
+        else:
+            cls._recs[site] = recs = await DB_EXECUTOR.run(lambda: EncodedResults(cls.query_recs(site)))
+            IOLoop.current().spawn_callback(SHARED_CACHE.set, shared_key, recs.to_json(), STALE_AFTER_MIN * 60)
+        cls._last_updated[site] = datetime.now()
+
+    @classmethod
+    @retry_rollback
+    def query_recs(cls, site: str) -> List[Dict[str, Any]]:
+        models = CURRENT_MODELS.get(site, cls.DEFAULT_TYPE)
+        if models is None:
+            query = Rec.select_with_relations().where(
+                (Model.type == cls.DEFAULT_TYPE) & (Model.status == Status.CURRENT.value)
+            )
+        elif not models:
+            return []
+        else:
+            query = Rec.select_with_article().where(Rec.model.in_(list(models)))
+        query = query.order_by(Rec.score.desc())
+        if site:
+            query = query.where(Article.site == site)
+
+        return [serialize_rec(x, models) for x in query]
 
     @classmethod
     def should_refresh(cls, site):
@@ -90,30 +169,29 @@ class RecHandler(APIHandler):
         super(APIHandler, self).__init__(*args, **kwargs)
 
     def apply_conditions(self, query, **filters):
+        """
+        expects a query from Rec.select_with_relations, with Article and Model already joined,
+        or from Rec.select_with_article if the current models are given as model_ids
+        """
         clauses = []
 
         if filters.get("source_entity_id"):
             clauses.append((self.mapping.source_entity_id == filters["source_entity_id"]))
 
-        article_clauses = []
         if filters.get("exclude"):
-            article_clauses.append((Article.external_id.not_in(filters["exclude"].split(","))))
+            clauses.append((Article.external_id.not_in(filters["exclude"].split(","))))
 
         if filters.get("site"):
-            article_clauses.append((Article.site == filters["site"]))
-
-        if article_clauses:
-            query = query.join(Article, on=(Article.id == self.mapping.recommended_article)).where(
-                reduce(operator.and_, article_clauses)
-            )
+            clauses.append((Article.site == filters["site"]))
 
         if filters.get("model_id"):
             clauses.append((self.mapping.model_id == filters["model_id"]))
 
+        elif filters.get("model_ids") is not None:
+            clauses.append((self.mapping.model.in_(filters["model_ids"])))
+
         elif filters.get("model_type"):
-            query = query.join(Model, on=(Model.id == self.mapping.model)).where(
-                (Model.type == filters["model_type"]) & (Model.status == Status.CURRENT.value)
-            )
+            clauses.append((Model.type == filters["model_type"]) & (Model.status == Status.CURRENT.value))
 
         if filters.get("size"):
             query = query.limit(filters["size"])
@@ -132,6 +210,9 @@ class RecHandler(APIHandler):
                 except ValueError:
                     return f"Invalid input for 'exclude' (List[int]): {filters['exclude']}"
 
+        if "model_type" in filters and filters["model_type"] not in MODEL_TYPES:
+            return f"Invalid input for 'model_type' ({', '.join(MODEL_TYPES)}): {filters['model_type']}"
+
         if "model_id" in filters:
             try:
                 int(filters["model_id"])
@@ -146,50 +227,390 @@ class RecHandler(APIHandler):
 
         return None
 
-    @cached(cache=TTL_CACHE, key=instance_unaware_key)
-    def fetch_cached_results(
+    def apply_conditions_in_memory(self, results: List[Dict[str, Any]], **filters) -> List[Dict[str, Any]]:
+        """
+        in-memory equivalent of apply_conditions + apply_sort for the exclude, sort and size filters,
+        for candidate results that already match the site, source_entity_id and model filters
+        """
+        if filters.get("exclude"):
+            exclude = set(filters["exclude"].split(","))
+            results = [x for x in results if x["recommended_article"]["external_id"] not in exclude]
+
+        results = self.sort_results(results, **filters)
+
+        if filters.get("size"):
+            results = results[: int(filters["size"])]
+
+        return results
+
+    @retry_rollback
+    def query_results(
         self,
         site: str,
         source_entity_id: Optional[str] = None,
         model_type: Optional[str] = None,
         model_id: Optional[str] = None,
-        exclude: Optional[str] = None,
-        size: Optional[str] = None,
-        sort_by: Optional[str] = None,
-        order_by: Optional[str] = None,
-    ):
+    ) -> List[Dict[str, Any]]:
+        """
+        fetch the full candidate list for a site/source/model: the top MAX_PAGE_SIZE recs by score,
+        which every exclude/size/sort variant of the request is derived from
+        """
         filters = locals()
         filters.pop("self")
-        query = self.mapping.select()
-        query = self.apply_conditions(query, **filters)
-        query = self.apply_sort(query, **filters)
-        incr_metric_total(DB_HIT_COUNTER, site)
-        return [x.to_dict() for x in query]
-
-    def fetch_results(self, filters: dict[str, str]) -> List[Rec]:
-        results = self.fetch_cached_results(
+        filters["size"] = MAX_PAGE_SIZE
+        models = self.current_models(site, model_type, model_id)
+        if models is not None and not models:
+            # no current model of that type, so no recs either
+            return []
+        query = self.select_recs(models, **filters)
+        query = query.order_by(self.mapping.score.desc())
+        with self.span("db"):
+            recs = list(query)
+        with self.span("serialize"):
+            return [serialize_rec(x, models) for x in recs]
+
+    @staticmethod
+    def current_models(site: str, model_type: Optional[str], model_id: Optional[str]) -> Optional[Dict[int, dict]]:
+        """
+        the current models to filter recs on for a model_type request, if CURRENT_MODELS has them
+        """
+        if model_id or not model_type:
+            return None
+        return CURRENT_MODELS.get(site, model_type)
+
+    def select_recs(self, models: Optional[Dict[int, dict]], **filters):
+        """
+        with models, filter on their ids and skip the model join; otherwise join the model to filter on its type
+        """
+        if models is None:
+            return self.apply_conditions(self.mapping.select_with_relations(), **filters)
+        return self.apply_conditions(self.mapping.select_with_article(), model_ids=list(models), **filters)
+
+    @staticmethod
+    def cache_key(
+        site: str,
+        source_entity_id: Optional[str] = None,
+        model_type: Optional[str] = None,
+        model_id: Optional[str] = None,
+    ) -> tuple:
+        if model_id:
+            # model_id overrides model_type, so requests that only differ in model_type share an entry
+            model_type = None
+        return (site, source_entity_id, model_type, model_id)
+
+    def get_cached_results(self, key: tuple) -> Optional[EncodedResults]:
+        """
+        returns the cached results for key, fresh or stale, or None on a miss.
+        stale hits are served as-is while one background fetch refreshes them.
+        """
+        site = key[0]
+        entry = TTL_CACHE.get(key)
+        if entry is None:
+            incr_metric_total(CACHE_MISS_COUNTER, site)
+            return None
+
+        if not TTL_CACHE.is_stale(entry):
+            incr_metric_total(CACHE_HIT_COUNTER, site)
+        else:
+            incr_metric_total(CACHE_STALE_HIT_COUNTER, site)
+            if key not in IN_FLIGHT:
+                IOLoop.current().spawn_callback(IN_FLIGHT.run, key, lambda: self.fetch_and_cache_results(key))
+        return entry.value
+
+    async def fetch_cached_results(
+        self,
+        site: str,
+        source_entity_id: Optional[str] = None,
+        model_type: Optional[str] = None,
+        model_id: Optional[str] = None,
+    ) -> EncodedResults:
+        """
+        cache hits are answered on the IOLoop; only misses are sent to the db executor,
+        and concurrent misses for the same key share a single db fetch
+        """
+        key = self.cache_key(site, source_entity_id, model_type, model_id)
+        with self.span("cache"):
+            cached_results = self.get_cached_results(key)
+        if cached_results is not None:
+            return cached_results
+
+        if key in IN_FLIGHT:
+            incr_metric_total(COALESCED_COUNTER, site)
+        return await IN_FLIGHT.run(key, lambda: self.fetch_and_cache_results(key))
+
+    async def fetch_and_cache_results(self, key: tuple) -> EncodedResults:
+        """
+        fill a local cache miss from the shared cache if another replica already fetched it, otherwise from the db
+        """
+        site, source_entity_id, model_type, model_id = key
+        shared_key = shared_cache_key(key)
+        with self.span("shared_cache"):
+            body = await SHARED_CACHE.get(shared_key)
+        if body is not None:
+            incr_metric_total(SHARED_CACHE_HIT_COUNTER, site)
+        else:
+            incr_metric_total(DB_HIT_COUNTER, site)
+
+        def load_and_measure_results() -> Tuple[EncodedResults, int]:
+            if body is not None:
+                with self.span("serialize"):
+                    results = recs_from_json(body)
+            else:
+                candidates = self.query_results(site, source_entity_id, model_type, model_id)
+                with self.span("encode"):
+                    results = EncodedResults(candidates)
+            return results, deep_getsizeof(results)
+
+        results, size = await DB_EXECUTOR.run(load_and_measure_results)
+        TTL_CACHE.put(key, results, size=size)
+        if body is None:
+            IOLoop.current().spawn_callback(SHARED_CACHE.set, shared_key, results.to_json(), STALE_AFTER_MIN * 60)
+        return results
+
+    async def fetch_results(self, filters: dict[str, str]) -> Tuple[List[Dict[str, Any]], Optional[EncodedResults]]:
+        """
+        returns the matching results, plus their pre-encoded JSON when they came from the cache
+        """
+        with self.span("cache"):
+            indexed_results = REC_INDEX.lookup(
+                filters["site"],
+                source_entity_id=filters.get("source_entity_id"),
+                model_type=filters.get("model_type"),
+                model_id=filters.get("model_id"),
+            )
+        if indexed_results is not None:
+            incr_metric_total(INDEX_HIT_COUNTER, filters["site"])
+            with self.span("filter"):
+                return self.apply_conditions_in_memory(indexed_results, **filters), None
+
+        cached_results = await self.fetch_cached_results(
             site=filters["site"],
             source_entity_id=filters.get("source_entity_id"),
             model_type=filters.get("model_type"),
             model_id=filters.get("model_id"),
-            exclude=filters.get("exclude"),
-            size=filters.get("size"),
-            sort_by=filters.get("sort_by"),
-            order_by=filters.get("order_by"),
         )
-        return results
+        with self.span("filter"):
+            return self.apply_conditions_in_memory(cached_results.results, **filters), cached_results
 
-    @retry_rollback
     async def get(self):
-        filters = self.get_arguments_as_dict()
-        filters["site"] = filters.get("site", DEFAULT_SITE)
-        validation_errors = self.validate_filters(**filters)
+        with self.span("parse"):
+            filters = self.get_arguments_as_dict()
+            filters["site"] = filters.get("site", DEFAULT_SITE)
+            validation_errors = self.validate_filters(**filters)
         if validation_errors:
             raise tornado.web.HTTPError(status_code=400, log_message=validation_errors)
 
-        res = {
-            "results": self.fetch_results(filters)
-            or DefaultRecs.get_recs(filters["site"], filters.get("source_entity_id"), int(filters["size"])),
-        }
+        results, encoded_results = await self.fetch_results(filters)
+        if not results:
+            with self.span("default_recs"):
+                results, encoded_results = await DefaultRecs.get_recs(
+                    filters["site"], filters.get("source_entity_id"), int(filters["size"])
+                )
         incr_metric_total(TOTAL_HANDLED, filters["site"])
-        self.api_response(res)
+
+        # recs only change when their model is retrained, which bumps the model's updated_at
+        model_versions = sorted({(result["model"]["id"], result["model"]["updated_at"]) for result in results})
+        encoding = self.response_encoding
+        # each encoding is a different representation, so it needs its own strong etag
+        etag = version_etag(model_versions, sorted(filters.items()), encoding)
+        if self.not_modified(etag, CACHE_CONTROL):
+            return
+
+        if encoded_results is not None and encoding is not None:
+            with self.span("encode"):
+                body = encoded_results.compressed_response_body(results, encoding)
+            self.api_response(body, content_encoding=encoding)
+        elif encoded_results is not None:
+            with self.span("encode"):
+                body = encoded_results.response_body(results)
+            self.api_response(body)
+        else:
+            self.api_response({"results": results})
+
+
+class RecBatchHandler(RecHandler):
+    """
+    recs for several source articles at once: POST /recs/batch with {"source_entity_ids": [...]} as the body
+    and the other /recs filters as query arguments, applied to every source article
+    """
+
+    async def get(self):
+        # RecHandler's GET would answer as a single /recs request
+        raise tornado.web.HTTPError(405)
+
+    async def options(self):
+        # a browser's preflight for the JSON POST
+        self.set_status(204)
+        self.add_header("Access-Control-Allow-Origin", "*")
+        self.add_header("Access-Control-Allow-Methods", "POST")
+        self.add_header("Access-Control-Allow-Headers", "Content-Type")
+
+    def parse_source_entity_ids(self) -> List[str]:
+        try:
+            body = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(status_code=400, log_message="Invalid JSON body")
+
+        source_entity_ids = body.get("source_entity_ids") if isinstance(body, dict) else None
+        if (
+            not isinstance(source_entity_ids, list)
+            or not source_entity_ids
+            or not all(isinstance(x, (str, int)) and not isinstance(x, bool) for x in source_entity_ids)
+        ):
+            raise tornado.web.HTTPError(
+                status_code=400, log_message="Invalid input for 'source_entity_ids' (List[str]): must be non-empty"
+            )
+        if len(source_entity_ids) > MAX_BATCH_SIZE:
+            raise tornado.web.HTTPError(
+                status_code=400,
+                log_message=f"Invalid input for 'source_entity_ids' (List[str]), must be at most {MAX_BATCH_SIZE}",
+            )
+        # deduplicated, in request order
+        return list(dict.fromkeys(str(x) for x in source_entity_ids))
+
+    @retry_rollback
+    def query_batch_results(
+        self,
+        site: str,
+        source_entity_ids: List[str],
+        model_type: Optional[str] = None,
+        model_id: Optional[str] = None,
+    ) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        query_results for many source articles with a single IN query, grouped by source_entity_id
+        """
+        results: Dict[str, List[Dict[str, Any]]] = {source_entity_id: [] for source_entity_id in source_entity_ids}
+        models = self.current_models(site, model_type, model_id)
+        if models is not None and not models:
+            return results
+        query = self.select_recs(models, site=site, model_type=model_type, model_id=model_id)
+        query = query.where(self.mapping.source_entity_id.in_(source_entity_ids)).order_by(self.mapping.score.desc())
+
+        with self.span("db"):
+            recs = list(query)
+
+        with self.span("serialize"):
+            for rec in recs:
+                candidates = results[rec.source_entity_id]
+                if len(candidates) < MAX_PAGE_SIZE:
+                    candidates.append(serialize_rec(rec, models))
+        return results
+
+    async def fetch_and_cache_batch(self, keys: List[tuple]) -> Dict[tuple, EncodedResults]:
+        """
+        fill local cache misses that share a site and model from the shared cache in one round trip,
+        and whatever is left from the db in one query
+        """
+        site, _, model_type, model_id = keys[0]
+        shared_keys = [shared_cache_key(key) for key in keys]
+        with self.span("shared_cache"):
+            bodies = dict(zip(keys, await SHARED_CACHE.get_many(shared_keys)))
+        missing = [key for key, body in bodies.items() if body is None]
+        for _ in range(len(keys) - len(missing)):
+            incr_metric_total(SHARED_CACHE_HIT_COUNTER, site)
+        if missing:
+            incr_metric_total(DB_HIT_COUNTER, site)
+
+        def load_and_measure_results() -> Dict[tuple, Tuple[EncodedResults, int]]:
+            with self.span("serialize"):
+                loaded = {key: recs_from_json(body) for key, body in bodies.items() if body is not None}
+            if missing:
+                candidates = self.query_batch_results(site, [key[1] for key in missing], model_type, model_id)
+                with self.span("encode"):
+                    for key in missing:
+                        loaded[key] = EncodedResults(candidates[key[1]])
+            return {key: (results, deep_getsizeof(results)) for key, results in loaded.items()}
+
+        measured_results = await DB_EXECUTOR.run(load_and_measure_results)
+        for key, (results, size) in measured_results.items():
+            TTL_CACHE.put(key, results, size=size)
+        for key in missing:
+            results = measured_results[key][0]
+            IOLoop.current().spawn_callback(
+                SHARED_CACHE.set, shared_cache_key(key), results.to_json(), STALE_AFTER_MIN * 60
+            )
+        return {key: results for key, (results, _) in measured_results.items()}
+
+    async def fetch_batch_results(
+        self, source_entity_ids: List[str], filters: dict[str, str]
+    ) -> Dict[str, Tuple[List[Dict[str, Any]], Optional[EncodedResults]]]:
+        """
+        fetch_results for each source article. index and cache hits are resolved one by one,
+        misses already being fetched are joined, and the rest are fetched together.
+        """
+        site = filters["site"]
+        results: Dict[str, Tuple[List[Dict[str, Any]], Optional[EncodedResults]]] = {}
+        pending: Dict[str, Awaitable[EncodedResults]] = {}
+        missing = []
+        # lookups and in-memory filtering of hits
+        with self.span("cache"):
+            for source_entity_id in source_entity_ids:
+                indexed_results = REC_INDEX.lookup(
+                    site,
+                    source_entity_id=source_entity_id,
+                    model_type=filters.get("model_type"),
+                    model_id=filters.get("model_id"),
+                )
+                if indexed_results is not None:
+                    incr_metric_total(INDEX_HIT_COUNTER, site)
+                    results[source_entity_id] = (self.apply_conditions_in_memory(indexed_results, **filters), None)
+                    continue
+
+                key = self.cache_key(site, source_entity_id, filters.get("model_type"), filters.get("model_id"))
+                cached_results = self.get_cached_results(key)
+                if cached_results is not None:
+                    results[source_entity_id] = (
+                        self.apply_conditions_in_memory(cached_results.results, **filters),
+                        cached_results,
+                    )
+                elif key in IN_FLIGHT:
+                    incr_metric_total(COALESCED_COUNTER, site)
+                    pending[source_entity_id] = IN_FLIGHT.run(key, functools.partial(self.fetch_and_cache_results, key))
+                else:
+                    missing.append(key)
+
+        if missing:
+            batch = asyncio.ensure_future(self.fetch_and_cache_batch(missing))
+
+            async def batch_result(key: tuple) -> EncodedResults:
+                return (await batch)[key]
+
+            # registered per key, so single /recs misses for these keys join the batch fetch
+            for key in missing:
+                pending[key[1]] = IN_FLIGHT.run(key, functools.partial(batch_result, key))
+
+        fetched_results = await asyncio.gather(*pending.values())
+        with self.span("filter"):
+            for source_entity_id, fetched in zip(pending, fetched_results):
+                results[source_entity_id] = (self.apply_conditions_in_memory(fetched.results, **filters), fetched)
+        return results
+
+    async def post(self):
+        with self.span("parse"):
+            filters = self.get_arguments_as_dict()
+            filters["site"] = filters.get("site", DEFAULT_SITE)
+            filters.pop("source_entity_id", None)
+            validation_errors = self.validate_filters(**filters)
+            if validation_errors:
+                raise tornado.web.HTTPError(status_code=400, log_message=validation_errors)
+            source_entity_ids = self.parse_source_entity_ids()
+
+        batch_results = await self.fetch_batch_results(source_entity_ids, filters)
+        response_parts = []
+        for source_entity_id in source_entity_ids:
+            results, encoded_results = batch_results[source_entity_id]
+            if not results:
+                with self.span("default_recs"):
+                    results, encoded_results = await DefaultRecs.get_recs(
+                        filters["site"], source_entity_id, int(filters["size"])
+                    )
+            with self.span("encode"):
+                if encoded_results is not None:
+                    encoded = encoded_results.encode(results)
+                else:
+                    encoded = json.dumps(results, default=default_serializer).encode()
+                response_parts.append(json.dumps(source_entity_id).encode() + b": " + encoded)
+        incr_metric_total(TOTAL_HANDLED, filters["site"])
+
+        # the same bytes as json.dumps({"results": {source_entity_id: results, ...}})
+        self.api_response(b'{"results": {' + b", ".join(response_parts) + b"}}")
@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import sys
+import time
+from collections import defaultdict
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    NamedTuple,
+    Optional,
+    TypeVar,
+)
+
+from cachetools import Cache, TTLCache
+
+T = TypeVar("T")
+
+
+def deep_getsizeof(obj: Any) -> int:
+    """
+    approximate memory footprint of obj in bytes, following dicts, lists, tuples and instance attributes.
+    objects referenced more than once are counted once.
+    """
+    seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif hasattr(obj, "__dict__"):
+            stack.append(vars(obj))
+    return size
+
+
+class CacheEntry(NamedTuple):
+    value: Any
+    # per the cache's timer
+    stale_at: float
+    # bytes, measured once when the entry is stored
+    size: int
+
+
+class StaleWhileRevalidateCache(TTLCache):
+    """
+    TTLCache whose ttl is the hard expiry, after which an entry is gone.
+    entries older than soft_ttl are still returned, flagged as stale, so callers can serve them
+    while a refresh happens in the background.
+
+    maxsize is a budget in bytes; least recently used entries are evicted to stay under it.
+    partition_of maps a key to the label (e.g. site) that stats are grouped by.
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        soft_ttl: float,
+        hard_ttl: float,
+        partition_of: Callable[[Any], str],
+        timer=time.monotonic,
+    ):
+        super().__init__(maxsize, ttl=hard_ttl, timer=timer, getsizeof=lambda entry: entry.size)
+        self.soft_ttl = soft_ttl
+        self.partition_of = partition_of
+        self._evictions: Dict[str, int] = defaultdict(int)
+
+    def put(self, key: Hashable, value: Any, size: Optional[int] = None) -> None:
+        if size is None:
+            size = deep_getsizeof(value)
+        if size > self.maxsize:
+            logging.warning(f"Not caching {key}: {size} bytes is over the cache's {self.maxsize} byte budget")
+            return
+        self[key] = CacheEntry(value, self.timer() + self.soft_ttl, size)
+
+    def is_stale(self, entry: CacheEntry) -> bool:
+        return self.timer() >= entry.stale_at
+
+    def popitem(self):
+        key, entry = super().popitem()
+        self._evictions[self.partition_of(key)] += 1
+        return key, entry
+
+    def flush_stats(self) -> Dict[str, Dict[str, int]]:
+        """
+        bytes and entries currently cached, and evictions since the last flush, by partition
+        """
+        stats: Dict[str, Dict[str, int]] = defaultdict(lambda: {"bytes": 0, "entries": 0, "evictions": 0})
+        # iterating skips expired entries, and Cache.__getitem__ reads without touching the lru order
+        for key in list(self):
+            partition_stats = stats[self.partition_of(key)]
+            partition_stats["bytes"] += Cache.__getitem__(self, key).size
+            partition_stats["entries"] += 1
+        for partition, evictions in self._evictions.items():
+            stats[partition]["evictions"] = evictions
+        self._evictions.clear()
+        return dict(stats)
+
+
+class SingleFlight:
+    """
+    coalesces concurrent calls for the same key: the first caller starts the work,
+    and everyone who asks for that key while it's running awaits the same result
+    """
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._in_flight
+
+    async def run(self, key: Hashable, f: Callable[[], Awaitable[T]]) -> T:
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(f())
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # shield the shared work, so one caller going away doesn't cancel it for the others
+        return await asyncio.shield(future)
@@ -0,0 +1,48 @@
+import gzip
+from typing import Optional
+
+try:
+    import brotli
+except ImportError:  # optional: without it, only gzip is offered
+    brotli = None
+
+# in order of preference when a client accepts several equally
+ENCODINGS = ["br", "gzip"] if brotli is not None else ["gzip"]
+# below this, compression saves less than the headers it costs
+MIN_COMPRESS_BYTES = 1024
+# per-response compression runs on the IOLoop, so favor speed over ratio
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    the supported content-coding the client prefers per its Accept-Encoding header, or None for identity
+    """
+    qualities = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        qualities[coding.strip().lower()] = q
+
+    wildcard = qualities.get("*", 0.0)
+    best, best_q = None, 0.0
+    for encoding in ENCODINGS:
+        q = qualities.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    if encoding == "br" and brotli is not None:
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    raise ValueError(f"unsupported encoding: {encoding}")
@@ -1,17 +1,34 @@
+import functools
+import hashlib
 import json
 import logging
 import os
+import time
 from pathlib import Path
-from typing import Any
+from typing import Any, Dict, List, Optional
 
-import boto3
 from botocore.exceptions import NoCredentialsError
 
 STAGE = os.environ["STAGE"]
 REGION = os.getenv("REGION", "us-east-1")
 CWD = str(Path(__file__).parent.resolve())
 INPUT_FILEPATH = f"{CWD}/../env.json"
-CLIENT = boto3.client("ssm", REGION)
+# optional file to keep the resolved config in between runs, so local and dev restarts skip SSM.
+# it holds secrets, so it is never used in prod
+CONFIG_CACHE_PATH = os.getenv("CONFIG_CACHE_PATH")
+CONFIG_CACHE_TTL_SEC = int(os.getenv("CONFIG_CACHE_TTL_SEC", 3600))
+# the GetParameters limit on names per call
+MAX_PARAMETERS_PER_CALL = 10
+
+
+@functools.lru_cache(maxsize=None)
+def aws_client(service: str) -> Any:
+    """
+    boto3 is slow to import and its clients slow to construct, so each client is made the first time it's needed
+    """
+    import boto3
+
+    return boto3.client(service, REGION)
 
 
 class Config:
@@ -19,15 +36,27 @@ class Config:
         self._config = self.load_env()
 
     @staticmethod
-    def get_secret(secret_key: str) -> Any:
-        res = CLIENT.get_parameter(Name=secret_key, WithDecryption=True)
-        val = res["Parameter"]["Value"]
+    def parse_secret(val: str) -> Any:
         try:
-            val = json.loads(val)
+            return json.loads(val)
         except json.decoder.JSONDecodeError:
             # expect this error for strings
-            pass
-        return val
+            return val
+
+    @classmethod
+    def get_secrets(cls, secret_keys: List[str]) -> Dict[str, Any]:
+        """
+        resolves secrets with one GetParameters call per MAX_PARAMETERS_PER_CALL of them, rather than one call each
+        """
+        secrets = {}
+        for start in range(0, len(secret_keys), MAX_PARAMETERS_PER_CALL):
+            names = secret_keys[start : start + MAX_PARAMETERS_PER_CALL]
+            res = aws_client("ssm").get_parameters(Names=names, WithDecryption=True)
+            if res["InvalidParameters"]:
+                raise ValueError(f"SSM parameters not found: {', '.join(res['InvalidParameters'])}")
+            for parameter in res["Parameters"]:
+                secrets[parameter["Name"]] = cls.parse_secret(parameter["Value"])
+        return secrets
 
     @staticmethod
     def is_secret(val: str) -> bool:
@@ -44,24 +73,67 @@ class Config:
 
         return val
 
+    @staticmethod
+    def cache_path() -> Optional[str]:
+        if STAGE == "prod":
+            return None
+        return CONFIG_CACHE_PATH
+
+    @staticmethod
+    def read_cache(path: str, version: str) -> Optional[Dict[str, Any]]:
+        try:
+            with open(path) as cache_file:
+                cached = json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+        # env.json changed, or the secrets may have been rotated since
+        if cached.get("version") != version or cached.get("expires_at", 0) < time.time():
+            return None
+        return cached["config"]
+
+    @staticmethod
+    def write_cache(path: str, version: str, config: Dict[str, Any]) -> None:
+        cached = {"version": version, "expires_at": time.time() + CONFIG_CACHE_TTL_SEC, "config": config}
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            # readable by this user only, since it holds secrets
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as cache_file:
+                json.dump(cached, cache_file)
+            os.replace(tmp_path, path)
+        except OSError:
+            logging.warning(f"Can't write config cache: '{path}'")
+
     def load_env(self):
         with open(INPUT_FILEPATH) as json_file:
-            env_vars = json.load(json_file)
+            raw_env = json_file.read()
+        env_vars = json.loads(raw_env)
+
+        version = hashlib.sha1(f"{STAGE}:{raw_env}".encode()).hexdigest()
+        cache_path = self.cache_path()
+        if cache_path:
+            cached = self.read_cache(cache_path, version)
+            if cached is not None:
+                return cached
 
         config = {}
         stage_env = env_vars.get("default", {})
         stage_env.update(env_vars[STAGE])
 
-        for var_name, val in stage_env.items():
-            if self.is_secret(val):
-                try:
-                    val = self.get_secret(val)
-                except NoCredentialsError:
-                    # alright if github action test workflow does not have aws credentials
-                    logging.warning(f"AWS credentials missing. Can't fetch secret: '{val}'")
+        secret_keys = sorted({val for val in stage_env.values() if self.is_secret(val)})
+        secrets = {}
+        try:
+            secrets = self.get_secrets(secret_keys)
+        except NoCredentialsError:
+            # alright if github action test workflow does not have aws credentials
+            logging.warning(f"AWS credentials missing. Can't fetch secrets: {secret_keys}")
 
-            config[var_name] = val
+        for var_name, val in stage_env.items():
+            config[var_name] = secrets.get(val, val) if self.is_secret(val) else val
 
+        # only cache a complete config
+        if cache_path and len(secrets) == len(secret_keys):
+            self.write_cache(cache_path, version, config)
         return config
 
 
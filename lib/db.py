@@ -1,19 +1,240 @@
-from playhouse.pool import PooledPostgresqlExtDatabase
+import asyncio
+import heapq
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Optional, Tuple, TypeVar
+
+from peewee import Database
+from playhouse.pool import PooledDatabase, _PooledPostgresqlDatabase
+from playhouse.postgres_ext import PostgresqlExtDatabase
 
 from lib.config import config
+from lib.histogram import LatencyHistogram
 
 PASSWORD = config.get("DB_PASSWORD")
 NAME = config.get("DB_NAME")
 USER = config.get("DB_USER")
 HOST = config.get("DB_HOST")
 PORT = 5432  # default postgres port
+MAX_DB_CONNECTIONS = config.get("MAX_DB_CONNECTIONS")
+# each executor thread holds on to its own pooled connection, so never run more threads than the pool allows
+DB_EXECUTOR_WORKERS = min(config.get("DB_EXECUTOR_WORKERS"), MAX_DB_CONNECTIONS)
+# streamed responses hold a thread and a connection for as long as the client reads, so they get threads of their own,
+# from the connections DB_EXECUTOR_WORKERS leaves over
+STREAM_EXECUTOR_WORKERS = min(config.get("STREAM_EXECUTOR_WORKERS"), MAX_DB_CONNECTIONS - DB_EXECUTOR_WORKERS)
+
+# opened at startup and topped up in the background, so the first requests don't pay for connection setup
+DB_POOL_WARM_CONNECTIONS = min(config.get("DB_POOL_WARM_CONNECTIONS"), MAX_DB_CONNECTIONS)
+
+T = TypeVar("T")
+
+
+class ConnectionCounter:
+    """
+    counts connections actually opened and closed. it goes beneath the pool in the mro,
+    so it sees connections come and go rather than being checked out and in.
+    """
+
+    opened: int = 0
+    closed: int = 0
+
+    def _connect(self):
+        conn = super()._connect()  # type: ignore
+        self.opened += 1
+        return conn
+
+    def _close(self, conn):
+        self.closed += 1
+        super()._close(conn)  # type: ignore
+
+
+class InstrumentedPool(PooledDatabase):
+    """
+    connection pool that records how long checking out a connection takes (waiting for a free slot
+    plus opening a new connection if none is idle), and that can be warmed up and have its idle connections
+    validated in the background instead of when a request checks them out
+    """
+
+    # counted by the ConnectionCounter beneath it
+    opened: int
+    closed: int
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._connect_times = LatencyHistogram()
+
+    def connect(self, reuse_if_open=False):
+        started_at = time.time()
+        connected = super().connect(reuse_if_open)
+        if connected:
+            with self._lock:
+                self._connect_times.record((time.time() - started_at) * 1000)
+        return connected
+
+    def warm_up(self, count: int) -> int:
+        """
+        make sure at least count connections are idle in the pool, returns how many were opened
+        """
+        conns = []
+        with self._lock:
+            opened = self.opened
+            try:
+                for _ in range(min(count, self._max_connections - len(self._in_use))):
+                    # reuses idle connections first, so only the shortfall is opened
+                    conns.append(self._connect())
+            finally:
+                for conn in conns:
+                    self._close(conn)
+            return self.opened - opened
+
+    def _is_usable(self, timestamp: float, conn) -> bool:
+        if self._stale_timeout and self._is_stale(timestamp):
+            return False
+        if self._is_closed(conn):
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+        except Exception:  # any driver error means the connection can't be trusted
+            return False
+        # also rolls back the transaction the ping may have opened
+        return self._can_reuse(conn)
+
+    def validate_idle(self) -> int:
+        """
+        ping each idle connection and close it if it's stale or broken, returns how many were closed.
+        connections are taken out of the pool one at a time while they're checked, so requests can still get the rest.
+        """
+        with self._lock:
+            idle = list(self._connections)
+        closed = 0
+        for entry in idle:
+            with self._lock:
+                if entry not in self._connections:
+                    continue  # checked out in the meantime
+                self._connections.remove(entry)
+                heapq.heapify(self._connections)
+            timestamp, conn = entry
+            if self._is_usable(timestamp, conn):
+                with self._lock:
+                    heapq.heappush(self._connections, entry)
+                continue
+            closed += 1
+            try:
+                self._close(conn, close_conn=True)
+            except Exception:
+                logging.exception("Failed to close broken db connection")
+        return closed
+
+    def flush_stats(self) -> Tuple[LatencyHistogram, int, int]:
+        """
+        returns the connect times (ms) and how many connections were opened and closed since the last flush
+        """
+        with self._lock:
+            connect_times = self._connect_times
+            opened, closed = self.opened, self.closed
+            self._connect_times = LatencyHistogram()
+            self.opened = self.closed = 0
+        return connect_times, opened, closed
+
+
+class PooledPostgresqlDatabase(InstrumentedPool, _PooledPostgresqlDatabase, ConnectionCounter, PostgresqlExtDatabase):
+    """
+    playhouse's PooledPostgresqlExtDatabase, instrumented
+    """
 
-db = PooledPostgresqlExtDatabase(
+
+db = PooledPostgresqlDatabase(
     NAME,
     user=USER,
     password=PASSWORD,
     host=HOST,
     port=PORT,
-    max_connections=config.get("MAX_DB_CONNECTIONS"),
+    max_connections=MAX_DB_CONNECTIONS,
     stale_timeout=300,  # connections time out after 5 minutes
 )
+
+
+class DBExecutor:
+    """
+    runs blocking database work on a bounded thread pool so handlers can await it
+    without stalling the IOLoop. with max_workers=0, work runs inline on the IOLoop.
+    each call checks a connection out of database for its duration and returns it after, rather than every thread
+    holding on to one, so the pool's validation, stale timeout and metrics apply to the connections serving requests.
+    """
+
+    def __init__(self, max_workers: int, database: Optional[Database] = None, thread_name_prefix: str = "db"):
+        self.database = database
+        self._executor = ThreadPoolExecutor(max_workers, thread_name_prefix=thread_name_prefix) if max_workers else None
+        self._lock = threading.Lock()
+        # calls submitted to the pool that haven't started running yet
+        self._queue_depth = 0
+        self._max_queue_depth = 0
+        self._wait_times = LatencyHistogram()
+
+    def _on_start(self, submitted_at: float) -> None:
+        wait_time = (time.time() - submitted_at) * 1000
+        with self._lock:
+            self._queue_depth -= 1
+            self._wait_times.record(wait_time)
+
+    def _call(self, f: Callable[..., T], *args, **kwargs) -> T:
+        if self.database is None:
+            return f(*args, **kwargs)
+        # a connection that's already open, e.g. inline on the IOLoop, belongs to the caller
+        opened = self.database.connect(reuse_if_open=True)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            if opened:
+                self.database.close()
+
+    async def run(self, f: Callable[..., T], *args, **kwargs) -> T:
+        if self._executor is None:
+            return self._call(f, *args, **kwargs)
+
+        submitted_at = time.time()
+
+        def timed_call() -> T:
+            self._on_start(submitted_at)
+            return self._call(f, *args, **kwargs)
+
+        with self._lock:
+            self._queue_depth += 1
+            self._max_queue_depth = max(self._max_queue_depth, self._queue_depth)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, timed_call)
+
+    @property
+    def is_threaded(self) -> bool:
+        return self._executor is not None
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue_depth
+
+    def flush_stats(self) -> Tuple[int, LatencyHistogram]:
+        """
+        returns the max queue depth and the queue wait times (ms) seen since the last flush
+        """
+        with self._lock:
+            max_queue_depth = self._max_queue_depth
+            wait_times = self._wait_times
+            self._max_queue_depth = self._queue_depth
+            self._wait_times = LatencyHistogram()
+        return max_queue_depth, wait_times
+
+
+DB_EXECUTOR = DBExecutor(DB_EXECUTOR_WORKERS)
+STREAM_EXECUTOR = DBExecutor(STREAM_EXECUTOR_WORKERS, thread_name_prefix="stream")
+
+
+def pool_stats() -> Dict[str, int]:
+    """
+    connections of the pool that are checked out vs. open and waiting to be reused
+    """
+    return {"in_use": len(db._in_use), "idle": len(db._connections)}
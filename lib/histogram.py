@@ -0,0 +1,86 @@
+import math
+from typing import Dict, Iterator, List, Tuple
+
+
+class LatencyHistogram:
+    """
+    fixed-memory histogram of positive values (e.g. latencies in ms) in log-spaced buckets:
+    percentiles come out within RELATIVE_ERROR of the true value, however many values are recorded.
+    histograms merge by adding bucket counts, so per-worker histograms combine into the task's.
+    """
+
+    # each bucket's upper bound is GROWTH times its lower bound, so its midpoint is within 2% of anything in it
+    GROWTH = 1.04
+    RELATIVE_ERROR = 0.02
+    # values at or below MIN_VALUE share the first bucket, and values above MAX_VALUE the last one
+    MIN_VALUE = 0.01
+    MAX_VALUE = 3_600_000.0
+    MAX_INDEX = math.ceil(math.log(MAX_VALUE / MIN_VALUE) / math.log(GROWTH))
+
+    def __init__(self):
+        # bucket index -> count; at most MAX_INDEX + 1 entries
+        self.buckets: Dict[int, int] = {}
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    @classmethod
+    def bucket_index(cls, value: float) -> int:
+        if value <= cls.MIN_VALUE:
+            return 0
+        return min(math.ceil(math.log(value / cls.MIN_VALUE) / math.log(cls.GROWTH)), cls.MAX_INDEX)
+
+    @classmethod
+    def bucket_value(cls, index: int) -> float:
+        """
+        the geometric midpoint of a bucket, which represents every value in it
+        """
+        if index == 0:
+            return cls.MIN_VALUE
+        return cls.MIN_VALUE * cls.GROWTH ** (index - 0.5)
+
+    def record(self, value: float) -> None:
+        index = self.bucket_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "LatencyHistogram") -> None:
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percentile: float) -> float:
+        """
+        e.g. percentile(99) for p99; nan if nothing was recorded
+        """
+        if not self.count:
+            return math.nan
+        if percentile >= 100:
+            return self.max
+        rank = percentile / 100 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                if index == self.MAX_INDEX:
+                    # the overflow bucket has no upper bound, so its midpoint means nothing
+                    return self.max
+                # the exact extremes are known, so don't report past them
+                return min(max(self.bucket_value(index), self.min), self.max)
+        return self.max
+
+    def values_and_counts(self, chunk_size: int) -> Iterator[Tuple[List[float], List[int]]]:
+        """
+        the non-empty buckets as (bucket values, counts), at most chunk_size buckets at a time
+        """
+        indexes = sorted(self.buckets)
+        for start in range(0, len(indexes), chunk_size):
+            chunk = indexes[start : start + chunk_size]
+            yield [self.bucket_value(index) for index in chunk], [self.buckets[index] for index in chunk]
@@ -1,12 +1,19 @@
+import asyncio
+import functools
 import logging
-from typing import Dict, List
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, List, Optional
 
-import boto3
+from tornado.ioloop import IOLoop
 
-from lib.config import REGION, STAGE, config
+from lib.config import STAGE, aws_client, config
+from lib.histogram import LatencyHistogram
 
-client = boto3.client("cloudwatch", REGION)
 SERVICE = config.get("SERVICE")
+# the PutMetricData limit on Values per datum
+MAX_VALUES_PER_DATUM = 150
 
 
 class Unit:
@@ -38,60 +45,135 @@ class Unit:
     COUNT_PER_SECOND = "Count/Second"
 
 
+class LocalMetricsClient:
+    """
+    stands in for the cloudwatch client locally and in tests: logs and keeps the last MAX_CALLS calls
+    instead of sending them
+    """
+
+    # enough for tests to inspect, without growing for as long as a local run or load test goes on
+    MAX_CALLS = 100
+
+    def __init__(self):
+        self.calls: Deque[dict] = deque(maxlen=self.MAX_CALLS)
+
+    def put_metric_data(self, **kwargs) -> None:
+        self.calls.append(kwargs)
+        for datum in kwargs["MetricData"]:
+            logging.debug(f"Skipping metric write: {datum}")
+
+
+class CloudWatchClient:
+    """
+    makes the boto3 client on the first send, from the emitter's thread, rather than at import
+    """
+
+    def put_metric_data(self, **kwargs) -> None:
+        aws_client("cloudwatch").put_metric_data(**kwargs)
+
+
+class MetricEmitter:
+    """
+    queues metric data and sends it from a background worker, up to MAX_BATCH_SIZE data per put_metric_data call,
+    so writing a metric never blocks the IOLoop on AWS. the queue holds at most max_queue_size data;
+    anything past that, or in a batch that fails to send, is dropped and reported as metrics_dropped.
+    """
+
+    # the PutMetricData limit on data per request
+    MAX_BATCH_SIZE = 1000
+
+    def __init__(self, client, namespace: str, max_queue_size: int = 10_000, flush_interval_sec: float = 5):
+        self.client = client
+        self.namespace = namespace
+        self.max_queue_size = max_queue_size
+        self.flush_interval_sec = flush_interval_sec
+        self._queue: Deque[dict] = deque()
+        self.dropped: Dict[str, int] = defaultdict(int)
+        # calls to put_metric_data block, so they get their own thread rather than the IOLoop
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="metrics")
+        self._wakeup: Optional[asyncio.Event] = None
+
+    def put(self, datum: dict) -> None:
+        if len(self._queue) >= self.max_queue_size:
+            self.dropped["queue_full"] += 1
+            return
+        self._queue.append(datum)
+        if len(self._queue) >= self.MAX_BATCH_SIZE and self._wakeup is not None:
+            self._wakeup.set()
+
+    def take_batch(self) -> List[dict]:
+        batch = []
+        for reason, count in self.dropped.items():
+            if count:
+                batch.append(format_datum("metrics_dropped", Unit.COUNT, {"reason": reason}, Value=count))
+        self.dropped.clear()
+        while self._queue and len(batch) < self.MAX_BATCH_SIZE:
+            batch.append(self._queue.popleft())
+        return batch
+
+    async def flush(self) -> None:
+        while self._queue or any(self.dropped.values()):
+            batch = self.take_batch()
+            try:
+                await IOLoop.current().run_in_executor(
+                    self._executor,
+                    functools.partial(self.client.put_metric_data, Namespace=self.namespace, MetricData=batch),
+                )
+            except Exception:
+                logging.exception(f"Failed to send {len(batch)} metric data")
+                self.dropped["send_failed"] += len(batch)
+                # try again next interval, rather than spinning on an error
+                return
+
+    async def run(self) -> None:
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval_sec)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+
+EMITTER = MetricEmitter(LocalMetricsClient() if STAGE == "local" else CloudWatchClient(), SERVICE)
+
+
+def format_datum(name: str, unit: str, tags: Optional[Dict[str, Any]], **value) -> dict:
+    """
+    value is either Value=... or StatisticValues={...}
+    """
+    default_tags = {"stage": STAGE}
+    if tags:
+        default_tags.update(tags)
+    formatted_tags = [{"Name": k, "Value": str(v)} for k, v in default_tags.items()]
+    return {
+        "MetricName": name,
+        "Dimensions": formatted_tags,
+        # data can wait in the queue for a while, so stamp them with when they were recorded
+        "Timestamp": datetime.now(timezone.utc),
+        "Unit": unit,
+        **value,
+    }
+
+
 def write_metric(
     name: str,
     value: float,
     unit: str = Unit.COUNT,
     tags: dict = None,
 ) -> None:
-    if STAGE == "local":
-        logging.info(f"Skipping metric write for name:{name} | value:{value} | tags:{tags}")
-        return
-    default_tags = {"stage": STAGE}
-    if tags:
-        default_tags.update(tags)
-    formatted_tags = [{"Name": k, "Value": str(v)} for k, v in default_tags.items()]
-
-    client.put_metric_data(
-        Namespace=SERVICE,
-        MetricData=[
-            {
-                "MetricName": name,
-                "Dimensions": formatted_tags,
-                "Value": value,
-                "Unit": unit,
-            },
-        ],
-    )
+    EMITTER.put(format_datum(name, unit, tags, Value=value))
 
 
-def write_aggregate_metrics(
+def write_histogram_metrics(
     name: str,
-    values: List[float],
-    unit: str = Unit.COUNT,
+    histogram: LatencyHistogram,
+    unit: str = Unit.MILLISECONDS,
     tags: Dict[str, str] = None,
 ) -> None:
-    if STAGE == "local":
-        logging.info(f"Skipping aggregate metric write for name:{name} | values:{values} | tags:{tags}")
-        return
-    default_tags = {"stage": STAGE}
-    if tags:
-        default_tags.update(tags)
-    formatted_tags = [{"Name": k, "Value": str(v)} for k, v in default_tags.items()]
-
-    client.put_metric_data(
-        Namespace=SERVICE,
-        MetricData=[
-            {
-                "MetricName": name,
-                "Dimensions": formatted_tags,
-                "StatisticValues": {
-                    "SampleCount": len(values),
-                    "Sum": sum(values),
-                    "Minimum": min(values),
-                    "Maximum": max(values),
-                },
-                "Unit": unit,
-            },
-        ],
-    )
+    """
+    publishes the histogram's buckets as Values/Counts, which cloudwatch can compute percentiles from
+    """
+    for values, counts in histogram.values_and_counts(MAX_VALUES_PER_DATUM):
+        EMITTER.put(format_datum(name, unit, tags, Values=values, Counts=counts))
@@ -0,0 +1,247 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from urllib.parse import urlparse
+
+import tornado.locks
+import tornado.util
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.tcpclient import TCPClient
+
+# after a failure, skip the shared cache for this long rather than making every request wait on it
+RETRY_AFTER_SEC = 30
+# connections per client, so a burst of misses doesn't queue behind a single round trip
+MAX_CONNECTIONS = 4
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisUnavailable(Exception):
+    """
+    a command was skipped because the server was marked down, or every connection stayed busy, while it waited.
+    it isn't a failure of the server.
+    """
+
+
+def encode_command(*args: Union[str, bytes, int]) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        if isinstance(arg, int):
+            arg = str(arg)
+        if isinstance(arg, str):
+            arg = arg.encode()
+        parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+
+async def read_reply(stream: IOStream) -> Any:
+    line = await stream.read_until(b"\r\n")
+    prefix, payload = line[:1], line[1:-2]
+    if prefix == b"+":
+        return payload
+    if prefix == b"-":
+        raise RedisError(payload.decode())
+    if prefix == b":":
+        return int(payload)
+    if prefix == b"$":
+        length = int(payload)
+        if length == -1:
+            return None
+        data = await stream.read_bytes(length + 2)
+        return data[:-2]
+    if prefix == b"*":
+        length = int(payload)
+        if length == -1:
+            return None
+        return [await read_reply(stream) for _ in range(length)]
+    raise RedisError(f"unexpected reply: {line!r}")
+
+
+class RedisClient:
+    """
+    minimal client for the redis protocol: a few connections, one command at a time on each.
+    only the round trip on a connection counts against timeout_sec; a command that can't get a connection
+    within it, or finds is_available false once it does, is skipped with RedisUnavailable.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        db: int = 0,
+        timeout_sec: float = 0.05,
+        is_available: Optional[Callable[[], bool]] = None,
+        max_connections: int = MAX_CONNECTIONS,
+    ):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.timeout_sec = timeout_sec
+        self.is_available = is_available
+        self._idle: List[IOStream] = []
+        self._slots = tornado.locks.Semaphore(max_connections)
+
+    async def _connect(self) -> IOStream:
+        stream = await TCPClient().connect(self.host, self.port)
+        if self.db:
+            await stream.write(encode_command("SELECT", self.db))
+            await read_reply(stream)
+        return stream
+
+    async def _checkout(self) -> IOStream:
+        while self._idle:
+            stream = self._idle.pop()
+            if not stream.closed():
+                return stream
+        return await asyncio.wait_for(self._connect(), self.timeout_sec)
+
+    async def _round_trip(self, stream: IOStream, *args: Union[str, bytes, int]) -> Any:
+        await stream.write(encode_command(*args))
+        return await read_reply(stream)
+
+    async def execute(self, *args: Union[str, bytes, int]) -> Any:
+        try:
+            await self._slots.acquire(timeout=timedelta(seconds=self.timeout_sec))
+        except tornado.util.TimeoutError:
+            raise RedisUnavailable()
+        try:
+            # the server may have been marked down while this command waited for a connection
+            if self.is_available is not None and not self.is_available():
+                raise RedisUnavailable()
+            stream = await self._checkout()
+            try:
+                reply = await asyncio.wait_for(self._round_trip(stream, *args), self.timeout_sec)
+            except BaseException:
+                # the connection may be mid-reply, so it can't be reused
+                stream.close()
+                raise
+            self._idle.append(stream)
+            return reply
+        finally:
+            self._slots.release()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.execute("GET", key)
+
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        return await self.execute("MGET", *keys)
+
+    async def set(self, key: str, value: bytes, ttl_sec: int) -> None:
+        await self.execute("SET", key, value, "EX", ttl_sec)
+
+
+class InMemoryRedisClient:
+    """
+    in-process stand-in for RedisClient, for local development and tests
+    """
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[bytes, float]] = {}
+
+    async def get(self, key: str) -> Optional[bytes]:
+        value, expires_at = self._data.get(key, (None, 0.0))
+        if value is None or time.monotonic() >= expires_at:
+            self._data.pop(key, None)
+            return None
+        return value
+
+    async def mget(self, keys: List[str]) -> List[Optional[bytes]]:
+        return [await self.get(key) for key in keys]
+
+    async def set(self, key: str, value: bytes, ttl_sec: int) -> None:
+        self._data[key] = (value, time.monotonic() + ttl_sec)
+
+
+class SharedCache:
+    """
+    cache tier shared by every replica, behind each process' own cache.
+    it's best-effort: if the server is unreachable, reads miss and writes are dropped
+    until RETRY_AFTER_SEC has passed, so requests fall back to local caching and the db.
+    writes can go through their own write_client, so large background sets don't queue ahead of reads.
+    """
+
+    def __init__(
+        self,
+        client: Optional[Union[RedisClient, InMemoryRedisClient]],
+        prefix: str = "",
+        write_client: Optional[Union[RedisClient, InMemoryRedisClient]] = None,
+    ):
+        self.client = client
+        self.write_client = write_client or client
+        self.prefix = prefix
+        self.errors = 0
+        self._down_until = 0.0
+
+    @classmethod
+    def from_url(cls, url: str, prefix: str = "", timeout_sec: float = 0.05) -> "SharedCache":
+        """
+        redis://host:port/db for a redis server, memory:// for an in-process fake, or empty to disable
+        """
+        if not url:
+            return cls(None)
+        parsed = urlparse(url)
+        if parsed.scheme == "memory":
+            return cls(InMemoryRedisClient(), prefix)
+        db = int(parsed.path.lstrip("/") or 0)
+        cache = cls(None, prefix)
+        cache.client, cache.write_client = [
+            RedisClient(parsed.hostname or "localhost", parsed.port or 6379, db, timeout_sec, lambda: cache.is_available)
+            for _ in range(2)
+        ]
+        return cache
+
+    @property
+    def is_available(self) -> bool:
+        return self.client is not None and time.monotonic() >= self._down_until
+
+    def _on_error(self, action: str, key: str) -> None:
+        # concurrent commands that fail with the same outage only count once
+        if not self.is_available:
+            return
+        self.errors += 1
+        self._down_until = time.monotonic() + RETRY_AFTER_SEC
+        logging.warning(f"Shared cache {action} failed for {key}, using local cache only for {RETRY_AFTER_SEC}s")
+
+    async def get(self, key: str) -> Optional[bytes]:
+        if self.client is None or not self.is_available:
+            return None
+        try:
+            return await self.client.get(self.prefix + key)
+        except RedisUnavailable:
+            return None
+        except (OSError, StreamClosedError, RedisError, asyncio.TimeoutError):
+            self._on_error("get", key)
+            return None
+
+    async def get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        """
+        one round trip for several keys; every key misses if the tier is down
+        """
+        if self.client is None or not self.is_available or not keys:
+            return [None] * len(keys)
+        try:
+            return await self.client.mget([self.prefix + key for key in keys])
+        except RedisUnavailable:
+            return [None] * len(keys)
+        except (OSError, StreamClosedError, RedisError, asyncio.TimeoutError):
+            self._on_error("get", ", ".join(keys))
+            return [None] * len(keys)
+
+    async def set(self, key: str, value: bytes, ttl_sec: int) -> None:
+        if self.write_client is None or not self.is_available:
+            return
+        try:
+            await self.write_client.set(self.prefix + key, value, ttl_sec)
+        except RedisUnavailable:
+            return
+        except (OSError, StreamClosedError, RedisError, asyncio.TimeoutError):
+            self._on_error("set", key)
+
+    def flush_errors(self) -> int:
+        errors = self.errors
+        self.errors = 0
+        return errors
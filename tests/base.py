@@ -1,3 +1,6 @@
+from contextlib import contextmanager
+from unittest import mock
+
 import tornado.testing
 from peewee import SqliteDatabase
 from tornado.concurrent import Future
@@ -16,6 +19,16 @@ def recreate_tables(db):
     db.create_tables(MAPPINGS)
 
 
+@contextmanager
+def count_queries():
+    """
+    count the sql statements executed against the test database, e.g.
+    with count_queries() as queries: ... ; assert queries.call_count == 1
+    """
+    with mock.patch.object(database, "execute_sql", wraps=database.execute_sql) as execute_sql:
+        yield execute_sql
+
+
 class BaseTest(tornado.testing.AsyncHTTPTestCase):
     def get_app(self):
         return Application()
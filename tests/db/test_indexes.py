@@ -0,0 +1,71 @@
+import tornado.testing
+
+from db.create_indexes import index_statements
+from db.mappings import database
+from db.mappings.article import Article
+from db.mappings.model import Status, Type
+from db.mappings.recommendation import Rec
+from handlers.recommendation import TTL_CACHE
+from tests.base import BaseTest, count_queries
+from tests.factories.article import ArticleFactory
+from tests.factories.model import ModelFactory
+from tests.factories.recommendation import RecFactory
+
+
+def query_plan(sql: str, params) -> str:
+    return "\n".join(row[-1] for row in database.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params))
+
+
+def test_index_statements__concurrently():
+    statements = dict(index_statements(Rec))
+
+    assert statements["rec_model_id_source_entity_id_score"] == (
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS "rec_model_id_source_entity_id_score" '
+        'ON "recommendation" ("model_id", "source_entity_id", "score")'
+    )
+    assert "article_site_external_id" in dict(index_statements(Article))
+    # only the declared indexes, not the ones peewee adds for foreign keys
+    assert list(statements) == ["rec_model_id_source_entity_id_score"]
+
+
+class TestQueryPlans(BaseTest):
+    """
+    the hot queries, as the handlers run them, search the indexes declared on the mappings rather than scanning
+    """
+
+    def setUp(self) -> None:
+        TTL_CACHE.clear()
+        super().setUp()
+        # enough rows across models, sources and sites that a scan would be the costlier plan
+        self.models = [ModelFactory.create(type=t.value, status=Status.CURRENT.value) for t in Type]
+        articles = [ArticleFactory.create(site=f"site-{i % 3}") for i in range(30)]
+        for model in self.models:
+            for i, article in enumerate(articles):
+                RecFactory.create(
+                    model_id=model["id"], recommended_article_id=article["id"], source_entity_id=str(i % 10)
+                )
+        database.execute_sql("ANALYZE")
+
+    @tornado.testing.gen_test
+    async def test_recs__model_and_source_use_composite_index(self):
+        with count_queries() as queries:
+            response = await self.http_client.fetch(
+                self.get_url(f"/recs?site=site-0&source_entity_id=1&model_id={self.models[0]['id']}")
+            )
+
+        assert response.code == 200
+        plan = query_plan(*queries.call_args_list[0][0])
+        assert "USING INDEX rec_model_id_source_entity_id_score (model_id=? AND source_entity_id=?)" in plan
+        assert "SCAN" not in plan.replace("SCAN CONSTANT ROW", "")
+
+    @tornado.testing.gen_test
+    async def test_model_articles__use_indexes(self):
+        with count_queries() as queries:
+            response = await self.http_client.fetch(self.get_url(f"/models/{self.models[0]['id']}/articles"))
+
+        assert response.code == 200
+        # the model, then its articles in a single query
+        assert queries.call_count == 2
+        plan = query_plan(*queries.call_args_list[1][0])
+        assert "USING COVERING INDEX rec_model_id_source_entity_id_score (model_id=?)" in plan
+        assert "USING INDEX article_site_external_id (site=? AND external_id=?)" in plan
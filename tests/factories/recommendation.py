@@ -1,6 +1,8 @@
 from random import randint, random
+from typing import List
 
 from db.mappings.recommendation import Rec
+from tests.factories.article import ArticleFactory
 from tests.factories.base import BaseFactory
 
 
@@ -13,3 +15,13 @@ class RecFactory(BaseFactory):
             "source_entity_id": str(randint(1000, 9000)),
             "score": random(),
         }
+
+
+def create_recs(model: dict, source_entity_id: str, count: int) -> List[dict]:
+    """
+    count recs of the model for the source article, each to a new article. returns the articles.
+    """
+    articles = [ArticleFactory.create() for _ in range(count)]
+    for article in articles:
+        RecFactory.create(model_id=model["id"], recommended_article_id=article["id"], source_entity_id=source_entity_id)
+    return articles
@@ -0,0 +1,48 @@
+import tornado.testing
+
+from lib.config import config
+from tests.base import BaseTest
+from tests.factories.article import ArticleFactory
+from tests.factories.model import ModelFactory
+from tests.factories.recommendation import RecFactory
+
+
+class TestMetricsHandler(BaseTest):
+    _endpoint = "/metrics"
+
+    @tornado.testing.gen_test
+    async def test_get__requires_admin_token(self):
+        response = await self.http_client.fetch(self.get_url(self._endpoint), method="GET", raise_error=False)
+        assert response.code == 401
+
+        response = await self.http_client.fetch(
+            self.get_url(self._endpoint), method="GET", headers={"Authorization": "wrong"}, raise_error=False
+        )
+        assert response.code == 403
+
+    @tornado.testing.gen_test
+    async def test_get__prometheus_format(self):
+        model = ModelFactory.create()
+        article = ArticleFactory.create()
+        RecFactory.create(model_id=model["id"], recommended_article_id=article["id"], source_entity_id="1")
+        recs_url = self.get_url(f"/recs?site=metrics-site&source_entity_id=1&model_id={model['id']}")
+        for _ in range(2):
+            await self.http_client.fetch(recs_url, method="GET")
+
+        response = await self.http_client.fetch(
+            self.get_url(self._endpoint), method="GET", headers={"Authorization": config.get("ADMIN_TOKEN")}
+        )
+
+        assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        lines = response.body.decode().splitlines()
+        assert "# TYPE total_rec_requests counter" in lines
+        assert 'total_rec_requests{site="metrics-site"} 2' in lines
+        assert 'total_rec_cache_hits{site="metrics-site"} 1' in lines
+        assert 'total_rec_db_hits{site="metrics-site"} 1' in lines
+        assert 'aggregate_latency_ms_count{handler="Rec",site="metrics-site"} 2' in lines
+        assert any(
+            line.startswith('aggregate_latency_ms{handler="Rec",site="metrics-site",quantile="0.99"}') for line in lines
+        )
+        assert any(line.startswith('rec_cache_entries{site="metrics-site"}') for line in lines)
+        assert any(line.startswith('db_pool_connections{state="in_use"}') for line in lines)
+        assert "# TYPE db_executor_wait_time_ms summary" in lines
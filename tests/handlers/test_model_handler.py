@@ -1,11 +1,23 @@
+import asyncio
 import json
+import threading
+import tracemalloc
+from datetime import datetime, timezone
+from unittest import mock
 
+import pytest
 import tornado.testing
-
-from db.mappings.model import Site, Status, Type
-from tests.base import BaseTest
+from tornado.simple_httpclient import HTTPStreamClosedError
+
+from db.helpers import iterate_lazily, update_resources
+from db.mappings import database
+from db.mappings.base import db_proxy
+from db.mappings.model import Model, Site, Status, Type
+from handlers.base import MAX_PAGE_SIZE, encode_cursor
+from lib.db import DBExecutor
+from tests.base import BaseTest, count_queries
 from tests.factories.article import ArticleFactory
-from tests.factories.model import ModelFactory
+from tests.factories.model import DEFAULT_SITE, ModelFactory
 from tests.factories.recommendation import RecFactory
 
 
@@ -71,6 +83,78 @@ class TestModelArticleHandler(BaseTest):
         assert target_article_1["id"] in article_ids
         assert target_article_2["id"] in article_ids
 
+    @tornado.testing.gen_test
+    async def test_get__cursor__walks_every_article(self):
+        model = ModelFactory.create(site=Site.TEXAS_TRIBUNE.value)
+        published = [datetime(2021, 1, 1), datetime(2021, 1, 2), datetime(2021, 1, 2), None, None]
+        articles = [
+            ArticleFactory.create(site=Site.TEXAS_TRIBUNE.value, external_id=str(i), published_at=published_at)
+            for i, published_at in enumerate(published)
+        ]
+        for article in articles:
+            RecFactory.create(
+                model_id=model["id"], source_entity_id=article["external_id"], recommended_article_id=article["id"]
+            )
+
+        pages = []
+        cursor = ""
+        while cursor is not None:
+            response = await self.http_client.fetch(
+                self.get_url(f"{self._endpoint}/{model['id']}/articles?size=2&cursor={cursor}"),
+                method="GET",
+                raise_error=False,
+            )
+            assert response.code == 200
+            results = json.loads(response.body)
+            pages.append([a["id"] for a in results["results"]])
+            cursor = results["next_cursor"]
+
+        # newest first, ties by id, and articles without published_at last
+        assert pages == [
+            [articles[2]["id"], articles[1]["id"]],
+            [articles[0]["id"], articles[4]["id"]],
+            [articles[3]["id"]],
+        ]
+
+    @tornado.testing.gen_test
+    async def test_get__invalid_page__throws_error(self):
+        model = ModelFactory.create()
+
+        for query in ("cursor=not-a-cursor", "cursor=WzFd", f"size={MAX_PAGE_SIZE + 1}", "size=0"):
+            response = await self.http_client.fetch(
+                self.get_url(f"{self._endpoint}/{model['id']}/articles?{query}"),
+                method="GET",
+                raise_error=False,
+            )
+            assert response.code == 400, query
+
+    @tornado.testing.gen_test
+    async def test_get__stream__same_body_as_page(self):
+        model = ModelFactory.create(site=Site.TEXAS_TRIBUNE.value)
+        for i in range(3):
+            article = ArticleFactory.create(
+                site=Site.TEXAS_TRIBUNE.value, external_id=str(i), published_at=datetime(2021, 1, i + 1)
+            )
+            RecFactory.create(model_id=model["id"], source_entity_id=str(i), recommended_article_id=article["id"])
+
+        for query in ("size=2", "size=3"):
+            url = self.get_url(f"{self._endpoint}/{model['id']}/articles?{query}")
+            paged = await self.http_client.fetch(url, method="GET")
+            streamed = await self.http_client.fetch(f"{url}&stream=true", method="GET")
+
+            assert streamed.code == 200
+            assert json.loads(streamed.body) == json.loads(paged.body)
+
+    @tornado.testing.gen_test
+    async def test_get__stream__missing_resource__throws_error(self):
+        response = await self.http_client.fetch(
+            self.get_url(f"{self._endpoint}/1/articles?stream=true"),
+            method="GET",
+            raise_error=False,
+        )
+
+        assert response.code == 404
+
 
 class TestModelHandler(BaseTest):
     _endpoint = "/models"
@@ -128,3 +212,217 @@ class TestModelHandler(BaseTest):
 
         assert len(results["results"]) == 1
         assert results["results"][0]["site"] == "texas-tribune"
+
+    @tornado.testing.gen_test
+    async def test_get__if_none_match__not_modified(self):
+        model = ModelFactory.create(status=Status.CURRENT.value)
+        url = self.get_url(f"{self._endpoint}?status={Status.CURRENT.value}")
+        response = await self.http_client.fetch(url, method="GET", raise_error=False)
+        etag = response.headers["Etag"]
+        assert response.headers["Cache-Control"] == "no-cache"
+
+        with count_queries() as queries:
+            cached_response = await self.http_client.fetch(
+                url, method="GET", headers={"If-None-Match": etag}, raise_error=False
+            )
+        assert cached_response.code == 304
+        assert cached_response.body == b""
+        # only the version query
+        assert queries.call_count == 1
+
+        update_resources(Model, Model.id == model["id"], status=Status.STALE.value)
+        ModelFactory.create(status=Status.CURRENT.value)
+        changed_response = await self.http_client.fetch(
+            url, method="GET", headers={"If-None-Match": etag}, raise_error=False
+        )
+        assert changed_response.code == 200
+        assert changed_response.headers["Etag"] != etag
+
+    async def walk_pages(self, query: str) -> list:
+        pages = []
+        cursor = ""
+        while cursor is not None:
+            response = await self.http_client.fetch(
+                self.get_url(f"{self._endpoint}?{query}&cursor={cursor}"), method="GET", raise_error=False
+            )
+            assert response.code == 200
+            results = json.loads(response.body)
+            pages.append([m["id"] for m in results["results"]])
+            cursor = results["next_cursor"]
+        return pages
+
+    @tornado.testing.gen_test
+    async def test_get__size__is_honored(self):
+        models = [ModelFactory.create() for _ in range(5)]
+
+        pages = await self.walk_pages("size=2")
+
+        # newest first by default
+        ids = [m["id"] for m in reversed(models)]
+        assert pages == [ids[:2], ids[2:4], ids[4:]]
+
+    @tornado.testing.gen_test
+    async def test_get__cursor__stable_under_sort(self):
+        sites = ["b", "a", "b", "a", "c"]
+        models = [ModelFactory.create(site=site) for site in sites]
+
+        pages = await self.walk_pages("size=2&sort_by=site&order_by=asc")
+
+        # ties on site are broken by id, in the same order
+        assert sum(pages, []) == [
+            models[1]["id"],
+            models[3]["id"],
+            models[0]["id"],
+            models[2]["id"],
+            models[4]["id"],
+        ]
+        assert len(pages) == 3
+
+    @tornado.testing.gen_test
+    async def test_get__cursor_for_other_sort__throws_error(self):
+        ModelFactory.create()
+        ModelFactory.create()
+        response = await self.http_client.fetch(self.get_url(f"{self._endpoint}?size=1"), method="GET")
+        cursor = json.loads(response.body)["next_cursor"]
+
+        response = await self.http_client.fetch(
+            self.get_url(f"{self._endpoint}?size=1&order_by=asc&cursor={cursor}"), method="GET", raise_error=False
+        )
+
+        assert response.code == 400
+
+        # malformed values for the right sort
+        for query, values in (
+            ("", [["id"], True, [{"x": 1}]]),
+            ("", [["id"], True, ["not-an-id"]]),
+            ("&sort_by=created_at", [["created_at", "id"], True, [None, 1]]),
+            ("&sort_by=created_at", [["created_at", "id"], True, ["not-a-date", 1]]),
+        ):
+            response = await self.http_client.fetch(
+                self.get_url(f"{self._endpoint}?size=1{query}&cursor={encode_cursor(*values)}"),
+                method="GET",
+                raise_error=False,
+            )
+            assert response.code == 400, values
+
+    @tornado.testing.gen_test
+    async def test_get__etag__only_covers_page(self):
+        oldest = ModelFactory.create()
+        ModelFactory.create()
+        ModelFactory.create()
+        url = self.get_url(f"{self._endpoint}?size=1")
+        etag = (await self.http_client.fetch(url, method="GET")).headers["Etag"]
+
+        # outside the page and the one after it
+        update_resources(Model, Model.id == oldest["id"], status=Status.STALE.value)
+        response = await self.http_client.fetch(url, method="GET", headers={"If-None-Match": etag}, raise_error=False)
+        assert response.code == 304
+
+        ModelFactory.create()
+        response = await self.http_client.fetch(url, method="GET", headers={"If-None-Match": etag}, raise_error=False)
+        assert response.code == 200
+
+    @tornado.testing.gen_test
+    async def test_get__stream__same_body_as_page(self):
+        for site in ["b", "a", "b"]:
+            ModelFactory.create(site=site)
+
+        for query in ("size=2&sort_by=site", "size=3&sort_by=site&order_by=asc"):
+            paged = await self.http_client.fetch(self.get_url(f"{self._endpoint}?{query}"), method="GET")
+            streamed = await self.http_client.fetch(self.get_url(f"{self._endpoint}?{query}&stream=true"), method="GET")
+
+            assert streamed.code == 200
+            assert json.loads(streamed.body) == json.loads(paged.body)
+
+    @tornado.testing.gen_test
+    async def test_get__stream__without_stream_threads__serves_page(self):
+        for site in ["b", "a", "b"]:
+            ModelFactory.create(site=site)
+        inline_executor = DBExecutor(max_workers=0, database=db_proxy)
+        query = "size=2&sort_by=site"
+        paged = await self.http_client.fetch(self.get_url(f"{self._endpoint}?{query}"), method="GET")
+
+        with mock.patch("handlers.base.STREAM_EXECUTOR", inline_executor):
+            streamed = await self.http_client.fetch(self.get_url(f"{self._endpoint}?{query}&stream=true"), method="GET")
+            too_large = await self.http_client.fetch(
+                self.get_url(f"{self._endpoint}?size={MAX_PAGE_SIZE + 1}&stream=true"), method="GET", raise_error=False
+            )
+
+        # rows would be read inline on the IOLoop, which can't also be waiting for the chunks, so it's the paged response
+        assert streamed.code == 200
+        assert json.loads(streamed.body) == json.loads(paged.body)
+        assert too_large.code == 400
+
+    @tornado.testing.gen_test(timeout=60)
+    async def test_get__stream__bounded_memory(self):
+        count = 20_000
+        now = datetime.now(timezone.utc)
+        with database.atomic():
+            for start in range(0, count, 100):
+                rows = [
+                    {"type": Type.ARTICLE.value, "site": DEFAULT_SITE, "created_at": now, "updated_at": now}
+                    for _ in range(start, min(start + 100, count))
+                ]
+                Model.insert_many(rows).execute()
+
+        body_bytes = 0
+        last_chunk = b""
+
+        def on_chunk(chunk: bytes) -> None:
+            nonlocal body_bytes, last_chunk
+            body_bytes += len(chunk)
+            last_chunk = chunk
+
+        tracemalloc.start()
+        try:
+            response = await self.http_client.fetch(
+                self.get_url(f"{self._endpoint}?size={count}&stream=true"),
+                method="GET",
+                streaming_callback=on_chunk,
+                request_timeout=60,
+            )
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert response.code == 200
+        assert last_chunk.endswith(b'], "next_cursor": null}')
+        assert body_bytes > 2 * 1024 * 1024
+        # a few chunks at a time, not the whole page
+        assert peak < body_bytes / 4
+
+    @tornado.testing.gen_test(timeout=30)
+    async def test_get__stream__stalled_client__stops_producer(self):
+        count = 5_000
+        now = datetime.now(timezone.utc)
+        with database.atomic():
+            rows = [{"type": Type.ARTICLE.value, "site": DEFAULT_SITE, "created_at": now, "updated_at": now}] * count
+            for start in range(0, count, 100):
+                Model.insert_many(rows[start : start + 100]).execute()
+
+        rows_read = 0
+        cursor_closed = threading.Event()
+
+        def counting_iterate_lazily(query):
+            nonlocal rows_read
+            try:
+                for row in iterate_lazily(query):
+                    rows_read += 1
+                    yield row
+            finally:
+                cursor_closed.set()
+
+        # a client that never reads, so no flush completes
+        with mock.patch("handlers.base.iterate_lazily", counting_iterate_lazily), mock.patch(
+            "handlers.base.STREAM_WRITE_TIMEOUT_SEC", 0.1
+        ), mock.patch(
+            "handlers.base.APIHandler.flush",
+            side_effect=lambda *args, **kwargs: asyncio.get_running_loop().create_future(),
+        ):
+            with pytest.raises(HTTPStreamClosedError):
+                await self.http_client.fetch(self.get_url(f"{self._endpoint}?size={count}&stream=true"), method="GET")
+            while not cursor_closed.is_set():
+                await asyncio.sleep(0.01)
+
+        # the producer stopped once the buffered chunks were full
+        assert rows_read < count
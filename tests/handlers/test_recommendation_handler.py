@@ -1,16 +1,38 @@
+import asyncio
+import gzip
 import json
+import time
+from unittest import mock
 
 import tornado.testing
 
-from db.mappings.model import Status, Type
-from handlers.recommendation import TTL_CACHE
+from db.current_models import CURRENT_MODELS
+from db.helpers import update_resources
+from db.mappings.model import Model, Status, Type
+from db.mappings.recommendation import Rec
+from db.rec_index import REC_INDEX
+from handlers.base import STAGE_LATENCY_HISTOGRAMS
+from handlers.recommendation import (
+    CACHE_HIT_COUNTER,
+    CACHE_MISS_COUNTER,
+    CACHE_STALE_HIT_COUNTER,
+    COALESCED_COUNTER,
+    MAX_BATCH_SIZE,
+    SHARED_CACHE_HIT_COUNTER,
+    TTL_CACHE,
+    DefaultRecs,
+    RecHandler,
+)
+from lib.compression import compress
 from lib.config import config
-from tests.base import BaseTest
+from lib.shared_cache import SharedCache
+from tests.base import BaseTest, count_queries
 from tests.factories.article import ArticleFactory
 from tests.factories.model import ModelFactory
-from tests.factories.recommendation import RecFactory
+from tests.factories.recommendation import RecFactory, create_recs
 
 MAX_PAGE_SIZE = config.get("MAX_PAGE_SIZE")
+DEFAULT_SITE = config.get("DEFAULT_SITE")
 
 
 class TestRecHandler(BaseTest):
@@ -18,6 +40,16 @@ class TestRecHandler(BaseTest):
 
     def setUp(self) -> None:
         TTL_CACHE.clear()
+        DefaultRecs._recs.clear()
+        DefaultRecs._last_updated.clear()
+        for counter in (
+            COALESCED_COUNTER,
+            CACHE_HIT_COUNTER,
+            CACHE_STALE_HIT_COUNTER,
+            CACHE_MISS_COUNTER,
+            SHARED_CACHE_HIT_COUNTER,
+        ):
+            counter.clear()
         super().setUp()
 
     @tornado.testing.gen_test
@@ -463,9 +495,536 @@ class TestRecHandler(BaseTest):
 
         # different request
         await self.http_client.fetch(
-            self.get_url(f"{self._endpoint}?site={site}&size={size + 1}"),
+            self.get_url(f"{self._endpoint}?site={site}&size={size}&source_entity_id=1"),
             method="GET",
             raise_error=False,
         )
 
         assert len(TTL_CACHE.keys()) == 2
+
+    @tornado.testing.gen_test
+    async def test_get__variant_requests__share_cache_entry(self):
+        model = ModelFactory.create()
+        articles = [ArticleFactory.create() for _ in range(4)]
+        for article in articles:
+            RecFactory.create(model_id=model["id"], recommended_article_id=article["id"], source_entity_id="1")
+
+        base_url = f"{self._endpoint}?source_entity_id=1&model_id={model['id']}"
+        response = await self.http_client.fetch(self.get_url(base_url), method="GET", raise_error=False)
+        all_results = json.loads(response.body)["results"]
+
+        with count_queries() as queries:
+            response = await self.http_client.fetch(
+                self.get_url(f"{base_url}&size=2&exclude={articles[0]['external_id']}&sort_by=score&order_by=asc"),
+                method="GET",
+                raise_error=False,
+            )
+            # model_type is ignored when model_id is given
+            await self.http_client.fetch(
+                self.get_url(f"{base_url}&model_type={Type.USER.value}"), method="GET", raise_error=False
+            )
+
+        assert queries.call_count == 0
+        assert len(TTL_CACHE.keys()) == 1
+        results = json.loads(response.body)["results"]
+        expected = sorted(
+            [r for r in all_results if r["recommended_article"]["id"] != articles[0]["id"]],
+            key=lambda r: r["score"],
+        )[:2]
+        assert results == expected
+
+    @tornado.testing.gen_test
+    async def test_get__single_query_regardless_of_size(self):
+        model = ModelFactory.create()
+        for _ in range(10):
+            article = ArticleFactory.create()
+            RecFactory.create(model_id=model["id"], recommended_article_id=article["id"], source_entity_id="1")
+
+        for size in (1, 10):
+            TTL_CACHE.clear()
+            with count_queries() as queries:
+                response = await self.http_client.fetch(
+                    self.get_url(f"{self._endpoint}?source_entity_id=1&model_id={model['id']}&size={size}"),
+                    method="GET",
+                    raise_error=False,
+                )
+
+            assert response.code == 200
+            results = json.loads(response.body)
+            assert len(results["results"]) == size
+            assert results["results"][0]["model"]["id"] == model["id"]
+            assert "external_id" in results["results"][0]["recommended_article"]
+            assert queries.call_count == 1
+
+    @tornado.testing.gen_test
+    async def test_get__default_recs__single_query(self):
+        popularity_model = ModelFactory.create(type=Type.POPULARITY.value)
+        for _ in range(5):
+            article = ArticleFactory.create()
+            RecFactory.create(model_id=popularity_model["id"], recommended_article_id=article["id"])
+
+        with count_queries() as queries:
+            response = await self.http_client.fetch(
+                self.get_url(f"{self._endpoint}?source_entity_id=missing&model_type={Type.ARTICLE.value}"),
+                method="GET",
+                raise_error=False,
+            )
+
+        assert response.code == 200
+        results = json.loads(response.body)
+        assert len(results["results"]) == 5
+        assert all(r["model"]["id"] == popularity_model["id"] for r in results["results"])
+        # one query for the cache miss, one to refresh the default recs
+        assert queries.call_count == 2
+
+    @tornado.testing.gen_test
+    async def test_get__concurrent_misses__coalesced(self):
+        model = ModelFactory.create()
+        article = ArticleFactory.create()
+        RecFactory.create(model_id=model["id"], recommended_article_id=article["id"], source_entity_id="1")
+        query_results = RecHandler.query_results
+
+        def slow_query_results(*args, **kwargs):
+            time.sleep(0.05)
+            return query_results(*args, **kwargs)
+
+        url = self.get_url(f"{self._endpoint}?source_entity_id=1&model_id={model['id']}")
+        with mock.patch.object(RecHandler, "query_results", autospec=True, side_effect=slow_query_results) as query:
+            responses = await asyncio.gather(
+                *[self.http_client.fetch(url, method="GET", raise_error=False) for _ in range(5)]
+            )
+
+        assert query.call_count == 1
+        assert all(json.loads(r.body)["results"][0]["id"] for r in responses)
+        assert COALESCED_COUNTER[DEFAULT_SITE] == 4
+
+    @tornado.testing.gen_test
+    async def test_get__stale_entry__served_then_refreshed(self):
+        model = ModelFactory.create()
+        article = ArticleFactory.create()
+        RecFactory.create(model_id=model["id"], recommended_article_id=article["id"], source_entity_id="1")
+        url = self.get_url(f"{self._endpoint}?source_entity_id=1&model_id={model['id']}")
+        await self.http_client.fetch(url, method="GET", raise_error=False)
+
+        RecFactory.create(model_id=model["id"], recommended_article_id=article["id"], source_entity_id="1")
+        (key,) = TTL_CACHE.keys()
+        TTL_CACHE[key] = TTL_CACHE[key]._replace(stale_at=TTL_CACHE.timer())
+
+        stale_response = await self.http_client.fetch(url, method="GET", raise_error=False)
+        assert len(json.loads(stale_response.body)["results"]) == 1
+        assert CACHE_STALE_HIT_COUNTER[DEFAULT_SITE] == 1
+
+        # the background refresh repopulates the entry
+        for _ in range(100):
+            if not TTL_CACHE.is_stale(TTL_CACHE[key]):
+                break
+            await asyncio.sleep(0.01)
+        fresh_response = await self.http_client.fetch(url, method="GET", raise_error=False)
+        assert len(json.loads(fresh_response.body)["results"]) == 2
+        assert CACHE_HIT_COUNTER[DEFAULT_SITE] == 1
+        assert CACHE_MISS_COUNTER[DEFAULT_SITE] == 1
+
+    @tornado.testing.gen_test
+    async def test_get__cache_hit__writes_pre_encoded_json(self):
+        model = ModelFactory.create()
+        for _ in range(3):
+            article = ArticleFactory.create()
+            RecFactory.create(model_id=model["id"], recommended_article_id=article["id"], source_entity_id="1")
+        url = self.get_url(f"{self._endpoint}?source_entity_id=1&model_id={model['id']}&size=2")
+        miss_response = await self.http_client.fetch(url, method="GET", raise_error=False)
+
+        with mock.patch("handlers.base.json.dumps") as dumps:
+            hit_response = await self.http_client.fetch(url, method="GET", raise_error=False)
+
+        dumps.assert_not_called()
+        assert hit_response.body == miss_response.body
+        results = json.loads(hit_response.body)["results"]
+        assert len(results) == 2
+        assert hit_response.body == json.dumps({"results": results}).encode()
+
+    @tornado.testing.gen_test
+    async def test_get__local_miss__served_from_shared_cache(self):
+        model = ModelFactory.create()
+        for _ in range(3):
+            article = ArticleFactory.create()
+            RecFactory.create(model_id=model["id"], recommended_article_id=article["id"], source_entity_id="1")
+        url = self.get_url(f"{self._endpoint}?source_entity_id=1&model_id={model['id']}&sort_by=score&order_by=asc")
+
+        with mock.patch("handlers.recommendation.SHARED_CACHE", SharedCache.from_url("memory://")) as shared_cache:
+            db_response = await self.http_client.fetch(url, method="GET", raise_error=False)
+            # the shared write happens in the background
+            for _ in range(100):
+                if shared_cache.client._data:
+                    break
+                await asyncio.sleep(0.01)
+
+            # as if the request had landed on another replica
+            TTL_CACHE.clear()
+            with count_queries() as queries:
+                shared_response = await self.http_client.fetch(url, method="GET", raise_error=False)
+
+        assert queries.call_count == 0
+        assert shared_response.body == db_response.body
+        assert SHARED_CACHE_HIT_COUNTER[DEFAULT_SITE] == 1
+
+    @tornado.testing.gen_test
+    async def test_get__if_none_match__not_modified(self):
+        model = ModelFactory.create()
+        for _ in range(3):
+            article = ArticleFactory.create()
+            RecFactory.create(model_id=model["id"], recommended_article_id=article["id"], source_entity_id="1")
+        url = self.get_url(f"{self._endpoint}?source_entity_id=1&model_id={model['id']}")
+        response = await self.http_client.fetch(url, method="GET", raise_error=False)
+        etag = response.headers["Etag"]
+        assert response.headers["Cache-Control"] == "public, max-age=900"
+
+        with count_queries() as queries, mock.patch("handlers.base.json.dumps") as dumps:
+            cached_response = await self.http_client.fetch(
+                url, method="GET", headers={"If-None-Match": etag}, raise_error=False
+            )
+        assert cached_response.code == 304
+        assert cached_response.body == b""
+        assert queries.call_count == 0
+        dumps.assert_not_called()
+
+        # other filters are a different response
+        sized_response = await self.http_client.fetch(
+            f"{url}&size=2", method="GET", headers={"If-None-Match": etag}, raise_error=False
+        )
+        assert sized_response.code == 200
+        assert sized_response.headers["Etag"] != etag
+
+        # retraining the model bumps its updated_at
+        update_resources(Model, Model.id == model["id"], status=Status.CURRENT.value)
+        TTL_CACHE.clear()
+        retrained_response = await self.http_client.fetch(
+            url, method="GET", headers={"If-None-Match": etag}, raise_error=False
+        )
+        assert retrained_response.code == 200
+        assert retrained_response.headers["Etag"] != etag
+
+    @tornado.testing.gen_test
+    async def test_get__accept_encoding__compressed_once_per_entry(self):
+        model = ModelFactory.create()
+        for _ in range(5):
+            article = ArticleFactory.create()
+            RecFactory.create(model_id=model["id"], recommended_article_id=article["id"], source_entity_id="1")
+        url = self.get_url(f"{self._endpoint}?source_entity_id=1&model_id={model['id']}")
+        raw_response = await self.http_client.fetch(url, method="GET", decompress_response=False)
+        assert "Content-Encoding" not in raw_response.headers
+
+        with mock.patch("handlers.base.compress", wraps=compress) as compress_body:
+            responses = [
+                await self.http_client.fetch(
+                    url, method="GET", headers={"Accept-Encoding": "gzip"}, decompress_response=False
+                )
+                for _ in range(3)
+            ]
+
+        assert compress_body.call_count == 1
+        for response in responses:
+            assert response.headers["Content-Encoding"] == "gzip"
+            assert response.headers["Vary"] == "Accept-Encoding"
+            assert gzip.decompress(response.body) == raw_response.body
+            assert len(response.body) < len(raw_response.body)
+        assert responses[0].headers["Etag"] != raw_response.headers["Etag"]
+
+    @tornado.testing.gen_test
+    async def test_get__server_timing(self):
+        model = ModelFactory.create()
+        article = ArticleFactory.create()
+        RecFactory.create(model_id=model["id"], recommended_article_id=article["id"], source_entity_id="1")
+        url = self.get_url(f"{self._endpoint}?source_entity_id=1&model_id={model['id']}")
+        STAGE_LATENCY_HISTOGRAMS.clear()
+
+        def stages(response) -> list:
+            return [timing.split(";")[0] for timing in response.headers["Server-Timing"].split(", ")]
+
+        miss_response = await self.http_client.fetch(url, method="GET")
+        assert stages(miss_response) == ["parse", "cache", "shared_cache", "db", "serialize", "encode", "filter", "total"]
+        hit_response = await self.http_client.fetch(url, method="GET")
+        assert stages(hit_response) == ["parse", "cache", "filter", "encode", "total"]
+
+        assert STAGE_LATENCY_HISTOGRAMS[("Rec", "n/a", "db")].count == 1
+        assert STAGE_LATENCY_HISTOGRAMS[("Rec", "n/a", "cache")].count == 2
+
+        with mock.patch("handlers.base.SERVER_TIMING_ENABLED", False):
+            response = await self.http_client.fetch(url, method="GET")
+        assert "Server-Timing" not in response.headers
+
+
+class TestRecHandlerWithIndex(BaseTest):
+    _endpoint = "/recs"
+
+    def setUp(self) -> None:
+        TTL_CACHE.clear()
+        REC_INDEX.clear()
+        super().setUp()
+
+    def tearDown(self) -> None:
+        REC_INDEX.clear()
+        super().tearDown()
+
+    @tornado.testing.gen_test
+    async def test_get__matches_db_results(self):
+        model = ModelFactory.create(type=Type.ARTICLE.value)
+        articles = create_recs(model, "1", 5)
+        url = self.get_url(
+            f"{self._endpoint}?source_entity_id=1&model_type={Type.ARTICLE.value}"
+            f"&exclude={articles[0]['external_id']}&sort_by=score&size=3"
+        )
+
+        db_response = await self.http_client.fetch(url, method="GET", raise_error=False)
+        await REC_INDEX.refresh()
+        with count_queries() as queries:
+            index_response = await self.http_client.fetch(url, method="GET", raise_error=False)
+
+        assert index_response.code == 200
+        assert queries.call_count == 0
+        assert json.loads(index_response.body) == json.loads(db_response.body)
+
+    @tornado.testing.gen_test
+    async def test_get__falls_back_to_db_for_non_current_model(self):
+        current_mdl = ModelFactory.create(type=Type.ARTICLE.value)
+        create_recs(current_mdl, "1", 2)
+        stale_mdl = ModelFactory.create(type=Type.ARTICLE.value, status=Status.STALE.value)
+        create_recs(stale_mdl, "1", 3)
+        await REC_INDEX.refresh()
+
+        with count_queries() as queries:
+            response = await self.http_client.fetch(
+                self.get_url(f"{self._endpoint}?source_entity_id=1&model_id={stale_mdl['id']}"),
+                method="GET",
+                raise_error=False,
+            )
+
+        assert queries.call_count == 1
+        results = json.loads(response.body)["results"]
+        assert len(results) == 3
+        assert {r["model"]["id"] for r in results} == {stale_mdl["id"]}
+
+    @tornado.testing.gen_test
+    async def test_refresh__skips_recs_without_article(self):
+        model = ModelFactory.create(type=Type.ARTICLE.value)
+        articles = create_recs(model, "1", 2)
+        # e.g. a rec written after its article was deleted
+        Rec.insert(
+            model=model["id"], recommended_article=articles[-1]["id"] + 1000, source_entity_id="1", score=0.5
+        ).execute()
+        await REC_INDEX.refresh()
+
+        results = REC_INDEX.lookup(DEFAULT_SITE, "1", model_type=Type.ARTICLE.value)
+        assert {r["recommended_article"]["id"] for r in results} == {article["id"] for article in articles}
+
+    @tornado.testing.gen_test
+    async def test_refresh__reloads_after_promotion(self):
+        old_mdl = ModelFactory.create(type=Type.ARTICLE.value)
+        create_recs(old_mdl, "1", 2)
+        new_mdl = ModelFactory.create(type=Type.ARTICLE.value, status=Status.PENDING.value)
+        create_recs(new_mdl, "1", 4)
+        await REC_INDEX.refresh()
+        assert len(REC_INDEX.lookup(DEFAULT_SITE, "1", model_type=Type.ARTICLE.value)) == 2
+
+        # unchanged models don't trigger a rebuild
+        with count_queries() as queries:
+            await REC_INDEX.refresh()
+        assert queries.call_count == 1
+
+        update_resources(Model, Model.id == old_mdl["id"], status=Status.STALE.value)
+        update_resources(Model, Model.id == new_mdl["id"], status=Status.CURRENT.value)
+        await REC_INDEX.refresh()
+
+        results = REC_INDEX.lookup(DEFAULT_SITE, "1", model_type=Type.ARTICLE.value)
+        assert len(results) == 4
+        assert {r["model"]["id"] for r in results} == {new_mdl["id"]}
+
+
+class TestRecHandlerWithCurrentModels(BaseTest):
+    _endpoint = "/recs"
+
+    def setUp(self) -> None:
+        TTL_CACHE.clear()
+        DefaultRecs._recs.clear()
+        DefaultRecs._last_updated.clear()
+        CURRENT_MODELS.clear()
+        super().setUp()
+
+    def tearDown(self) -> None:
+        CURRENT_MODELS.clear()
+        super().tearDown()
+
+    @tornado.testing.gen_test
+    async def test_get__model_type__filters_on_current_model_id(self):
+        model = ModelFactory.create(type=Type.ARTICLE.value)
+        create_recs(model, "1", 3)
+        ModelFactory.create(type=Type.ARTICLE.value, site="other-site")
+        create_recs(ModelFactory.create(type=Type.ARTICLE.value, status=Status.STALE.value), "1", 2)
+        url = self.get_url(f"{self._endpoint}?source_entity_id=1&model_type={Type.ARTICLE.value}")
+        joined_response = await self.http_client.fetch(url, method="GET")
+        TTL_CACHE.clear()
+        await CURRENT_MODELS.refresh()
+
+        with count_queries() as queries:
+            response = await self.http_client.fetch(url, method="GET")
+
+        assert json.loads(response.body) == json.loads(joined_response.body)
+        assert len(json.loads(response.body)["results"]) == 3
+        assert queries.call_count == 1
+        sql = queries.call_args[0][0]
+        assert '"model"' not in sql
+        assert '"model_id" IN' in sql
+
+    @tornado.testing.gen_test
+    async def test_get__model_type__no_current_model_skips_db(self):
+        popularity_model = ModelFactory.create(type=Type.POPULARITY.value)
+        create_recs(popularity_model, "1", 2)
+        await CURRENT_MODELS.refresh()
+
+        with count_queries() as queries:
+            response = await self.http_client.fetch(
+                self.get_url(f"{self._endpoint}?source_entity_id=1&model_type={Type.USER.value}"), method="GET"
+            )
+
+        # falls back to the default recs, which are fetched without joining the model table either
+        results = json.loads(response.body)["results"]
+        assert [r["model"] for r in results] == [popularity_model] * 2
+        assert queries.call_count == 1
+        assert '"model"' not in queries.call_args[0][0]
+
+    @tornado.testing.gen_test
+    async def test_get__invalid_model_type__rejected_without_db(self):
+        with count_queries() as queries:
+            response = await self.http_client.fetch(
+                self.get_url(f"{self._endpoint}?source_entity_id=1&model_type=articles"),
+                method="GET",
+                raise_error=False,
+            )
+
+        assert response.code == 400
+        assert "model_type" in json.loads(response.body)["message"]
+        assert queries.call_count == 0
+
+    @tornado.testing.gen_test
+    async def test_refresh__picks_up_promoted_model(self):
+        old_mdl = ModelFactory.create(type=Type.ARTICLE.value)
+        new_mdl = ModelFactory.create(type=Type.ARTICLE.value, status=Status.PENDING.value)
+        await CURRENT_MODELS.refresh()
+        assert list(CURRENT_MODELS.get(DEFAULT_SITE, Type.ARTICLE.value)) == [old_mdl["id"]]
+
+        update_resources(Model, Model.id == old_mdl["id"], status=Status.STALE.value)
+        update_resources(Model, Model.id == new_mdl["id"], status=Status.CURRENT.value)
+        await CURRENT_MODELS.refresh()
+
+        assert list(CURRENT_MODELS.get(DEFAULT_SITE, Type.ARTICLE.value)) == [new_mdl["id"]]
+        assert CURRENT_MODELS.get("other-site", Type.ARTICLE.value) == {}
+
+
+class TestRecBatchHandler(BaseTest):
+    _endpoint = "/recs/batch"
+
+    def setUp(self) -> None:
+        TTL_CACHE.clear()
+        DefaultRecs._recs.clear()
+        DefaultRecs._last_updated.clear()
+        super().setUp()
+
+    async def post(self, source_entity_ids, query: str = ""):
+        return await self.http_client.fetch(
+            self.get_url(f"{self._endpoint}?{query}"),
+            method="POST",
+            body=json.dumps({"source_entity_ids": source_entity_ids}),
+            raise_error=False,
+        )
+
+    @tornado.testing.gen_test
+    async def test_post__matches_single_requests(self):
+        model = ModelFactory.create()
+        for source_entity_id, count in (("1", 3), ("2", 2)):
+            create_recs(model, source_entity_id, count)
+        query = f"model_id={model['id']}&size=2&sort_by=score&order_by=asc"
+
+        response = await self.post(["1", "2"], query)
+
+        assert response.code == 200
+        results = json.loads(response.body)["results"]
+        assert list(results) == ["1", "2"]
+        for source_entity_id in ("1", "2"):
+            single_response = await self.http_client.fetch(
+                self.get_url(f"/recs?source_entity_id={source_entity_id}&{query}"), method="GET"
+            )
+            assert results[source_entity_id] == json.loads(single_response.body)["results"]
+
+    @tornado.testing.gen_test
+    async def test_post__misses_fetched_with_one_query(self):
+        model = ModelFactory.create()
+        for source_entity_id in ("1", "2", "3"):
+            create_recs(model, source_entity_id, 2)
+        query = f"model_type={model['type']}"
+        # "1" is already cached by a single request
+        await self.http_client.fetch(self.get_url(f"/recs?source_entity_id=1&{query}"), method="GET")
+
+        with count_queries() as queries:
+            miss_response = await self.post(["1", "2", "3"], query)
+        assert queries.call_count == 1
+
+        with count_queries() as queries:
+            hit_response = await self.post(["3", "2", "1"], query)
+        assert queries.call_count == 0
+
+        miss_results = json.loads(miss_response.body)["results"]
+        hit_results = json.loads(hit_response.body)["results"]
+        assert list(hit_results) == ["3", "2", "1"]
+        assert hit_results == miss_results
+        assert all(len(results) == 2 for results in hit_results.values())
+
+    @tornado.testing.gen_test
+    async def test_post__no_recs__default_recs(self):
+        model = ModelFactory.create()
+        create_recs(model, "1", 2)
+        popularity_model = ModelFactory.create(type=Type.POPULARITY.value)
+        create_recs(popularity_model, "popular", 4)
+
+        with count_queries() as queries:
+            response = await self.post(["1", "missing", "also-missing"], f"model_id={model['id']}")
+
+        results = json.loads(response.body)["results"]
+        assert [r["model"]["id"] for r in results["1"]] == [model["id"]] * 2
+        assert [r["model"]["id"] for r in results["missing"]] == [popularity_model["id"]] * 4
+        assert results["also-missing"] == results["missing"]
+        # one query for the batch, one to refresh the default recs
+        assert queries.call_count == 2
+
+    @tornado.testing.gen_test
+    async def test_post__invalid_body(self):
+        for body in ("not json", json.dumps({"source_entity_ids": []}), json.dumps({"source_entity_ids": "1"})):
+            response = await self.http_client.fetch(
+                self.get_url(self._endpoint), method="POST", body=body, raise_error=False
+            )
+            assert response.code == 400
+
+        response = await self.post([str(x) for x in range(MAX_BATCH_SIZE + 1)])
+        assert response.code == 400
+        assert "source_entity_ids" in json.loads(response.body)["message"]
+
+    @tornado.testing.gen_test
+    async def test_post__invalid_filters(self):
+        response = await self.post(["1"], "exclude=a")
+
+        assert response.code == 400
+
+    @tornado.testing.gen_test
+    async def test_get__not_allowed(self):
+        response = await self.http_client.fetch(
+            self.get_url(f"{self._endpoint}?site={DEFAULT_SITE}"), method="GET", raise_error=False
+        )
+
+        assert response.code == 405
+
+    @tornado.testing.gen_test
+    async def test_options__allows_post(self):
+        response = await self.http_client.fetch(self.get_url(self._endpoint), method="OPTIONS", raise_error=False)
+
+        assert response.code == 204
+        assert response.headers["Access-Control-Allow-Origin"] == "*"
+        assert response.headers["Access-Control-Allow-Methods"] == "POST"
+        assert response.headers["Access-Control-Allow-Headers"] == "Content-Type"
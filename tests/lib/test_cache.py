@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+import tornado.testing
+
+from lib.cache import SingleFlight, StaleWhileRevalidateCache, deep_getsizeof
+
+
+class TestSingleFlight(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    async def test_run__coalesces_concurrent_calls(self):
+        single_flight = SingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "result"
+
+        results = await asyncio.gather(*[single_flight.run("key", fetch) for _ in range(5)])
+
+        assert results == ["result"] * 5
+        assert len(calls) == 1
+        assert "key" not in single_flight
+
+        # once the first call completes, the next one runs again
+        await single_flight.run("key", fetch)
+        assert len(calls) == 2
+
+    @tornado.testing.gen_test
+    async def test_run__shares_errors(self):
+        single_flight = SingleFlight()
+
+        async def fetch():
+            await asyncio.sleep(0.01)
+            raise ValueError("db is down")
+
+        results = await asyncio.gather(*[single_flight.run("key", fetch) for _ in range(3)], return_exceptions=True)
+
+        assert all(isinstance(result, ValueError) for result in results)
+        with pytest.raises(ValueError):
+            await single_flight.run("key", fetch)
+
+
+class TestStaleWhileRevalidateCache:
+    def make_cache(self, maxsize: int) -> StaleWhileRevalidateCache:
+        return StaleWhileRevalidateCache(maxsize, soft_ttl=60, hard_ttl=120, partition_of=lambda key: key[0])
+
+    def test_put__evicts_to_stay_under_byte_budget(self):
+        cache = self.make_cache(maxsize=250)
+        cache.put(("site1", "1"), "a", size=100)
+        cache.put(("site1", "2"), "b", size=100)
+        cache.put(("site2", "1"), "c", size=100)
+
+        assert cache.currsize == 200
+        assert ("site1", "1") not in cache
+        assert cache.flush_stats() == {
+            "site1": {"bytes": 100, "entries": 1, "evictions": 1},
+            "site2": {"bytes": 100, "entries": 1, "evictions": 0},
+        }
+        # evictions are reset on flush, sizes aren't
+        assert cache.flush_stats()["site1"] == {"bytes": 100, "entries": 1, "evictions": 0}
+
+    def test_put__measures_entries_and_skips_oversized(self):
+        cache = self.make_cache(maxsize=10_000)
+        results = [{"id": i, "title": "x" * 100} for i in range(10)]
+        cache.put(("site1", "1"), results)
+
+        assert cache[("site1", "1")].size == deep_getsizeof(results)
+        assert deep_getsizeof(results) > 10 * 100
+
+        cache.put(("site1", "2"), "x" * 20_000)
+        assert ("site1", "2") not in cache
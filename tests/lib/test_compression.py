@@ -0,0 +1,42 @@
+import gzip
+from unittest import mock
+
+import pytest
+
+from lib.compression import compress, negotiate_encoding
+
+
+@pytest.mark.parametrize(
+    "accept_encoding,expected",
+    [
+        ("", None),
+        ("identity", None),
+        ("gzip", "gzip"),
+        ("deflate, gzip;q=0.5", "gzip"),
+        ("gzip;q=0", None),
+        ("GZIP", "gzip"),
+        ("*", "gzip"),
+        ("*, gzip;q=0", None),
+        ("gzip;q=bad", None),
+    ],
+)
+def test_negotiate_encoding(accept_encoding, expected):
+    with mock.patch("lib.compression.ENCODINGS", ["gzip"]):
+        assert negotiate_encoding(accept_encoding) == expected
+
+
+def test_negotiate_encoding__prefers_br_when_available():
+    with mock.patch("lib.compression.ENCODINGS", ["br", "gzip"]):
+        assert negotiate_encoding("gzip, deflate, br") == "br"
+        assert negotiate_encoding("gzip, br;q=0.5") == "gzip"
+
+
+def test_compress__gzip_round_trip():
+    body = b'{"results": []}' * 100
+
+    assert gzip.decompress(compress(body, "gzip")) == body
+
+
+def test_compress__unsupported():
+    with pytest.raises(ValueError):
+        compress(b"", "deflate")
@@ -0,0 +1,76 @@
+import os
+from unittest import mock
+
+import pytest
+
+from lib.config import Config
+
+
+def parameters_response(names, invalid=()):
+    return {
+        "Parameters": [{"Name": name, "Value": f'"{name}-value"'} for name in names if name not in invalid],
+        "InvalidParameters": [name for name in names if name in invalid],
+    }
+
+
+def test_get_secrets__batches_names():
+    client = mock.Mock()
+    client.get_parameters.side_effect = lambda Names, WithDecryption: parameters_response(Names)
+    keys = [f"/dev/secret-{i}" for i in range(12)]
+
+    with mock.patch("lib.config.aws_client", return_value=client):
+        secrets = Config.get_secrets(keys)
+
+    assert client.get_parameters.call_count == 2
+    assert [len(call.kwargs["Names"]) for call in client.get_parameters.call_args_list] == [10, 2]
+    # values are parsed as json where possible
+    assert secrets["/dev/secret-11"] == "/dev/secret-11-value"
+
+
+def test_get_secrets__missing_parameter_raises():
+    client = mock.Mock()
+    client.get_parameters.return_value = parameters_response(["/dev/a", "/dev/b"], invalid=["/dev/b"])
+
+    with mock.patch("lib.config.aws_client", return_value=client):
+        with pytest.raises(ValueError, match="/dev/b"):
+            Config.get_secrets(["/dev/a", "/dev/b"])
+
+
+def resolve_all(keys):
+    return {key: f"{key}-value" for key in keys}
+
+
+def test_load_env__reuses_cached_config(tmp_path):
+    cache_path = str(tmp_path / "config.json")
+
+    with mock.patch("lib.config.CONFIG_CACHE_PATH", cache_path):
+        with mock.patch.object(Config, "get_secrets", side_effect=resolve_all) as get_secrets:
+            first = Config()
+            second = Config()
+
+    assert get_secrets.call_count == 1
+    assert second._config == first._config
+    assert first.get("DB_PASSWORD") == "/dev/database/password-value"
+    assert os.stat(cache_path).st_mode & 0o777 == 0o600
+
+
+def test_load_env__expired_cache_is_refreshed(tmp_path):
+    cache_path = str(tmp_path / "config.json")
+
+    with mock.patch("lib.config.CONFIG_CACHE_PATH", cache_path):
+        with mock.patch.object(Config, "get_secrets", side_effect=resolve_all) as get_secrets:
+            Config()
+            with mock.patch("lib.config.time.time", return_value=float("inf")):
+                Config()
+
+    assert get_secrets.call_count == 2
+
+
+def test_load_env__never_caches_in_prod(tmp_path):
+    cache_path = str(tmp_path / "config.json")
+
+    with mock.patch("lib.config.CONFIG_CACHE_PATH", cache_path), mock.patch("lib.config.STAGE", "prod"):
+        with mock.patch.object(Config, "get_secrets", side_effect=resolve_all):
+            assert Config().get("DB_PASSWORD") == "/prod/database/password-value"
+
+    assert not os.path.exists(cache_path)
@@ -0,0 +1,136 @@
+import asyncio
+import threading
+import time
+from unittest import mock
+
+import tornado.testing
+from peewee import SqliteDatabase
+from playhouse.pool import _PooledSqliteDatabase
+
+from lib.db import ConnectionCounter, DBExecutor, InstrumentedPool
+
+
+class PooledSqliteDatabase(InstrumentedPool, _PooledSqliteDatabase, ConnectionCounter, SqliteDatabase):
+    pass
+
+
+def make_pool(**kwargs) -> PooledSqliteDatabase:
+    return PooledSqliteDatabase(":memory:", max_connections=4, **kwargs)
+
+
+class TestDBExecutor(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    async def test_run__off_ioloop_thread(self):
+        executor = DBExecutor(max_workers=1)
+        release = threading.Event()
+
+        def blocking_call():
+            release.wait()
+            return threading.get_ident()
+
+        calls = [executor.run(blocking_call)] + [executor.run(threading.get_ident) for _ in range(2)]
+        tasks = asyncio.gather(*calls)
+        # the ioloop is still free while the only worker is busy
+        await asyncio.sleep(0.01)
+        release.set()
+        thread_ids = await tasks
+
+        assert threading.get_ident() not in thread_ids
+        max_queue_depth, wait_times = executor.flush_stats()
+        # the two calls behind the blocked one were queued together
+        assert max_queue_depth >= 2
+        assert wait_times.count == 3
+
+        # stats reset after each flush
+        max_queue_depth, wait_times = executor.flush_stats()
+        assert (max_queue_depth, wait_times.count) == (0, 0)
+
+    @tornado.testing.gen_test
+    async def test_run__inline_without_workers(self):
+        executor = DBExecutor(max_workers=0)
+
+        thread_id = await executor.run(threading.get_ident)
+
+        assert thread_id == threading.get_ident()
+        max_queue_depth, wait_times = executor.flush_stats()
+        assert (max_queue_depth, wait_times.count) == (0, 0)
+
+    @tornado.testing.gen_test
+    async def test_run__returns_connection_to_pool_after_each_call(self):
+        # pooled connections move between the executor's threads
+        pool = make_pool(check_same_thread=False)
+        executor = DBExecutor(max_workers=2, database=pool)
+
+        def query():
+            assert not pool.is_closed()
+            return pool.execute_sql("SELECT 1").fetchone()[0]
+
+        assert await asyncio.gather(*(executor.run(query) for _ in range(4))) == [1] * 4
+
+        # checked out for each call and returned, so the same connection serves every thread
+        assert len(pool._in_use) == 0
+        connect_times, opened, _ = pool.flush_stats()
+        assert connect_times.count == 4
+        assert opened <= 2
+
+    @tornado.testing.gen_test
+    async def test_run__inline_keeps_callers_connection(self):
+        pool = make_pool()
+        executor = DBExecutor(max_workers=0, database=pool)
+        pool.connect()
+
+        await executor.run(pool.execute_sql, "SELECT 1")
+
+        assert not pool.is_closed()
+        pool.close()
+
+
+class TestInstrumentedPool:
+    def test_connect__records_connect_time_and_churn(self):
+        pool = make_pool()
+
+        pool.connect()
+        pool.execute_sql("SELECT 1")
+        pool.close()
+        # the second checkout reuses the idle connection
+        pool.connect()
+        pool.manual_close()
+
+        connect_times, opened, closed = pool.flush_stats()
+        assert connect_times.count == 2
+        assert (opened, closed) == (1, 1)
+        connect_times, opened, closed = pool.flush_stats()
+        assert (connect_times.count, opened, closed) == (0, 0, 0)
+
+    def test_warm_up__opens_only_the_shortfall(self):
+        pool = make_pool()
+
+        assert pool.warm_up(2) == 2
+        assert pool.warm_up(3) == 1
+        assert (len(pool._in_use), len(pool._connections)) == (0, 3)
+        # never beyond max_connections
+        assert pool.warm_up(10) == 1
+
+    def test_warm_up__first_checkout_reuses_warm_connection(self):
+        pool = make_pool()
+        pool.warm_up(1)
+        pool.flush_stats()
+
+        pool.connect()
+
+        assert pool.flush_stats()[1] == 0
+        pool.close()
+
+    def test_validate_idle__closes_broken_and_stale_connections(self):
+        pool = make_pool(stale_timeout=60)
+        pool.warm_up(3)
+        broken = pool._connections[0][1]
+        broken.close()
+
+        assert pool.validate_idle() == 1
+        assert len(pool._connections) == 2
+        assert all(conn is not broken for _, conn in pool._connections)
+
+        with mock.patch("playhouse.pool.time.time", return_value=time.time() + 120):
+            assert pool.validate_idle() == 2
+        assert pool._connections == []
@@ -0,0 +1,72 @@
+import math
+import random
+
+import pytest
+
+from lib.histogram import LatencyHistogram
+
+
+def exact_percentile(values: list, percentile: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percentile / 100 * len(ordered)) - 1, 0)]
+
+
+def test_percentile__within_relative_error():
+    rng = random.Random(0)
+    values = [rng.lognormvariate(3, 1) for _ in range(10_000)]
+    histogram = LatencyHistogram()
+    for value in values:
+        histogram.record(value)
+
+    for percentile in (50, 90, 95, 99, 99.9):
+        expected = exact_percentile(values, percentile)
+        assert histogram.percentile(percentile) == pytest.approx(expected, rel=LatencyHistogram.RELATIVE_ERROR)
+    assert histogram.percentile(100) == max(values)
+    assert histogram.count == len(values)
+    assert histogram.sum == pytest.approx(sum(values))
+
+
+def test_record__fixed_memory():
+    histogram = LatencyHistogram()
+    for exponent in range(-5, 12):
+        for _ in range(100):
+            histogram.record(10**exponent)
+
+    assert len(histogram.buckets) <= LatencyHistogram.MAX_INDEX + 1
+    assert histogram.percentile(100) == 10**11
+
+
+def test_merge__same_as_recording_everything():
+    rng = random.Random(1)
+    values = [rng.uniform(1, 500) for _ in range(1000)]
+    merged, whole = LatencyHistogram(), LatencyHistogram()
+    for i, value in enumerate(values):
+        whole.record(value)
+        if i % 2:
+            merged.record(value)
+    other = LatencyHistogram()
+    for value in values[::2]:
+        other.record(value)
+
+    merged.merge(other)
+
+    assert merged.buckets == whole.buckets
+    assert (merged.count, merged.min, merged.max) == (whole.count, whole.min, whole.max)
+    assert merged.percentile(99) == whole.percentile(99)
+
+
+def test_percentile__empty():
+    assert math.isnan(LatencyHistogram().percentile(50))
+
+
+def test_values_and_counts__chunked():
+    histogram = LatencyHistogram()
+    for value in range(1, 2000):
+        histogram.record(value)
+
+    chunks = list(histogram.values_and_counts(150))
+
+    assert all(len(values) == len(counts) <= 150 for values, counts in chunks)
+    assert sum(sum(counts) for _, counts in chunks) == histogram.count
+    all_values = [value for values, _ in chunks for value in values]
+    assert all_values == sorted(all_values)
@@ -0,0 +1,111 @@
+from unittest import mock
+
+import tornado.gen
+import tornado.testing
+
+from lib.histogram import LatencyHistogram
+from lib.metrics import (
+    MAX_VALUES_PER_DATUM,
+    LocalMetricsClient,
+    MetricEmitter,
+    Unit,
+    format_datum,
+    write_histogram_metrics,
+)
+
+
+class FailingClient:
+    def put_metric_data(self, **kwargs):
+        raise ConnectionError("cloudwatch is down")
+
+
+def datum(value: float) -> dict:
+    return format_datum("test_metric", Unit.COUNT, {"site": "site"}, Value=value)
+
+
+def test_local_client__keeps_last_calls():
+    client = LocalMetricsClient()
+
+    for value in range(LocalMetricsClient.MAX_CALLS + 10):
+        client.put_metric_data(Namespace="namespace", MetricData=[datum(value)])
+
+    assert len(client.calls) == LocalMetricsClient.MAX_CALLS
+    assert client.calls[0]["MetricData"][0]["Value"] == 10
+    assert client.calls[-1]["MetricData"][0]["Value"] == LocalMetricsClient.MAX_CALLS + 9
+
+
+class TestMetricEmitter(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    async def test_flush__sends_in_batches(self):
+        client = LocalMetricsClient()
+        emitter = MetricEmitter(client, "namespace")
+        for i in range(MetricEmitter.MAX_BATCH_SIZE + 5):
+            emitter.put(datum(i))
+
+        await emitter.flush()
+
+        assert [len(call["MetricData"]) for call in client.calls] == [MetricEmitter.MAX_BATCH_SIZE, 5]
+        assert all(call["Namespace"] == "namespace" for call in client.calls)
+        values = [d["Value"] for call in client.calls for d in call["MetricData"]]
+        assert values == list(range(MetricEmitter.MAX_BATCH_SIZE + 5))
+
+    @tornado.testing.gen_test
+    async def test_put__full_queue__drops_and_reports(self):
+        client = LocalMetricsClient()
+        emitter = MetricEmitter(client, "namespace", max_queue_size=2)
+        for i in range(5):
+            emitter.put(datum(i))
+
+        await emitter.flush()
+
+        (call,) = client.calls
+        dropped, *data = call["MetricData"]
+        assert dropped["MetricName"] == "metrics_dropped"
+        assert dropped["Value"] == 3
+        assert {"Name": "reason", "Value": "queue_full"} in dropped["Dimensions"]
+        assert [d["Value"] for d in data] == [0, 1]
+
+    @tornado.testing.gen_test
+    async def test_flush__send_failure__counted_as_dropped(self):
+        emitter = MetricEmitter(FailingClient(), "namespace")
+        emitter.put(datum(1))
+        emitter.put(datum(2))
+
+        await emitter.flush()
+
+        assert emitter.dropped == {"send_failed": 2}
+        client = LocalMetricsClient()
+        emitter.client = client
+        await emitter.flush()
+        assert client.calls[0]["MetricData"][0]["Value"] == 2
+        assert emitter.dropped == {}
+
+    @tornado.testing.gen_test
+    async def test_run__full_batch__flushed_early(self):
+        client = LocalMetricsClient()
+        emitter = MetricEmitter(client, "namespace", flush_interval_sec=60)
+        self.io_loop.spawn_callback(emitter.run)
+        await tornado.gen.sleep(0.01)
+
+        for i in range(MetricEmitter.MAX_BATCH_SIZE):
+            emitter.put(datum(i))
+        for _ in range(100):
+            if client.calls:
+                break
+            await tornado.gen.sleep(0.01)
+
+        assert len(client.calls[0]["MetricData"]) == MetricEmitter.MAX_BATCH_SIZE
+
+
+def test_write_histogram_metrics__values_and_counts():
+    histogram = LatencyHistogram()
+    for value in range(1, 2000):
+        histogram.record(value)
+    emitter = MetricEmitter(LocalMetricsClient(), "namespace")
+
+    with mock.patch("lib.metrics.EMITTER", emitter):
+        write_histogram_metrics("latency", histogram, tags={"site": "site"})
+
+    data = emitter.take_batch()
+    assert all(len(d["Values"]) == len(d["Counts"]) <= MAX_VALUES_PER_DATUM for d in data)
+    assert sum(sum(d["Counts"]) for d in data) == histogram.count
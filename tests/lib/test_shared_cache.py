@@ -0,0 +1,179 @@
+import asyncio
+import socket
+import time
+from unittest import mock
+
+import tornado.testing
+from tornado.iostream import StreamClosedError
+from tornado.tcpserver import TCPServer
+
+from lib.shared_cache import RedisClient, SharedCache, encode_command
+
+
+class FakeRedisServer(TCPServer):
+    """
+    answers GET, MGET and SET from a dict, enough of the protocol to exercise RedisClient
+    """
+
+    def __init__(self, latency_sec: float = 0):
+        super().__init__()
+        self.data = {}
+        self.commands = []
+        self.latency_sec = latency_sec
+
+    async def handle_stream(self, stream, address):
+        try:
+            while True:
+                count = int((await stream.read_until(b"\r\n"))[1:-2])
+                args = []
+                for _ in range(count):
+                    length = int((await stream.read_until(b"\r\n"))[1:-2])
+                    args.append((await stream.read_bytes(length + 2))[:-2])
+                self.commands.append(args)
+                await asyncio.sleep(self.latency_sec)
+                if args[0] == b"SET":
+                    self.data[args[1]] = args[2]
+                    await stream.write(b"+OK\r\n")
+                elif args[0] == b"MGET":
+                    await stream.write(b"*%d\r\n" % (len(args) - 1))
+                    for key in args[1:]:
+                        await stream.write(self.bulk_reply(key))
+                else:
+                    await stream.write(self.bulk_reply(args[1]))
+        except StreamClosedError:
+            pass
+
+    def bulk_reply(self, key: bytes) -> bytes:
+        if key not in self.data:
+            return b"$-1\r\n"
+        value = self.data[key]
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def unused_port() -> int:
+    sock, port = tornado.testing.bind_unused_port()
+    sock.close()
+    return port
+
+
+def test_encode_command():
+    assert encode_command("SET", "key", b"a\r\nb", "EX", 60) == (
+        b"*5\r\n$3\r\nSET\r\n$3\r\nkey\r\n$4\r\na\r\nb\r\n$2\r\nEX\r\n$2\r\n60\r\n"
+    )
+
+
+class TestRedisClient(tornado.testing.AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        sock, self.port = tornado.testing.bind_unused_port()
+        self.server = FakeRedisServer()
+        self.server.add_socket(sock)
+
+    def tearDown(self):
+        self.server.stop()
+        super().tearDown()
+
+    @tornado.testing.gen_test
+    async def test_get_set(self):
+        client = RedisClient("127.0.0.1", self.port, timeout_sec=1)
+
+        assert await client.get("key") is None
+        await client.set("key", b"[1, 2]", 60)
+        assert await client.get("key") == b"[1, 2]"
+        assert self.server.commands[1] == [b"SET", b"key", b"[1, 2]", b"EX", b"60"]
+
+    @tornado.testing.gen_test
+    async def test_shared_cache__prefixes_keys(self):
+        cache = SharedCache.from_url(f"redis://127.0.0.1:{self.port}", prefix="svc:local:", timeout_sec=1)
+
+        await cache.set("recs:a", b"[]", 60)
+
+        assert self.server.data == {b"svc:local:recs:a": b"[]"}
+        assert await cache.get("recs:a") == b"[]"
+        assert await cache.get_many(["recs:b", "recs:a"]) == [None, b"[]"]
+
+    @tornado.testing.gen_test
+    async def test_shared_cache__concurrent_gets_dont_mark_healthy_server_down(self):
+        self.server.latency_sec = 0.001
+        cache = SharedCache.from_url(f"redis://127.0.0.1:{self.port}", timeout_sec=0.05)
+
+        await asyncio.gather(*(cache.get(f"key-{i}") for i in range(100)))
+
+        # waiting for a connection isn't part of the round trip, nor a failure
+        assert cache.flush_errors() == 0
+        assert cache.is_available
+
+
+class TestSharedCache(tornado.testing.AsyncTestCase):
+    @tornado.testing.gen_test
+    async def test_unreachable_server__degrades_to_miss(self):
+        cache = SharedCache.from_url(f"redis://127.0.0.1:{unused_port()}", timeout_sec=1)
+
+        assert await cache.get("key") is None
+        await cache.set("key", b"[]", 60)
+
+        # the failed get marks the tier down, so the set doesn't try to connect again
+        assert cache.flush_errors() == 1
+        assert not cache.is_available
+
+    @tornado.testing.gen_test
+    async def test_unreachable_server__retried_after_backoff(self):
+        cache = SharedCache.from_url(f"redis://127.0.0.1:{unused_port()}", timeout_sec=1)
+        await cache.get("key")
+
+        with mock.patch("lib.shared_cache.time.monotonic", return_value=float("inf")):
+            assert cache.is_available
+
+    @tornado.testing.gen_test
+    async def test_slow_server__times_out(self):
+        # accepts connections but never replies
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        cache = SharedCache.from_url(f"redis://127.0.0.1:{listener.getsockname()[1]}", timeout_sec=0.05)
+
+        assert await cache.get("key") is None
+        assert cache.flush_errors() == 1
+        listener.close()
+
+    @tornado.testing.gen_test
+    async def test_slow_server__concurrent_gets_wait_at_most_timeout(self):
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        cache = SharedCache.from_url(f"redis://127.0.0.1:{listener.getsockname()[1]}", timeout_sec=0.05)
+
+        started_at = time.monotonic()
+        results = await asyncio.gather(*(cache.get(f"key-{i}") for i in range(20)))
+        elapsed = time.monotonic() - started_at
+
+        assert results == [None] * 20
+        # the wait for the connection counts against the timeout, rather than each get queueing behind the last
+        assert elapsed < 0.5
+        # one outage, one error
+        assert cache.flush_errors() == 1
+        listener.close()
+
+    def test_from_url__writes_use_their_own_connection(self):
+        cache = SharedCache.from_url("redis://127.0.0.1:6379")
+
+        assert cache.write_client is not None
+        assert cache.write_client is not cache.client
+
+    @tornado.testing.gen_test
+    async def test_disabled(self):
+        cache = SharedCache.from_url("")
+
+        await cache.set("key", b"[]", 60)
+        assert await cache.get("key") is None
+        assert await cache.get_many(["key"]) == [None]
+        assert not cache.is_available
+
+    @tornado.testing.gen_test
+    async def test_memory__expires_after_ttl(self):
+        cache = SharedCache.from_url("memory://")
+        await cache.set("key", b"[]", 60)
+
+        assert await cache.get("key") == b"[]"
+        with mock.patch("lib.shared_cache.time.monotonic", return_value=float("inf")):
+            assert await cache.get("key") is None
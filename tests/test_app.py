@@ -0,0 +1,167 @@
+import time
+from unittest import mock
+
+from app import (
+    MetricRegistry,
+    MetricSnapshot,
+    WorkerMetricAggregator,
+    flush_metrics,
+    format_labels,
+)
+from lib.histogram import LatencyHistogram
+
+
+def make_snapshot(site: str, total: int, latencies: list) -> MetricSnapshot:
+    snapshot = MetricSnapshot()
+    snapshot.counters["total_rec_requests"] = {site: total}
+    histogram = snapshot.latencies[("Rec", site)] = LatencyHistogram()
+    for latency in latencies:
+        histogram.record(latency)
+    return snapshot
+
+
+class TestMetricSnapshot:
+    def test_merge__sums_counters_and_combines_latencies(self):
+        snapshot = make_snapshot("site1", 2, [1.0, 2.0])
+        snapshot.merge(make_snapshot("site1", 3, [3.0]))
+        snapshot.merge(make_snapshot("site2", 1, [4.0]))
+
+        assert snapshot.counters["total_rec_requests"] == {"site1": 5, "site2": 1}
+        site1_latencies = snapshot.latencies[("Rec", "site1")]
+        assert (site1_latencies.count, site1_latencies.sum, site1_latencies.max) == (3, 6.0, 3.0)
+        assert snapshot.latencies[("Rec", "site2")].count == 1
+
+    def test_merge__combines_stage_latencies(self):
+        snapshot, other = MetricSnapshot(), MetricSnapshot()
+        for stage_snapshot, latency in ((snapshot, 1.0), (other, 3.0)):
+            histogram = stage_snapshot.stage_latencies[("Rec", "site1", "db")] = LatencyHistogram()
+            histogram.record(latency)
+        other.stage_latencies[("Rec", "site1", "encode")] = LatencyHistogram()
+
+        snapshot.merge(other)
+
+        assert set(snapshot.stage_latencies) == {("Rec", "site1", "db"), ("Rec", "site1", "encode")}
+        assert snapshot.stage_latencies[("Rec", "site1", "db")].count == 2
+        assert snapshot.stage_latencies[("Rec", "site1", "db")].max == 3.0
+
+    def test_merge__db_pool_connections_are_gauges(self):
+        snapshot, other, later = MetricSnapshot(), MetricSnapshot(), MetricSnapshot()
+        snapshot.db_pool_connections = {"in_use": 2, "idle": 1}
+        other.db_pool_connections = {"in_use": 3, "idle": 0}
+        other.db_connections_opened = 3
+        later.db_pool_connections = {"in_use": 1, "idle": 4}
+
+        # other workers' pools add up, while a later snapshot of the same pool replaces them
+        snapshot.merge(other)
+        assert snapshot.db_pool_connections == {"in_use": 5, "idle": 1}
+        snapshot.merge(later, later=True)
+        assert snapshot.db_pool_connections == {"in_use": 1, "idle": 4}
+        assert snapshot.db_connections_opened == 3
+
+    def test_rec_cache_hit_ratios(self):
+        snapshot = MetricSnapshot()
+        snapshot.counters["total_rec_cache_hits"] = {"site1": 6, "site2": 0}
+        snapshot.counters["total_rec_cache_stale_hits"] = {"site1": 2}
+        snapshot.counters["total_rec_cache_misses"] = {"site1": 2, "site2": 0}
+
+        assert snapshot.rec_cache_hit_ratios() == {"site1": 80.0}
+
+
+class TestMetricRegistry:
+    def test_take_pending__totals_keep_accumulating(self):
+        registry = MetricRegistry()
+        first, second = make_snapshot("site1", 2, [1.0]), make_snapshot("site1", 3, [2.0])
+        first.rec_cache_stats = {"site1": {"bytes": 100, "entries": 2, "evictions": 1}}
+        second.rec_cache_stats = {"site2": {"bytes": 50, "entries": 1, "evictions": 0}}
+
+        with mock.patch.object(MetricSnapshot, "collect", side_effect=[first, second]):
+            assert registry.take_pending().counters["total_rec_requests"] == {"site1": 2}
+            assert registry.take_pending().counters["total_rec_requests"] == {"site1": 3}
+
+        assert registry.totals.counters["total_rec_requests"] == {"site1": 5}
+        assert registry.totals.latencies[("Rec", "site1")].count == 2
+        # cache size is a gauge, so the latest snapshot replaces it, while evictions add up
+        assert registry.totals.rec_cache_stats == {
+            "site1": {"bytes": 0, "entries": 0, "evictions": 1},
+            "site2": {"bytes": 50, "entries": 1, "evictions": 0},
+        }
+
+    def test_render__serves_every_workers_totals(self, tmp_path):
+        workers = [MetricRegistry(), MetricRegistry()]
+        for worker_id, registry in enumerate(workers):
+            registry.share_totals(str(tmp_path), worker_id)
+
+        snapshots = [
+            make_snapshot("site1", 2, [1.0]),
+            make_snapshot("site1", 3, [2.0]),
+            MetricSnapshot(),
+            MetricSnapshot(),
+        ]
+        with mock.patch.object(MetricSnapshot, "collect", side_effect=snapshots):
+            workers[1].save_totals()
+            workers[0].save_totals()
+            # either worker answers with the task's totals
+            rendered = [workers[1].render(), workers[0].render()]
+
+        for text in rendered:
+            assert 'total_rec_requests{site="site1"} 5' in text
+            assert "db_executor_queue_depth" not in text
+
+
+def test_format_labels__escapes_values():
+    assert format_labels({}) == ""
+    assert format_labels({"site": 'a"b\\c\nd', "stage": "db"}) == '{site="a\\"b\\\\c\\nd",stage="db"}'
+
+
+class TestWorkerMetricAggregator:
+    def test_flush_metrics__only_leader_publishes(self):
+        aggregator = WorkerMetricAggregator()
+        follower_snapshot = make_snapshot("site1", 3, [3.0])
+
+        with mock.patch.object(MetricSnapshot, "collect", return_value=follower_snapshot), mock.patch.object(
+            MetricSnapshot, "publish"
+        ) as publish:
+            flush_metrics(aggregator)
+        publish.assert_not_called()
+
+        aggregator.is_leader = True
+        leader_snapshot = make_snapshot("site1", 2, [1.0])
+        with mock.patch.object(MetricSnapshot, "collect", return_value=leader_snapshot), mock.patch.object(
+            MetricSnapshot, "publish", autospec=True
+        ) as publish:
+            # the queue hands snapshots over from a background thread
+            for _ in range(100):
+                if not aggregator._queue.empty():
+                    break
+                time.sleep(0.01)
+            flush_metrics(aggregator)
+        publish.assert_called_once()
+        (published,) = publish.call_args[0]
+        assert published.counters["total_rec_requests"] == {"site1": 5}
+
+    def test_merge_into__keeps_latest_gauges_per_worker(self):
+        aggregator = WorkerMetricAggregator()
+        aggregator.is_leader = True
+        older, latest = make_snapshot("site1", 2, [1.0]), make_snapshot("site1", 3, [2.0])
+        older.db_pool_connections = {"in_use": 5, "idle": 5}
+        latest.db_pool_connections = {"in_use": 1, "idle": 2}
+        latest.rec_cache_stats = {"site1": {"bytes": 100, "entries": 2, "evictions": 1}}
+
+        # two snapshots from the same follower in one flush
+        snapshot = MetricSnapshot()
+        snapshot.db_pool_connections = {"in_use": 1, "idle": 0}
+        with mock.patch.object(aggregator, "drain", return_value=[(1, older), (1, latest)]):
+            aggregator.merge_into(snapshot)
+
+        assert snapshot.counters["total_rec_requests"] == {"site1": 5}
+        assert snapshot.db_pool_connections == {"in_use": 2, "idle": 2}
+        assert snapshot.rec_cache_stats == {"site1": {"bytes": 100, "entries": 2, "evictions": 1}}
+
+        # none from it in the next flush, but its gauges still count, and its counters aren't added again
+        snapshot = MetricSnapshot()
+        with mock.patch.object(aggregator, "drain", return_value=[]):
+            aggregator.merge_into(snapshot)
+
+        assert snapshot.counters == {}
+        assert snapshot.db_pool_connections == {"in_use": 1, "idle": 2}
+        assert snapshot.rec_cache_stats == {"site1": {"bytes": 100, "entries": 2, "evictions": 0}}